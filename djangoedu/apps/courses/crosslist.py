@@ -0,0 +1,227 @@
+"""
+===========
+Cross Lists
+===========
+
+``Course.cross_list`` and ``CourseOffering.cross_list`` link the listings
+of one class under different departments or numbers. Cross listing is
+transitive, so instead of following the links hop by hop every row keeps
+``cross_list_group``, the smallest primary key of its class, and all the
+listings are a single indexed query::
+
+    CourseOffering.objects.filter(cross_list_group=offering.cross_list_group)
+
+The groups are computed with union-find over the link table. Change links
+with ``link`` and ``unlink``, which update only the groups involved. Links
+changed some other way, in the admin or with ``cross_list.add()``, fire no
+signal, so ``cross_listed`` (behind ``get_cross_listed``) compares the group
+of a row with the rows its links reach and refreshes the group when they
+disagree. ``manage.py rebuildcrosslists`` recomputes every group, for
+example after the column was added to an existing database.
+
+Example use:
+
+    >>> link(phy_offering, ast_offering)
+    >>> [unicode(o) for o in phy_offering.get_cross_listed()]
+    [u'AST 309: Stars Spring 2008', u'PHY 309: Stars Spring 2008']
+"""
+
+import time
+
+from django.db import connection, transaction
+from django.db.models import Q
+
+# number of primary keys per IN clause
+CHUNK_SIZE = 500
+
+class UnionFind(object):
+    """
+    Disjoint sets of keys, each set named by its smallest key.
+
+        >>> sets = UnionFind([1, 2, 3, 4])
+        >>> sets.union(4, 2), sets.union(2, 3)
+        (2, 2)
+        >>> sets.find(3), sets.find(1)
+        (2, 1)
+    """
+
+    def __init__(self, keys=()):
+        self.parents = {}
+        for key in keys:
+            self.parents[key] = key
+
+    def find(self, key):
+        parents = self.parents
+        parents.setdefault(key, key)
+        while parents[key] != key:
+            # path halving
+            parents[key] = parents[parents[key]]
+            key = parents[key]
+        return key
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if b < a:
+            a, b = b, a
+        self.parents[b] = a
+        return a
+
+    def groups(self):
+        """Return a dictionary mapping every key to the name of its set."""
+        return dict([(key, self.find(key)) for key in self.parents])
+
+def _links(model, pks=None):
+    """Return the (pk, pk) pairs of the cross_list links of model, only
+    those touching pks if given."""
+    field = model._meta.get_field('cross_list')
+    qn = connection.ops.quote_name
+    columns = qn(field.m2m_column_name()), qn(field.m2m_reverse_name())
+    sql = 'SELECT %s, %s FROM %s' % (columns + (qn(field.m2m_db_table()),))
+    cursor = connection.cursor()
+    if pks is None:
+        cursor.execute(sql)
+        return list(cursor.fetchall())
+    pks = list(pks)
+    links = []
+    for start in range(0, len(pks), CHUNK_SIZE):
+        chunk = pks[start:start + CHUNK_SIZE]
+        marks = ', '.join(['%s'] * len(chunk))
+        cursor.execute(sql + ' WHERE %s IN (%s) OR %s IN (%s)' % (
+            columns[0], marks, columns[1], marks), chunk + chunk)
+        links.extend(cursor.fetchall())
+    return links
+
+def _connected(model, pks):
+    """Return the pks linked to pks directly or not, and their links."""
+    seen = dict.fromkeys(pks)
+    frontier = list(seen)
+    links = []
+    while frontier:
+        found = _links(model, frontier)
+        links.extend(found)
+        frontier = []
+        for pair in found:
+            for pk in pair:
+                if pk not in seen:
+                    seen[pk] = None
+                    frontier.append(pk)
+    return seen.keys(), links
+
+def _write_groups(model, groups):
+    """Store the groups that changed, returns the count."""
+    current = {}
+    pks = groups.keys()
+    for start in range(0, len(pks), CHUNK_SIZE):
+        for pk, group in model.objects.filter(pk__in=pks[start:start + CHUNK_SIZE]
+                ).values_list('pk', 'cross_list_group'):
+            current[pk] = group
+    changed = [(group, pk) for pk, group in groups.items()
+               if pk in current and current[pk] != group]
+    if changed:
+        qn = connection.ops.quote_name
+        opts = model._meta
+        connection.cursor().executemany('UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+            qn(opts.db_table), qn(opts.get_field('cross_list_group').column),
+            qn(opts.pk.column)), changed)
+        # commits outside transaction management, marks the transaction
+        # dirty for commit_on_success inside it
+        transaction.commit_unless_managed()
+    return len(changed)
+
+def link(a, b):
+    """Cross list a and b, two courses or two offerings, merging their groups."""
+    model = a.__class__
+    def merge():
+        a.cross_list.add(b)
+        groups = [group or pk for pk, group in model.objects.filter(
+            pk__in=[a.pk, b.pk]).values_list('pk', 'cross_list_group')]
+        group = min(groups)
+        model.objects.filter(Q(cross_list_group__in=groups) |
+            Q(pk__in=[a.pk, b.pk])).update(cross_list_group=group)
+        return group
+    a.cross_list_group = b.cross_list_group = transaction.commit_on_success(merge)()
+
+def unlink(a, b):
+    """Remove the cross listing of a and b, splitting their group if nothing
+    else connects them."""
+    def split():
+        a.cross_list.remove(b)
+        return refresh_groups(a.__class__, [a.pk, b.pk])
+    groups = transaction.commit_on_success(split)()
+    a.cross_list_group, b.cross_list_group = groups[a.pk], groups[b.pk]
+
+def refresh_groups(model, pks):
+    """Recompute the groups of the rows of pks and of everything in their
+    groups or linked to them. Returns the dictionary of the new groups."""
+    pks = list(pks)
+    start = dict.fromkeys(pks)
+    old = model.objects.filter(pk__in=pks).exclude(cross_list_group=None)
+    old = dict.fromkeys(old.values_list('cross_list_group', flat=True)).keys()
+    for index in range(0, len(old), CHUNK_SIZE):
+        for pk in model.objects.filter(cross_list_group__in=old[index:index + CHUNK_SIZE]
+                ).values_list('pk', flat=True):
+            start[pk] = None
+    keys, links = _connected(model, start.keys())
+    sets = UnionFind(keys)
+    for pair in links:
+        sets.union(*pair)
+    groups = sets.groups()
+    _write_groups(model, groups)
+    return groups
+
+def rebuild_groups(model):
+    """Recompute the group of every row of model in one transaction.
+
+    Returns a dictionary with the counts of ``rows``, ``groups`` (with more
+    than one listing) and ``updated`` rows and ``seconds``.
+    """
+    started = time.time()
+    def rebuild():
+        sets = UnionFind(model.objects.values_list('pk', flat=True))
+        for pair in _links(model):
+            sets.union(*pair)
+        groups = sets.groups()
+        return groups, _write_groups(model, groups)
+    groups, updated = transaction.commit_on_success(rebuild)()
+    sizes = {}
+    for group in groups.values():
+        sizes[group] = sizes.get(group, 0) + 1
+    return {'rows': len(groups), 'updated': updated, 'seconds': time.time() - started,
+            'groups': len([size for size in sizes.values() if size > 1])}
+
+def cross_listed(instance):
+    """Return the rows cross listed with instance, itself included.
+
+    The group is refreshed first when the links reach other rows than the
+    stored group holds, which costs a query per hop of the links.
+    """
+    model = instance.__class__
+    keys, links = _connected(model, [instance.pk])
+    group = model.objects.filter(pk=instance.pk).values_list('cross_list_group', flat=True)
+    group = list(group)
+    members = []
+    if group and group[0] is not None:
+        members = list(model.objects.filter(cross_list_group=group[0]
+            ).values_list('pk', flat=True))
+    keys.sort()
+    members.sort()
+    if keys != members:
+        group = [refresh_groups(model, [instance.pk])[instance.pk]]
+    if group:
+        instance.cross_list_group = group[0]
+    return model.objects.filter(cross_list_group=instance.cross_list_group)
+
+def assign_group(instance):
+    """A new row is in a group of its own."""
+    if instance.cross_list_group is None:
+        instance.__class__.objects.filter(pk=instance.pk).update(
+            cross_list_group=instance.pk)
+        instance.cross_list_group = instance.pk
+
+def split_group(instance):
+    """The rest of the group of a deleted row may no longer be connected."""
+    model = instance.__class__
+    group = instance.cross_list_group
+    if group is not None:
+        refresh_groups(model, model.objects.filter(cross_list_group=group
+            ).values_list('pk', flat=True))
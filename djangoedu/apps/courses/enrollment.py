@@ -0,0 +1,181 @@
+"""
+=================
+Enrollment Import
+=================
+
+Applies a registrar feed of section memberships for one semester in bulk
+instead of saving ``CourseMembership`` rows one at a time.
+
+The feed is a list of ``(uid, unique number, role, status)`` records. The
+sections of the semester, the people and the roles are read into
+dictionaries once. Then, in one transaction, the feed is compared with the
+memberships already in the sections and only the differences are written:
+new memberships with a single ``executemany`` INSERT, status changes and
+deletes with one UPDATE or DELETE per ``batch_size`` rows. ``date`` is set
+on the rows inserted or changed only.
+
+Only memberships in the roles that appear in the feed are compared, so an
+enrollment feed of learners leaves the instructors alone. Memberships
+missing from the feed are kept unless ``delete_missing`` is given.
+
+Records for unknown uids, unique numbers or roles are skipped and counted.
+Duplicate memberships of a person, section and role are deleted.
+
+Example use:
+
+    >>> stats = import_enrollment([('rm6776', 12345, 'Learner', True)], semester)
+    >>> stats['created'], stats['deleted']
+    (1, 0)
+"""
+
+import time
+import datetime
+
+from django.db import connection, transaction
+
+from djangoedu.core.models import eduPerson
+from djangoedu.apps.courses.models import CourseMembership, OfferingSection, \
+    RoleType
+
+def _index_sections(semester):
+    """Return the unique numbers of the sections of semester mapped to
+    (section pk, offering pk)."""
+    sections = {}
+    for number, pk, offering in OfferingSection.objects.filter(
+            offering__timeFrame=semester).exclude(unique_number=None).values_list(
+            'unique_number', 'pk', 'offering'):
+        sections[number] = (pk, offering)
+    return sections
+
+def _index_people(uids, batch_size):
+    people = {}
+    for start in range(0, len(uids), batch_size):
+        for ldap, pk in eduPerson.objects.filter(
+                ldap__in=uids[start:start + batch_size]).values_list('ldap', 'pk'):
+            people[ldap] = pk
+    return people
+
+def _index_roles():
+    return dict(RoleType.objects.values_list('name', 'pk'))
+
+def _existing(section_pks, role_pks, batch_size):
+    """Return the memberships of the sections in the roles, (person,
+    section, role) mapped to (pk, status), and the pks of duplicates."""
+    existing = {}
+    duplicates = []
+    if not role_pks:
+        return existing, duplicates
+    for start in range(0, len(section_pks), batch_size):
+        for pk, person, section, role, status in CourseMembership.objects.filter(
+                section__in=section_pks[start:start + batch_size],
+                roleType__in=role_pks).order_by('pk'
+                ).values_list('pk', 'person', 'section', 'roleType', 'status'):
+            key = (person, section, role)
+            if key in existing:
+                duplicates.append(pk)
+            else:
+                existing[key] = (pk, status)
+    return existing, duplicates
+
+def _insert(cursor, rows):
+    qn = connection.ops.quote_name
+    opts = CourseMembership._meta
+    fields = ('offering', 'section', 'person', 'roleType', 'status', 'date')
+    columns = [qn(opts.get_field(name).column) for name in fields]
+    cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+        ', '.join(columns), ', '.join(['%s'] * len(columns))), rows)
+
+def _delete(cursor, pks, batch_size):
+    qn = connection.ops.quote_name
+    opts = CourseMembership._meta
+    for start in range(0, len(pks), batch_size):
+        chunk = pks[start:start + batch_size]
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(opts.db_table),
+            qn(opts.pk.column), ', '.join(['%s'] * len(chunk))), chunk)
+
+def import_enrollment(records, semester, delete_missing=False, batch_size=1000):
+    """Make the section memberships of semester match records.
+
+    Options:
+
+    * ``records``: ``(uid, unique number, role name, status)`` tuples, a
+      later record for the same person, section and role wins.
+    * ``semester``: The time frame of the sections.
+    * ``delete_missing``: Delete the memberships in the sections of the
+      semester, in the roles of records, that are not in records.
+    * ``batch_size``: Number of rows per query.
+
+    Returns a dictionary with the counts of ``records``, ``created``,
+    ``activated``, ``deactivated``, ``deleted`` and ``unchanged``
+    memberships, of ``unknown_people``, ``unknown_sections`` and
+    ``unknown_roles`` records, and ``resolve_seconds``, ``diff_seconds``,
+    ``write_seconds`` and ``seconds``.
+    """
+    started = time.time()
+    records = list(records)
+    stats = {'records': len(records), 'created': 0, 'activated': 0,
+             'deactivated': 0, 'deleted': 0, 'unchanged': 0,
+             'unknown_people': 0, 'unknown_sections': 0, 'unknown_roles': 0}
+
+    sections = _index_sections(semester)
+    people = _index_people(dict.fromkeys([record[0] for record in records]).keys(),
+                           batch_size)
+    roles = _index_roles()
+    wanted = {}
+    for uid, number, role, status in records:
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            number = None
+        if number not in sections:
+            stats['unknown_sections'] += 1
+        elif uid not in people:
+            stats['unknown_people'] += 1
+        elif role not in roles:
+            stats['unknown_roles'] += 1
+        else:
+            wanted[(people[uid], sections[number][0], roles[role])] = bool(status)
+    stats['resolve_seconds'] = time.time() - started
+    offerings = dict(sections.values())
+    role_pks = dict.fromkeys([role for person, section, role in wanted]).keys()
+
+    def apply():
+        # the memberships are read in the transaction that writes the
+        # differences, so the diff is as recent as it can be
+        started_diff = time.time()
+        existing, deletes = _existing(offerings.keys(), role_pks, batch_size)
+        now = datetime.datetime.now()
+        inserts = []
+        flips = {True: [], False: []}
+        for key, status in wanted.items():
+            if key not in existing:
+                person, section, role = key
+                inserts.append((offerings[section], section, person, role, status, now))
+            elif existing[key][1] != status:
+                flips[status].append(existing[key][0])
+            else:
+                stats['unchanged'] += 1
+        if delete_missing:
+            deletes.extend([pk for key, (pk, status) in existing.items()
+                            if key not in wanted])
+        stats['diff_seconds'] = time.time() - started_diff
+
+        started_write = time.time()
+        cursor = connection.cursor()
+        if inserts:
+            _insert(cursor, inserts)
+        for status, pks in flips.items():
+            for start in range(0, len(pks), batch_size):
+                CourseMembership.objects.filter(pk__in=pks[start:start + batch_size]
+                    ).update(status=status, date=now)
+        _delete(cursor, deletes, batch_size)
+        # raw SQL doesn't mark the transaction for commit_on_success
+        transaction.set_dirty()
+        stats['created'] = len(inserts)
+        stats['activated'] = len(flips[True])
+        stats['deactivated'] = len(flips[False])
+        stats['deleted'] = len(deletes)
+        stats['write_seconds'] = time.time() - started_write
+    transaction.commit_on_success(apply)()
+    stats['seconds'] = time.time() - started
+    return stats
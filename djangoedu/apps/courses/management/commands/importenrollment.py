@@ -0,0 +1,52 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+ACTIVE = ('1', 't', 'true', 'y', 'yes', 'a', 'active')
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--semester', dest='semester', type='int', default=None,
+            help='CCYYS of the semester, the current semester by default.'),
+        make_option('--delete-missing', action='store_true', dest='delete_missing',
+            default=False, help='Delete the memberships in the roles of the feed that '
+                                'are not in it.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of rows per query.'),
+    )
+    help = ("Applies a registrar feed, a CSV file with the columns uid, unique number, "
+            "role and status, to the section memberships of a semester.")
+    args = 'file.csv'
+
+    def handle(self, *args, **options):
+        from djangoedu.core.models import Semester
+        from djangoedu.apps.courses.enrollment import import_enrollment
+        if len(args) != 1:
+            raise CommandError('Enter the CSV file to import.')
+        try:
+            if options.get('semester'):
+                semester = Semester.objects.get(pk=options['semester'])
+            else:
+                semester = Semester.objects.current_semester()
+        except Semester.DoesNotExist:
+            raise CommandError('There is no such semester.')
+        records = []
+        for line, row in enumerate(csv.reader(open(args[0], 'rb'))):
+            row = [value.decode('utf-8').strip() for value in row]
+            if len(row) != 4:
+                raise CommandError('Line %d: expected uid, unique number, role and status.'
+                                   % (line + 1))
+            uid, number, role, status = row
+            records.append((uid, number, role, status.lower() in ACTIVE))
+        stats = import_enrollment(records, semester,
+                                  delete_missing=options.get('delete_missing'),
+                                  batch_size=options.get('batch_size'))
+        print "%s: %d records, %d created, %d activated, %d deactivated, %d deleted, %d unchanged" % (
+            semester, stats['records'], stats['created'], stats['activated'],
+            stats['deactivated'], stats['deleted'], stats['unchanged'])
+        print "Skipped %d unknown people, %d unknown sections, %d unknown roles" % (
+            stats['unknown_people'], stats['unknown_sections'], stats['unknown_roles'])
+        print "Resolved in %.1f, diffed in %.1f, written in %.1f, %.1f seconds in all" % (
+            stats['resolve_seconds'], stats['diff_seconds'], stats['write_seconds'],
+            stats['seconds'])
@@ -0,0 +1,18 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of courses read per query.'),
+    )
+    help = "Rebuilds the course search index."
+
+    def handle(self, *args, **options):
+        import time
+        from djangoedu.apps.courses.search import rebuild_index
+        start = time.time()
+        stats = rebuild_index(batch_size=options.get('batch_size'))
+        print "Indexed %d courses (%d tokens) in %.1f seconds" % (
+            stats['courses'], stats['tokens'], time.time() - start)
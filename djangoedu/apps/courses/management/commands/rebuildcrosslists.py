@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    help = "Recomputes the cross list groups of every Course and CourseOffering."
+
+    def handle(self, *args, **options):
+        from djangoedu.apps.courses.models import Course, CourseOffering
+        from djangoedu.apps.courses.crosslist import rebuild_groups
+        for model in (Course, CourseOffering):
+            stats = rebuild_groups(model)
+            print "%s: %d rows in %d cross listed groups, %d updated in %.1f seconds" % (
+                model._meta.verbose_name_plural, stats['rows'], stats['groups'],
+                stats['updated'], stats['seconds'])
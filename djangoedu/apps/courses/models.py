@@ -14,8 +14,10 @@ from django.utils.translation import ugettext as _
 from django.db import models
 from django.conf import settings
 from django.core import validators
+from django.db.models import signals
+from django.dispatch import dispatcher
 
-from edu.core.models import eduPerson
+from djangoedu.core.models import eduPerson
 
 # grab defaults from settings file
 try:
@@ -27,12 +29,12 @@ except:
 try:
     TimeFrame = __import__(settings.TIME_FRAME_MODEL)
 except:
-    from edu.core.models import Semester as TimeFrame
+    from djangoedu.core.models import Semester as TimeFrame
 
 try:
     Department = __import__(settings.DEPARTMENT_MODEL)
 except:
-    from edu.core.models import Organization as Department
+    from djangoedu.core.models import Organization as Department
     
 class Course(models.Model):
     """*Courses*
@@ -55,10 +57,33 @@ class Course(models.Model):
         help_text=_("If this course has a parent then this abstract will be appended to the parents abstract."))
     prerequisite = models.TextField(_("Prerequisite"), blank=True,
         help_text=_("If this course has a parent then this prereq will be appended to the parents prereq."))
+    cross_list_group = models.PositiveIntegerField(blank=True, null=True,
+        db_index=True, editable=False)
 
     def __unicode__(self):
         return u"%s %s: %s" % (unicode(self.department), self.number, self.title)
 
+    def get_cross_listed(self):
+        """Returns this course and every course it is cross listed as,
+        directly or not, see ``courses.crosslist``."""
+        from djangoedu.apps.courses.crosslist import cross_listed
+        return cross_listed(self)
+
+    def effective_abstract(self):
+        """Returns the abstract appended to those of the parent courses.
+        Use ``courses.texts.resolve_texts`` for many courses at once."""
+        return self._get_effective_texts()[0]
+
+    def effective_prerequisite(self):
+        """Returns the prerequisite appended to those of the parent courses."""
+        return self._get_effective_texts()[1]
+
+    def _get_effective_texts(self):
+        if not hasattr(self, '_effective_texts'):
+            from djangoedu.apps.courses.texts import resolve_texts
+            resolve_texts([self])
+        return self._effective_texts
+
     def short_title(self):
         """Returns a truncated title useful for table displays and menus."""
         return unicode(self)[:COURSE_TRUNCATE_LENGTH]
@@ -80,9 +105,17 @@ class CourseOffering(models.Model):
     timeFrame = models.ForeignKey(TimeFrame, verbose_name=_("Time Frame"))
     cross_list = models.ManyToManyField('self', verbose_name=_("Cross Listed As"), 
         blank=True, null=True, related_name="cross_listings")
+    cross_list_group = models.PositiveIntegerField(blank=True, null=True,
+        db_index=True, editable=False)
     
     def __unicode__(self):
         return u"%s %s" % (self.course, self.timeFrame)
+
+    def get_cross_listed(self):
+        """Returns this offering and every offering it is cross listed as,
+        directly or not, see ``courses.crosslist``."""
+        from djangoedu.apps.courses.crosslist import cross_listed
+        return cross_listed(self)
     
     class Meta:
         unique_together = ('course', 'timeFrame')
@@ -156,12 +189,63 @@ class CourseMembership(models.Model):
     date = models.DateTimeField(_("Status Date"))
     
     def save(self):
-        """Set the date to current time on change."""
+        """Set the date to current time when the status changes.
+        
+        See ``courses.enrollment`` for saving many memberships at once.
+        """
         import datetime
-        self.date = datetime.datetime.now()
-        super(Membership, self).save()
+        changed = self.pk is None or self.date is None
+        if not changed:
+            old = CourseMembership.objects.filter(pk=self.pk).values_list('status', flat=True)
+            changed = list(old) != [self.status]
+        if changed:
+            self.date = datetime.datetime.now()
+        super(CourseMembership, self).save()
         
     def __unicode__(self):
         if not self.section:
             return u"%s@%s" % (unicode(self.roleType), unicode(self.offering))
-        return u"%s@%s" % (unicode(self.roleType), unicode(self.section))
\ No newline at end of file
+        return u"%s@%s" % (unicode(self.roleType), unicode(self.section))
+
+class CourseSearchToken(models.Model):
+    """A word of a course in the search index, see ``courses.search``."""
+    course = models.ForeignKey(Course, related_name='search_tokens')
+    token = models.CharField(max_length=50, db_index=True)
+    weight = models.PositiveSmallIntegerField(default=1)
+    
+    class Meta:
+        unique_together = ('token', 'course')
+
+def _index_course(instance):
+    from djangoedu.apps.courses.search import index_course
+    index_course(instance)
+
+def _index_department(instance):
+    from djangoedu.apps.courses.search import index_department
+    index_department(instance)
+
+def _invalidate_texts(instance):
+    from djangoedu.apps.courses.texts import invalidate_texts
+    invalidate_texts(instance)
+
+def _assign_cross_list_group(instance):
+    from djangoedu.apps.courses.crosslist import assign_group
+    assign_group(instance)
+
+def _split_cross_list_group(instance):
+    from djangoedu.apps.courses.crosslist import split_group
+    split_group(instance)
+
+# keep the search index current
+dispatcher.connect(_index_course, signal=signals.post_save, sender=Course)
+dispatcher.connect(_index_department, signal=signals.post_save, sender=Department)
+
+# drop the composed abstracts and prerequisites
+dispatcher.connect(_invalidate_texts, signal=signals.post_save, sender=Course)
+dispatcher.connect(_invalidate_texts, signal=signals.post_delete, sender=Course)
+
+# keep the cross list groups current
+dispatcher.connect(_assign_cross_list_group, signal=signals.post_save, sender=Course)
+dispatcher.connect(_assign_cross_list_group, signal=signals.post_save, sender=CourseOffering)
+dispatcher.connect(_split_cross_list_group, signal=signals.post_delete, sender=Course)
+dispatcher.connect(_split_cross_list_group, signal=signals.post_delete, sender=CourseOffering)
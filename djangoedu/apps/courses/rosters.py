@@ -0,0 +1,209 @@
+"""
+=======
+Rosters
+=======
+
+The memberships of an offering or a section as flat rows, read without
+building a model instance (and its chain of foreign key queries) per
+member.
+
+Rows are read in chunks of ``chunk_size`` sorted by last name, each chunk
+a single joined query continuing after the last row of the previous one
+(keyset paging, so late chunks cost as much as the first), and the
+``ldap`` values of a chunk are resolved with one
+``LdapObjectField.prefetch``. Memory stays the same whatever the size of
+the roster, and ``roster_response`` streams the rows to the client as CSV
+or JSON while they are read.
+
+The following setting is used::
+
+    ROSTER_LDAP_ATTRIBUTES = (default ('ou',), LDAP attributes added as columns)
+
+The attributes must be among the ones the ``eduPerson.ldap`` field stores,
+see ``EDUPERSON_LDAP_ATTRIBUTES``, or ImproperlyConfigured is raised.
+
+Example use:
+
+    >>> for row in iter_roster(offering=offering):
+    ...     print row['username'], row['role']
+    rm6776 Instructor
+    ...
+
+Hooking the views into a urlconf::
+
+    (r'^offerings/(?P<offering_id>\\d+)/roster\\.(?P<format>csv|json)$',
+     'djangoedu.apps.courses.rosters.offering_roster'),
+    (r'^sections/(?P<section_id>\\d+)/roster\\.(?P<format>csv|json)$',
+     'djangoedu.apps.courses.rosters.section_roster'),
+"""
+
+import csv
+import StringIO
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, Http404
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.auth.decorators import permission_required
+
+from djangoedu.core.models import eduPerson
+from djangoedu.apps.courses.models import CourseMembership, CourseOffering, \
+    OfferingSection
+
+LDAP_ATTRIBUTES = tuple(getattr(settings, 'ROSTER_LDAP_ATTRIBUTES', ('ou',)))
+
+def _unknown_attributes(attributes):
+    """Return the attributes the ``eduPerson.ldap`` field doesn't store."""
+    stored = eduPerson._meta.get_field('ldap').attributes
+    if stored is None:
+        return []
+    return [name for name in attributes if name not in stored]
+
+if _unknown_attributes(LDAP_ATTRIBUTES):
+    raise ImproperlyConfigured("ROSTER_LDAP_ATTRIBUTES %s are not stored by "
+        "eduPerson.ldap, add them to EDUPERSON_LDAP_ATTRIBUTES."
+        % ', '.join(_unknown_attributes(LDAP_ATTRIBUTES)))
+
+# (column, membership lookup)
+FIELDS = (
+    ('id', 'pk'),
+    ('ldap', 'person__ldap'),
+    ('username', 'person__user__username'),
+    ('last_name', 'person__user__last_name'),
+    ('first_name', 'person__user__first_name'),
+    ('email', 'person__user__email'),
+    ('role', 'roleType__name'),
+    ('sub_role', 'subRole__name'),
+    ('section', 'section__unique_number'),
+    ('status', 'status'),
+    ('date', 'date'),
+)
+
+def roster_columns(ldap_attributes=None):
+    """Return the column names of the roster rows."""
+    if ldap_attributes is None:
+        ldap_attributes = LDAP_ATTRIBUTES
+    return [column for column, lookup in FIELDS] + list(ldap_attributes)
+
+def roster_queryset(offering=None, section=None, include_inactive=False):
+    """Return the memberships of offering, including those of its sections,
+    or of section."""
+    if (offering is None) == (section is None):
+        raise ValueError("Give either an offering or a section.")
+    if section is not None:
+        members = CourseMembership.objects.filter(section=section)
+    else:
+        members = CourseMembership.objects.filter(Q(offering=offering) |
+                                                  Q(section__offering=offering))
+    if not include_inactive:
+        members = members.filter(status=True)
+    return members
+
+def _chunks(members, chunk_size):
+    """Yield lists of value tuples in (last name, pk) order."""
+    lookups = [lookup for column, lookup in FIELDS]
+    last = None
+    while True:
+        chunk = members
+        if last is not None:
+            chunk = chunk.filter(Q(person__user__last_name__gt=last[0]) |
+                Q(person__user__last_name=last[0], pk__gt=last[1]))
+        chunk = list(chunk.order_by('person__user__last_name', 'pk'
+                     ).values_list(*lookups)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = (chunk[-1][3], chunk[-1][0])
+
+def _ldap_value(obj, attribute):
+    values = getattr(obj, attribute, None) or []
+    if isinstance(values, basestring):
+        return values
+    return u'; '.join(values)
+
+def iter_roster(offering=None, section=None, include_inactive=False,
+                chunk_size=500, ldap_attributes=None):
+    """Yield a dictionary per membership of offering or section, keyed by
+    ``roster_columns``.
+
+    Inactive memberships are left out unless ``include_inactive``. The
+    ``ldap_attributes`` columns are empty for people missing from the
+    directory, attributes ``eduPerson.ldap`` doesn't store raise
+    ValueError.
+    """
+    if ldap_attributes is None:
+        ldap_attributes = LDAP_ATTRIBUTES
+    elif _unknown_attributes(ldap_attributes):
+        raise ValueError("eduPerson.ldap doesn't store %s."
+                         % ', '.join(_unknown_attributes(ldap_attributes)))
+    members = roster_queryset(offering, section, include_inactive)
+    field = eduPerson._meta.get_field('ldap')
+    columns = [column for column, lookup in FIELDS]
+    for chunk in _chunks(members, chunk_size):
+        found = {}
+        if ldap_attributes:
+            found = field.prefetch(dict.fromkeys([values[1] for values in chunk]).keys())
+        for values in chunk:
+            row = dict(zip(columns, values))
+            obj = found.get(row['ldap'])
+            for attribute in ldap_attributes:
+                row[attribute] = obj is not None and _ldap_value(obj, attribute) or u''
+            yield row
+
+def _csv_lines(rows, columns):
+    buffer = StringIO.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for count, row in enumerate(rows):
+        values = [row[column] for column in columns]
+        writer.writerow([value is not None and smart_str(value) or ''
+                         for value in values])
+        if count % 100 == 99:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _json_lines(rows):
+    yield '['
+    separator = ''
+    for row in rows:
+        yield separator + simplejson.dumps(row, cls=DjangoJSONEncoder)
+        separator = ',\n'
+    yield ']\n'
+
+def roster_response(rows, columns, format='csv', filename='roster'):
+    """Return a HttpResponse streaming rows as CSV or JSON."""
+    if format == 'csv':
+        response = HttpResponse(_csv_lines(rows, columns), mimetype='text/csv')
+        response['Content-Disposition'] = 'attachment; filename=%s.csv' % filename
+    elif format == 'json':
+        response = HttpResponse(_json_lines(rows), mimetype='application/json')
+    else:
+        raise Http404
+    return response
+
+def offering_roster(request, offering_id, format='csv'):
+    """The roster of a course offering and its sections."""
+    try:
+        offering = CourseOffering.objects.get(pk=offering_id)
+    except CourseOffering.DoesNotExist:
+        raise Http404
+    return roster_response(iter_roster(offering=offering), roster_columns(),
+                           format, 'roster-%s' % offering.pk)
+offering_roster = permission_required('courses.change_coursemembership')(offering_roster)
+
+def section_roster(request, section_id, format='csv'):
+    """The roster of an offering section."""
+    try:
+        section = OfferingSection.objects.get(pk=section_id)
+    except OfferingSection.DoesNotExist:
+        raise Http404
+    return roster_response(iter_roster(section=section), roster_columns(),
+                           format, 'roster-section-%s' % section.pk)
+section_roster = permission_required('courses.change_coursemembership')(section_roster)
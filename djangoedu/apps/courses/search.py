@@ -0,0 +1,176 @@
+"""
+=============
+Course Search
+=============
+
+An inverted index of the course catalog kept in the ``CourseSearchToken``
+table: one row per word of a course with a weight for where the word was
+found. Searching is an indexed lookup (or ``startswith`` for the word
+being typed) on the token column instead of ``LIKE`` scans over the
+course text.
+
+Words are lowercased runs of letters and digits. The weights are::
+
+    number 8, department abbreviation 6, prefix 3, title 4, abstract 1
+
+A course is reindexed when it is saved and the courses of a department
+when the department is saved, see ``courses.models``. Rebuild the whole
+index with ``manage.py rebuildcoursesearch``.
+
+Example use:
+
+    >>> [course.number for course in search_courses('phys quant')]
+    [u'373', u'389K']
+    >>> search_courses('ph', limit=5)  # autocomplete
+    [<Course: PHY 301: Mechanics>, ...]
+"""
+
+import re
+
+from django.db import connection, transaction
+
+from djangoedu.apps.courses.models import Course, CourseSearchToken
+
+WEIGHTS = (('number', 8), ('department', 6), ('prefix', 3), ('title', 4),
+           ('abstract', 1))
+STOP_WORDS = dict.fromkeys(('a', 'an', 'and', 'are', 'as', 'at', 'be', 'by',
+    'for', 'from', 'in', 'is', 'it', 'of', 'on', 'or', 'the', 'this', 'to',
+    'with'))
+MAX_TOKEN_LENGTH = CourseSearchToken._meta.get_field('token').max_length
+
+# letters and digits, no underscores as they are LIKE wildcards
+_words = re.compile(r'[^\W_]+', re.UNICODE)
+
+def tokenize(text, stop_words=True):
+    """Return the lowercased words of text.
+
+        >>> tokenize(u'Intro. to Quantum Mechanics (PHY 373)')
+        [u'intro', u'quantum', u'mechanics', u'phy', u'373']
+    """
+    words = []
+    for word in _words.findall(text.lower()):
+        if stop_words and word in STOP_WORDS:
+            continue
+        words.append(word[:MAX_TOKEN_LENGTH])
+    return words
+
+def course_tokens(course):
+    """Return a dictionary of the tokens of course to their weights."""
+    department = getattr(course.department, 'abbr', u'') or u''
+    texts = {'number': course.number, 'department': department,
+             'prefix': course.prefix, 'title': course.title,
+             'abstract': course.abstract}
+    tokens = {}
+    for name, weight in WEIGHTS:
+        for token in tokenize(texts[name] or u''):
+            tokens[token] = tokens.get(token, 0) + weight
+    # the number as typed, '301L' as well as '301' and 'l'
+    number = u''.join(tokenize(course.number, stop_words=False))[:MAX_TOKEN_LENGTH]
+    if number and number not in tokens:
+        tokens[number] = WEIGHTS[0][1]
+    return tokens
+
+def _insert_sql():
+    qn = connection.ops.quote_name
+    opts = CourseSearchToken._meta
+    return 'INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % (
+        qn(opts.db_table), qn(opts.get_field('course').column),
+        qn(opts.get_field('token').column), qn(opts.get_field('weight').column))
+
+def _write_tokens(courses):
+    rows = []
+    for course in courses:
+        for token, weight in course_tokens(course).items():
+            rows.append((course.pk, token, weight))
+    if rows:
+        connection.cursor().executemany(_insert_sql(), rows)
+        # commits outside transaction management, marks the transaction
+        # dirty for commit_on_success inside it
+        transaction.commit_unless_managed()
+    return len(rows)
+
+def index_course(course):
+    """Replace the tokens of course."""
+    unindex_course(course)
+    _write_tokens([course])
+
+def unindex_course(course):
+    CourseSearchToken.objects.filter(course=course).delete()
+
+def index_department(department):
+    """Reindex every course of department, after its abbreviation changed."""
+    courses = list(Course.objects.filter(department=department).select_related())
+    CourseSearchToken.objects.filter(course__department=department).delete()
+    _write_tokens(courses)
+
+def rebuild_index(batch_size=500):
+    """Rebuild the whole index in one transaction, returns the counts of
+    ``courses`` and ``tokens``."""
+    def rebuild():
+        CourseSearchToken.objects.all().delete()
+        stats = {'courses': 0, 'tokens': 0}
+        pks = list(Course.objects.values_list('pk', flat=True).order_by('pk'))
+        for start in range(0, len(pks), batch_size):
+            courses = Course.objects.filter(
+                pk__in=pks[start:start + batch_size]).select_related()
+            courses = list(courses)
+            stats['courses'] += len(courses)
+            stats['tokens'] += _write_tokens(courses)
+        return stats
+    return transaction.commit_on_success(rebuild)()
+
+def _search_sql(words, prefix, limit):
+    """Return the SQL and parameters ranking the courses matching words.
+
+    Every word is a subquery giving the best weight of each course it
+    matches, a course matching all of them has one row per word.
+    """
+    qn = connection.ops.quote_name
+    opts = CourseSearchToken._meta
+    table = qn(opts.db_table)
+    course = qn(opts.get_field('course').column)
+    token = qn(opts.get_field('token').column)
+    weight = qn(opts.get_field('weight').column)
+    matches, params = [], []
+    for position, word in enumerate(words):
+        if prefix and position == len(words) - 1:
+            matches.append('SELECT %s AS course, MAX(CASE WHEN %s = %%s THEN %s '
+                'ELSE %s / 2.0 END) AS score FROM %s WHERE %s %s GROUP BY %s' % (
+                course, token, weight, weight, table, token,
+                connection.operators['startswith'], course))
+            params.extend([word, word + '%'])
+        else:
+            matches.append('SELECT %s AS course, MAX(%s) AS score FROM %s '
+                'WHERE %s = %%s GROUP BY %s' % (course, weight, table, token, course))
+            params.append(word)
+    course_opts = Course._meta
+    department = qn(course_opts.get_field('department').column)
+    number = qn(course_opts.get_field('number').column)
+    sql = ('SELECT m.course FROM (%s) m INNER JOIN %s c ON c.%s = m.course '
+           'GROUP BY m.course, c.%s, c.%s HAVING COUNT(*) = %%s '
+           'ORDER BY SUM(m.score) DESC, c.%s, c.%s' % (
+           ' UNION ALL '.join(matches), qn(course_opts.db_table),
+           qn(course_opts.pk.column), department, number, department, number))
+    if limit is not None:
+        sql += ' ' + connection.ops.limit_offset_sql(limit)
+    params.append(len(words))
+    return sql, params
+
+def search_courses(query, limit=20, prefix=True):
+    """Return the courses matching every word of query, best first.
+
+    With ``prefix`` the last word also matches the words it starts, for
+    autocompletion. Courses are ranked by the summed weights of the
+    matched words, a whole word match counting twice a prefix match, and
+    then by department and number. The ranking and the limit are applied
+    by the database, only the courses returned are loaded. A ``limit`` of
+    None returns every match.
+    """
+    words = tokenize(query)
+    if not words:
+        return []
+    cursor = connection.cursor()
+    cursor.execute(*_search_sql(words, prefix, limit))
+    pks = [row[0] for row in cursor.fetchall()]
+    courses = Course.objects.in_bulk(pks)
+    return [courses[pk] for pk in pks if pk in courses]
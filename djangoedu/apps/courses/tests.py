@@ -1,6 +1,25 @@
+import csv
+import datetime
+import StringIO
+
 from django.test import TestCase
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404
+from django.utils import simplejson
+from django.contrib.auth.models import User
+
+from djangoedu.core.models import eduPerson, Organization, Semester
+from djangoedu.ldap.fake import FakeDirectory
+from djangoedu.apps.courses.models import Course, CourseOffering, SectionType, \
+    OfferingSection, RoleType, CourseMembership
+from djangoedu.apps.courses.search import search_courses, rebuild_index
+from djangoedu.apps.courses.crosslist import refresh_groups, rebuild_groups
+from djangoedu.apps.courses.enrollment import import_enrollment
+from djangoedu.apps.courses import texts, rosters
 
 class CoursesTest(TestCase):
     """Course Tests"""
@@ -12,4 +31,352 @@ class CoursesTest(TestCase):
          
         
     def testSomething(self):
-        """"""
\ No newline at end of file
+        """"""
+
+def discard_uncommitted():
+    """Roll back whatever the code under test left uncommitted."""
+    connection._rollback()
+
+def install_directory(uids):
+    """Point eduPerson.ldap at a FakeDirectory holding people of uids."""
+    field = eduPerson._meta.get_field('ldap')
+    directory = FakeDirectory()
+    for uid in uids:
+        directory.add('uid=%s,%s' % (uid, field.base or 'dc=state,dc=edu'),
+                      {'uid': [uid], 'givenName': [uid.title()], 'sn': ['Person'],
+                       'mail': ['%s@state.edu' % uid], 'ou': ['Physics']})
+    for host, port in field.servers:
+        directory.install(host, port, field.username, field.password, field.is_secure)
+    return directory
+
+class SearchTest(TestCase):
+    """Course search index"""
+    
+    def setUp(self):
+        self.physics = Organization.objects.create(name='Physics', abbr='PHY')
+        self.course = Course.objects.create(department=self.physics, number='309',
+            title='Introduction to Cosmology')
+    
+    def testIndexCommitted(self):
+        """Tokens written when a course is saved are committed."""
+        discard_uncommitted()
+        self.assertEqual(search_courses('cosmo'), [self.course])
+        self.assertEqual(search_courses('phy 309', prefix=False), [self.course])
+        self.assertEqual(search_courses('chemistry'), [])
+    
+    def testRebuildCommitted(self):
+        rebuild_index()
+        discard_uncommitted()
+        self.assertEqual(search_courses('introduction'), [self.course])
+    
+    def testLimit(self):
+        other = Course.objects.create(department=self.physics, number='310',
+            title='Introduction to Stars')
+        self.assertEqual(search_courses('introduction', limit=1), [self.course])
+        self.assertEqual(search_courses('introduction', limit=None), [self.course, other])
+
+class CrossListTest(TestCase):
+    """Cross list groups"""
+    
+    def setUp(self):
+        physics = Organization.objects.create(name='Physics', abbr='PHY')
+        astronomy = Organization.objects.create(name='Astronomy', abbr='AST')
+        self.phy = Course.objects.create(department=physics, number='309', title='Stars')
+        self.ast = Course.objects.create(department=astronomy, number='309', title='Stars')
+        self.other = Course.objects.create(department=physics, number='101', title='Mechanics')
+    
+    def groups(self):
+        return dict(Course.objects.values_list('pk', 'cross_list_group'))
+    
+    def testRefreshCommitted(self):
+        self.phy.cross_list.add(self.ast)
+        refresh_groups(Course, [self.phy.pk])
+        discard_uncommitted()
+        groups = self.groups()
+        self.assertEqual(groups[self.ast.pk], self.phy.pk)
+        self.assertEqual(groups[self.other.pk], self.other.pk)
+    
+    def testLinksChangedDirectly(self):
+        """Groups follow links changed without link() and unlink()."""
+        self.phy.cross_list.add(self.ast)
+        self.assertEqual(list(self.phy.get_cross_listed().order_by('pk')),
+                         [self.phy, self.ast])
+        self.ast.cross_list.remove(self.phy)
+        self.assertEqual(list(self.ast.get_cross_listed()), [self.ast])
+        self.assertEqual(list(self.phy.get_cross_listed()), [self.phy])
+    
+    def testRebuildCommitted(self):
+        self.phy.cross_list.add(self.ast)
+        Course.objects.update(cross_list_group=None)
+        stats = rebuild_groups(Course)
+        discard_uncommitted()
+        self.assertEqual(stats['updated'], 3)
+        self.assertEqual(stats['groups'], 1)
+        self.assertEqual(self.groups(), {self.phy.pk: self.phy.pk,
+            self.ast.pk: self.phy.pk, self.other.pk: self.other.pk})
+
+class MembershipTest(TestCase):
+    """Memberships"""
+    
+    def setUp(self):
+        install_directory(['alice', 'bob', 'carol'])
+        self.people = {}
+        for uid in ('alice', 'bob', 'carol'):
+            user = User.objects.create(username=uid)
+            self.people[uid] = eduPerson.objects.create(user=user, ldap=uid)
+        physics = Organization.objects.create(name='Physics', abbr='PHY')
+        course = Course.objects.create(department=physics, number='309', title='Stars')
+        Semester.objects.create(year=2008, semester=2, sdate=datetime.date(2008, 1, 14),
+                                edate=datetime.date(2008, 5, 14))
+        self.semester = Semester.objects.get(year=2008, semester=2)
+        self.offering = CourseOffering.objects.create(course=course, timeFrame=self.semester)
+        lecture = SectionType.objects.create(name='Lecture')
+        self.first = OfferingSection.objects.create(offering=self.offering,
+            unique_number=12345, type=lecture)
+        self.second = OfferingSection.objects.create(offering=self.offering,
+            unique_number=12350, type=lecture)
+        self.learner = RoleType.objects.create(name='Learner')
+        self.instructor = RoleType.objects.create(name='Instructor')
+    
+    def member(self, uid, section, status=True, role=None):
+        return CourseMembership.objects.create(offering=self.offering, section=section,
+            person=self.people[uid], roleType=role or self.learner, status=status)
+    
+    def memberships(self):
+        return dict([((person, section), status) for person, section, status in
+            CourseMembership.objects.values_list('person__ldap', 'section__unique_number',
+                                                 'status')])
+    
+    def testDateStamping(self):
+        """The date changes with the status only."""
+        membership = self.member('alice', self.first)
+        self.failIf(membership.date is None)
+        old = datetime.datetime(2008, 1, 1)
+        CourseMembership.objects.filter(pk=membership.pk).update(date=old)
+        membership = CourseMembership.objects.get(pk=membership.pk)
+        membership.save()
+        self.assertEqual(CourseMembership.objects.get(pk=membership.pk).date, old)
+        membership.status = False
+        membership.save()
+        self.failUnless(CourseMembership.objects.get(pk=membership.pk).date > old)
+    
+    def testImportDiff(self):
+        self.member('alice', self.first)
+        self.member('alice', self.first) # duplicate
+        self.member('bob', self.first)
+        self.member('carol', self.first, status=False)
+        self.member('alice', self.second)
+        self.member('carol', self.second, role=self.instructor)
+        records = [
+            ('alice', 12345, 'Learner', True),
+            ('bob', 12345, 'Learner', False),
+            ('carol', '12345', 'Learner', True),
+            ('bob', 12350, 'Learner', True),
+            ('nobody', 12345, 'Learner', True),
+            ('alice', 99999, 'Learner', True),
+            ('alice', 12345, 'Grader', True),
+        ]
+        stats = import_enrollment(records, self.semester, delete_missing=True,
+                                  batch_size=2)
+        discard_uncommitted()
+        self.assertEqual(stats['records'], 7)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['activated'], 1)
+        self.assertEqual(stats['deactivated'], 1)
+        self.assertEqual(stats['deleted'], 2)
+        self.assertEqual(stats['unchanged'], 1)
+        self.assertEqual(stats['unknown_people'], 1)
+        self.assertEqual(stats['unknown_sections'], 1)
+        self.assertEqual(stats['unknown_roles'], 1)
+        self.assertEqual(self.memberships(), {(u'alice', 12345): True,
+            (u'bob', 12345): False, (u'carol', 12345): True, (u'bob', 12350): True,
+            (u'carol', 12350): True})
+        self.assertEqual(CourseMembership.objects.count(), 5)
+        
+        stats = import_enrollment(records, self.semester, delete_missing=True)
+        self.assertEqual(stats['unchanged'], 4)
+        self.assertEqual(stats['created'] + stats['deleted'], 0)
+    
+    def testImportKeepMissing(self):
+        self.member('alice', self.second)
+        stats = import_enrollment([('bob', 12345, 'Learner', True)], self.semester)
+        discard_uncommitted()
+        self.assertEqual((stats['created'], stats['deleted']), (1, 0))
+        self.assertEqual(self.memberships(), {(u'alice', 12350): True,
+                                              (u'bob', 12345): True})
+
+class TextsTest(TestCase):
+    """Effective abstracts and prerequisites"""
+    
+    def setUp(self):
+        self.cache = texts.cache
+        texts.cache = get_cache('locmem:///')
+        physics = Organization.objects.create(name='Physics', abbr='PHY')
+        self.topics = Course.objects.create(department=physics, number='379',
+            title='Topics', abstract='Selected topics.',
+            prerequisite='Upper division standing.')
+        self.cosmology = Course.objects.create(department=physics, number='379C',
+            title='Cosmology', parent=self.topics, abstract='Cosmology.')
+        self.galaxies = Course.objects.create(department=physics, number='379G',
+            title='Galaxies', parent=self.cosmology, abstract='Galaxies.',
+            prerequisite='PHY 309.')
+        self.stars = Course.objects.create(department=physics, number='379S',
+            title='Stars', parent=self.topics, abstract='Stars.')
+        self.mechanics = Course.objects.create(department=physics, number='101',
+            title='Mechanics', abstract='Forces.')
+        # the primary keys of every query for ancestors
+        self.loaded = []
+        self.rows = texts._rows
+        def rows(pks):
+            if pks:
+                self.loaded.append(sorted(pks))
+            return self.rows(pks)
+        texts._rows = rows
+    
+    def tearDown(self):
+        texts.cache = self.cache
+        texts._rows = self.rows
+    
+    def resolve(self, *courses):
+        return texts.resolve_texts(Course.objects.filter(
+            pk__in=[course.pk for course in courses]).order_by('number'))
+    
+    def testBatched(self):
+        """Ancestors are loaded one level per query, each only once."""
+        mechanics, galaxies, stars = self.resolve(self.galaxies, self.stars, self.mechanics)
+        self.assertEqual(self.loaded, [sorted([self.topics.pk, self.cosmology.pk])])
+        self.assertEqual(galaxies.effective_abstract(),
+                         u'Selected topics.\n\nCosmology.\n\nGalaxies.')
+        self.assertEqual(galaxies.effective_prerequisite(),
+                         u'Upper division standing.\n\nPHY 309.')
+        self.assertEqual(stars.effective_abstract(), u'Selected topics.\n\nStars.')
+        self.assertEqual(mechanics.effective_abstract(), u'Forces.')
+        self.assertEqual(mechanics.effective_prerequisite(), u'')
+        
+        self.loaded = []
+        galaxies = Course.objects.get(pk=self.galaxies.pk)
+        self.assertEqual(galaxies.effective_abstract(),
+                         u'Selected topics.\n\nCosmology.\n\nGalaxies.')
+        self.assertEqual(self.loaded, [])
+    
+    def testLevels(self):
+        self.resolve(self.galaxies)
+        self.assertEqual(self.loaded, [[self.cosmology.pk], [self.topics.pk]])
+    
+    def testStopsAtCached(self):
+        """The walk up stops at ancestors whose texts are cached."""
+        self.resolve(self.cosmology)
+        self.loaded = []
+        galaxies, = self.resolve(self.galaxies)
+        self.assertEqual(self.loaded, [])
+        self.assertEqual(galaxies.effective_abstract(),
+                         u'Selected topics.\n\nCosmology.\n\nGalaxies.')
+    
+    def testInvalidatedWithDescendants(self):
+        self.resolve(self.galaxies, self.stars, self.mechanics)
+        self.topics.abstract = 'Introductory topics.'
+        self.topics.save()
+        for course in (self.topics, self.cosmology, self.galaxies, self.stars):
+            self.assertEqual(texts.cache.get(texts._key(course.pk)), None)
+        self.failIf(texts.cache.get(texts._key(self.mechanics.pk)) is None)
+        galaxies = Course.objects.get(pk=self.galaxies.pk)
+        self.assertEqual(galaxies.effective_abstract(),
+                         u'Introductory topics.\n\nCosmology.\n\nGalaxies.')
+        self.assertEqual(Course.objects.get(pk=self.stars.pk).effective_abstract(),
+                         u'Introductory topics.\n\nStars.')
+
+class RosterTest(TestCase):
+    """Streamed rosters"""
+    
+    # uid, last name, in the first section rather than the offering
+    people = [('alice', 'Smith', False), ('bob', 'Jones', True),
+              ('carol', 'Smith', True), ('dave', 'Smith', False),
+              ('erin', 'Adams', False)]
+    
+    def setUp(self):
+        install_directory([uid for uid, last_name, in_section in self.people])
+        physics = Organization.objects.create(name='Physics', abbr='PHY')
+        course = Course.objects.create(department=physics, number='309', title='Stars')
+        Semester.objects.create(year=2008, semester=2, sdate=datetime.date(2008, 1, 14),
+                                edate=datetime.date(2008, 5, 14))
+        semester = Semester.objects.get(year=2008, semester=2)
+        self.offering = CourseOffering.objects.create(course=course, timeFrame=semester)
+        self.section = OfferingSection.objects.create(offering=self.offering,
+            unique_number=12345, type=SectionType.objects.create(name='Lecture'))
+        learner = RoleType.objects.create(name='Learner')
+        for uid, last_name, in_section in self.people:
+            user = User.objects.create(username=uid)
+            person = eduPerson.objects.create(user=user, ldap=uid)
+            User.objects.filter(pk=user.pk).update(last_name=last_name)
+            if in_section:
+                CourseMembership.objects.create(section=self.section, person=person,
+                                                roleType=learner)
+            else:
+                CourseMembership.objects.create(offering=self.offering, person=person,
+                                                roleType=learner)
+        CourseMembership.objects.filter(person__ldap='dave').update(status=False)
+    
+    def usernames(self, rows):
+        return [row['username'] for row in rows]
+    
+    def testKeysetPaging(self):
+        """Chunks continue after the last row when last names repeat across
+        the chunk boundary."""
+        members = rosters.roster_queryset(offering=self.offering, include_inactive=True)
+        for size, lengths in ((1, [1, 1, 1, 1, 1]), (2, [2, 2, 1]), (3, [3, 2]), (5, [5])):
+            chunks = list(rosters._chunks(members, size))
+            self.assertEqual([len(chunk) for chunk in chunks], lengths)
+            self.assertEqual([values[2] for chunk in chunks for values in chunk],
+                             ['erin', 'bob', 'alice', 'carol', 'dave'])
+    
+    def testRoster(self):
+        rows = list(rosters.iter_roster(offering=self.offering, chunk_size=2))
+        self.assertEqual(self.usernames(rows), ['erin', 'bob', 'alice', 'carol'])
+        self.assertEqual(rows[1]['section'], 12345)
+        self.assertEqual(rows[1]['role'], u'Learner')
+        self.assertEqual([row['ou'] for row in rows], [u'Physics'] * 4)
+        rows = rosters.iter_roster(offering=self.offering, include_inactive=True)
+        self.assertEqual(self.usernames(rows), ['erin', 'bob', 'alice', 'carol', 'dave'])
+        rows = rosters.iter_roster(section=self.section)
+        self.assertEqual(self.usernames(rows), ['bob', 'carol'])
+    
+    def testArguments(self):
+        self.assertRaises(ValueError, rosters.roster_queryset)
+        self.assertRaises(ValueError, rosters.roster_queryset, self.offering, self.section)
+        self.assertRaises(ValueError, list, rosters.iter_roster(offering=self.offering,
+                          ldap_attributes=('telephoneNumber',)))
+        rows = list(rosters.iter_roster(offering=self.offering, ldap_attributes=()))
+        self.failIf('ou' in rows[0])
+    
+    def testUnstoredSetting(self):
+        """Columns eduPerson.ldap doesn't store are refused on import."""
+        old = getattr(settings, 'ROSTER_LDAP_ATTRIBUTES', ('ou',))
+        settings.ROSTER_LDAP_ATTRIBUTES = ('ou', 'telephoneNumber')
+        try:
+            self.assertRaises(ImproperlyConfigured, reload, rosters)
+        finally:
+            settings.ROSTER_LDAP_ATTRIBUTES = old
+            reload(rosters)
+    
+    def testCSV(self):
+        columns = rosters.roster_columns()
+        response = rosters.roster_response(rosters.iter_roster(offering=self.offering),
+                                           columns, 'csv', 'roster-1')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename=roster-1.csv')
+        lines = list(csv.reader(StringIO.StringIO(response.content)))
+        self.assertEqual(lines[0], columns)
+        rows = [dict(zip(columns, line)) for line in lines[1:]]
+        self.assertEqual(self.usernames(rows), ['erin', 'bob', 'alice', 'carol'])
+        self.assertEqual([row['section'] for row in rows], ['', '12345', '', '12345'])
+        self.assertEqual(rows[0]['email'], 'erin@state.edu')
+    
+    def testJSON(self):
+        response = rosters.roster_response(rosters.iter_roster(section=self.section),
+                                           rosters.roster_columns(), 'json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        rows = simplejson.loads(response.content)
+        self.assertEqual(self.usernames(rows), ['bob', 'carol'])
+        self.assertEqual(rows[0]['ou'], 'Physics')
+        self.assertEqual(rows[0]['status'], True)
+        self.assertRaises(Http404, rosters.roster_response, [], [], 'xml')
@@ -0,0 +1,118 @@
+"""
+============
+Course Texts
+============
+
+The abstract and prerequisite of a course with a parent are appended to
+those of the parent, and so on up the chain. ``resolve_texts`` composes
+them for a whole list of courses at once: the composed texts are kept in
+the cache per course, and the ancestors of the courses missing from it are
+loaded one level per query, stopping at ancestors that are cached. A save
+or delete of a course drops the cached texts of it and its descendants.
+
+The following setting is used::
+
+    COURSE_TEXT_CACHE_TIMEOUT = (default 86400 seconds)
+
+Example use:
+
+    >>> courses = resolve_texts(Course.objects.filter(department=physics))
+    >>> courses[0].effective_abstract()
+    u'Selected topics in physics.\\n\\nThis semester: Cosmology.'
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+
+from djangoedu.apps.courses.models import Course
+
+CACHE_TIMEOUT = getattr(settings, 'COURSE_TEXT_CACHE_TIMEOUT', 60 * 60 * 24)
+SEPARATOR = u'\n\n'
+
+# number of primary keys per IN clause
+CHUNK_SIZE = 500
+
+def _key(pk):
+    return 'djangoedu.courses.text.%s' % pk
+
+def _join(parent, child):
+    return SEPARATOR.join([text for text in (parent, child) if text])
+
+def _cached(pks):
+    """Return the cached (abstract, prerequisite) of pks."""
+    if not pks:
+        return {}
+    found = cache.get_many([_key(pk) for pk in pks])
+    texts = {}
+    for pk in pks:
+        value = found.get(_key(pk))
+        if value is not None:
+            texts[pk] = value
+    return texts
+
+def _rows(pks):
+    """Return (parent, abstract, prerequisite) of the courses of pks."""
+    rows = {}
+    for start in range(0, len(pks), CHUNK_SIZE):
+        for pk, parent, abstract, prerequisite in Course.objects.filter(
+                pk__in=pks[start:start + CHUNK_SIZE]).values_list(
+                'pk', 'parent', 'abstract', 'prerequisite'):
+            rows[pk] = (parent, abstract, prerequisite)
+    return rows
+
+def resolve_texts(courses):
+    """Set the effective abstract and prerequisite of every course.
+
+    Returns the courses as a list, their ``effective_abstract()`` and
+    ``effective_prerequisite()`` then need no further queries.
+    """
+    courses = list(courses)
+    pks = dict.fromkeys([course.pk for course in courses]).keys()
+    texts = _cached(pks)
+    rows = {}
+    for course in courses:
+        if course.pk not in texts:
+            rows[course.pk] = (course.parent_id, course.abstract, course.prerequisite)
+    # walk up from the courses missing from the cache
+    wanted = [parent for parent, abstract, prerequisite in rows.values()
+              if parent is not None]
+    while wanted:
+        wanted = [pk for pk in dict.fromkeys(wanted).keys()
+                  if pk not in texts and pk not in rows]
+        cached = _cached(wanted)
+        texts.update(cached)
+        loaded = _rows([pk for pk in wanted if pk not in cached])
+        rows.update(loaded)
+        wanted = [parent for parent, abstract, prerequisite in loaded.values()
+                  if parent is not None]
+    # compose from the top down
+    for pk in rows.keys():
+        chain = []
+        while pk not in texts and pk in rows and pk not in chain:
+            chain.append(pk)
+            pk = rows[pk][0]
+        parent = texts.get(pk, (u'', u''))
+        chain.reverse()
+        for pk in chain:
+            abstract, prerequisite = rows[pk][1:]
+            parent = (_join(parent[0], abstract), _join(parent[1], prerequisite))
+            texts[pk] = parent
+            cache.set(_key(pk), parent, CACHE_TIMEOUT)
+    for course in courses:
+        course._effective_texts = texts[course.pk]
+    return courses
+
+def invalidate_texts(course):
+    """Drop the cached texts of course and its descendants."""
+    course.__dict__.pop('_effective_texts', None)
+    level = [course.pk]
+    seen = {}
+    while level:
+        for pk in level:
+            seen[pk] = True
+            cache.delete(_key(pk))
+        children = []
+        for start in range(0, len(level), CHUNK_SIZE):
+            children.extend(Course.objects.filter(
+                parent__in=level[start:start + CHUNK_SIZE]).values_list('pk', flat=True))
+        level = [pk for pk in children if pk not in seen]
@@ -0,0 +1,138 @@
+"""
+==============
+LDAP User Sync
+==============
+
+Refreshes the names and email addresses of the django.contrib.auth Users
+of all active eduPersons from LDAP.
+
+Only entries whose ``modifyTimestamp`` is newer than the last run are
+fetched, using a paged search, and only User rows that actually differ are
+written, in batches of one transaction each. The first run, or a run with
+``full=True``, looks every active eduPerson up.
+
+The start of the last run is kept in a ``SyncState`` row, so it survives
+restarts and cache purges. The following setting is used::
+
+    LDAP_SYNC_OVERLAP = (default 300 seconds, subtracted from the last run
+                         to allow for clock skew with the directory)
+"""
+
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.contrib.auth.models import User
+
+from djangoedu.core.models import eduPerson, SyncState, user_fields_from_ldap
+from djangoedu.ldap.fields import LDAPObject
+
+LAST_RUN = 'djangoedu.core.ldapsync.last_run'
+SYNC_OVERLAP = getattr(settings, 'LDAP_SYNC_OVERLAP', 300)
+
+def ldap_timestamp(seconds):
+    """Format seconds since the epoch as a LDAP GeneralizedTime string."""
+    return time.strftime('%Y%m%d%H%M%SZ', time.gmtime(seconds))
+
+def last_run():
+    """Return the GeneralizedTime the next incremental run starts at, or
+    None before the first run."""
+    values = SyncState.objects.filter(name=LAST_RUN).values_list('value', flat=True)
+    if values and values[0]:
+        return values[0]
+    return None
+
+def _set_last_run(value):
+    state, created = SyncState.objects.get_or_create(name=LAST_RUN)
+    state.value = value
+    state.save()
+
+def changed_entries(field, values, since, page_size=500):
+    """Yield a LDAPObject for each of ``values`` modified since ``since``.
+
+    ``since`` is a GeneralizedTime string. The directory is scanned with
+    a single paged search, entries not in ``values`` are skipped.
+    """
+    filter = '(&(%s=*)(modifyTimestamp>=%s))' % (field.filter_attr, since)
+    wanted = dict([(value.lower(), value) for value in values])
+    for item in field.get_pool().iter_search(field.base, filter,
+            returnAttributes=field.get_search_attributes(), page_size=page_size):
+        for attr_value in item[field.filter_attr]:
+            value = wanted.get(attr_value.lower())
+            if value is not None:
+                yield LDAPObject(item, value, field.attributes)
+                break
+
+def _apply_changes(changes):
+    for user_id, fields in changes:
+        User.objects.filter(pk=user_id).update(**fields)
+_apply_changes = transaction.commit_on_success(_apply_changes)
+
+def _sync_batch(field, people, objects, stats):
+    """Diff a batch of LDAPObjects against their Users and save changes."""
+    user_ids = [people[obj._orig_value] for obj in objects]
+    current = {}
+    for row in User.objects.filter(pk__in=user_ids).values(
+            'id', 'first_name', 'last_name', 'email'):
+        current[row['id']] = row
+    changes = []
+    for obj in objects:
+        user_id = people[obj._orig_value]
+        row = current.get(user_id)
+        if row is None:
+            continue
+        fields = {}
+        for name, value in user_fields_from_ldap(obj).items():
+            if row[name] != value:
+                fields[name] = value
+        if fields:
+            changes.append((user_id, fields))
+    if changes:
+        _apply_changes(changes)
+    # the objects are fresh, save the next page view a lookup
+    field.cache_objects(objects)
+    stats['checked'] += len(objects)
+    stats['updated'] += len(changes)
+
+def sync_users(since=None, full=False, batch_size=500):
+    """Update the Users of active eduPersons from LDAP.
+
+    Options:
+
+    * ``since``: (Optional) GeneralizedTime string, only entries modified
+      after it are synced. Defaults to the start of the last run.
+    * ``full``: Sync every active eduPerson regardless of ``since``.
+    * ``batch_size``: Number of people diffed and saved per transaction.
+
+    Returns a dictionary with the counts of ``people``, ``checked``,
+    ``updated`` and ``missing`` (not found in LDAP) as well as ``since``
+    and ``seconds``.
+    """
+    started = time.time()
+    field = eduPerson._meta.get_field('ldap')
+    people = dict(eduPerson.objects.filter(active=True).values_list('ldap', 'user'))
+    if full:
+        since = None
+    elif since is None:
+        since = last_run()
+    stats = {'people': len(people), 'checked': 0, 'updated': 0, 'missing': 0,
+             'since': since}
+    if since is None:
+        values = people.keys()
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            found = field.fetch(batch)
+            stats['missing'] += len(batch) - len(found)
+            _sync_batch(field, people, found.values(), stats)
+    else:
+        batch = []
+        for obj in changed_entries(field, people.keys(), since):
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                _sync_batch(field, people, batch, stats)
+                batch = []
+        if batch:
+            _sync_batch(field, people, batch, stats)
+    _set_last_run(ldap_timestamp(started - SYNC_OVERLAP))
+    stats['seconds'] = time.time() - started
+    return stats
@@ -0,0 +1,114 @@
+"""
+=================
+LDAP Cache Warmer
+=================
+
+Looks the LDAP entries of many eduPersons up ahead of time, for example
+before the first week of a semester, so the first page views find them in
+the shared cache.
+
+The values are split into batches that are resolved in parallel by a pool
+of processes, each batch with the bulk searches of
+``LdapObjectField.prefetch`` (or ``fetch`` to search again even for cached
+entries). Batches are handed out no faster than ``rate`` people per second
+so the directory is not flooded. Without the multiprocessing module
+(before Python 2.6) the batches are resolved in this process.
+"""
+
+import time
+
+from django.db import models, connection
+from django.core.cache import cache
+
+from djangoedu.core.models import eduPerson
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+def people_to_warm(semester=None):
+    """Return the ``ldap`` values of the active eduPersons.
+
+    With a semester only the people with an active membership in one of its
+    offerings, or their sections, are returned.
+    """
+    people = eduPerson.objects.filter(active=True)
+    if semester is not None:
+        CourseMembership = models.get_model('courses', 'CourseMembership')
+        if CourseMembership is None:
+            raise ValueError("The courses application is not installed.")
+        members = CourseMembership.objects.filter(status=True,
+            person__active=True).filter(models.Q(offering__timeFrame=semester) |
+            models.Q(section__offering__timeFrame=semester))
+        people = people.filter(pk__in=members.values_list('person', flat=True))
+    return list(people.values_list('ldap', flat=True).distinct())
+
+def _batches(values, batch_size, rate, force):
+    """Yield (batch, force) pairs, no faster than rate values per second."""
+    start = time.time()
+    sent = 0
+    for index in range(0, len(values), batch_size):
+        batch = values[index:index + batch_size]
+        if rate:
+            wait = start + float(sent) / rate - time.time()
+            if wait > 0:
+                time.sleep(wait)
+        sent += len(batch)
+        yield batch, force
+
+def warm_batch(args):
+    """Resolve a batch of values, returns (values, found)."""
+    values, force = args
+    field = eduPerson._meta.get_field('ldap')
+    if force:
+        found = field.fetch(values)
+    else:
+        found = field.prefetch(values)
+    return len(values), len(found)
+
+def warm_cache(values, processes=4, batch_size=200, rate=0, force=False,
+               progress=None):
+    """Put the LDAP entries of values into the cache.
+
+    Options:
+
+    * ``processes``: Number of worker processes, 1 resolves every batch in
+      this process.
+    * ``batch_size``: Number of values resolved per batch.
+    * ``rate``: (Optional) Maximum number of values handed out per second.
+    * ``force``: Search the directory even for values already cached.
+    * ``progress``: (Optional) Called with the stats after every batch.
+
+    Returns a dictionary with the counts of ``people``, ``done`` and
+    ``found`` as well as ``seconds`` and ``rate``, the people done per
+    second.
+    """
+    started = time.time()
+    stats = {'people': len(values), 'done': 0, 'found': 0, 'seconds': 0.0,
+             'rate': 0.0}
+    batches = _batches(values, batch_size, rate, force)
+    pool = None
+    if multiprocessing is not None and processes > 1:
+        # don't let the workers share the sockets of this process
+        connection.close()
+        disconnect = getattr(getattr(cache, '_cache', None), 'disconnect_all', None)
+        if disconnect is not None:
+            disconnect()
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(warm_batch, batches)
+    else:
+        results = (warm_batch(batch) for batch in batches)
+    try:
+        for done, found in results:
+            stats['done'] += done
+            stats['found'] += found
+            stats['seconds'] = time.time() - started
+            stats['rate'] = stats['done'] / max(stats['seconds'], 1e-9)
+            if progress is not None:
+                progress(stats)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return stats
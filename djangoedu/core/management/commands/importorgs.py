@@ -0,0 +1,38 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild', default=False,
+            help='Renumber the organizations already in the database instead of importing.'),
+    )
+    help = ("Bulk loads Organizations from a CSV file with the columns key, parent key, "
+            "name, abbreviation and web site (an empty parent key makes a root).")
+    args = '[file.csv]'
+
+    def handle(self, *args, **options):
+        from djangoedu.core.orgimport import import_organizations, rebuild_organizations
+        if options.get('rebuild'):
+            if args:
+                raise CommandError('--rebuild takes no file.')
+            stats = rebuild_organizations()
+            print "Renumbered %d of %d organizations in %.1f seconds" % (
+                stats['renumbered'], stats['organizations'], stats['seconds'])
+            return
+        if len(args) != 1:
+            raise CommandError('Enter the CSV file to import.')
+        records = []
+        for line, row in enumerate(csv.reader(open(args[0], 'rb'))):
+            row = [value.decode('utf-8').strip() for value in row]
+            if len(row) < 3:
+                raise CommandError('Line %d: expected at least key, parent and name.' % (line + 1))
+            row = (row + [u'', u''])[:5]
+            records.append(tuple(row))
+        try:
+            stats = import_organizations(records)
+        except ValueError, e:
+            raise CommandError(str(e))
+        print "Imported %d organizations (%d existing renumbered) in %.1f seconds" % (
+            stats['created'], stats['renumbered'], stats['seconds'])
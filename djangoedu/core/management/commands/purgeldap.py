@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = "Purges cached LDAP objects for the given values (e.g. uids)."
+    args = '<value value ...>'
+
+    def handle(self, *values, **options):
+        from djangoedu.ldap.fields import invalidate
+        if not values:
+            raise CommandError('Enter at least one value to purge.')
+        for value in values:
+            invalidate(value)
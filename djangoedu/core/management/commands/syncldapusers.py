@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Sync every active eduPerson, not only recently modified ones.'),
+        make_option('--since', dest='since', default=None,
+            help='Only sync entries modified after this GeneralizedTime (e.g. 20080901000000Z).'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of people saved per transaction.'),
+    )
+    help = "Updates the names and emails of active eduPersons' Users from LDAP."
+
+    def handle(self, *args, **options):
+        from djangoedu.core.ldapsync import sync_users
+        stats = sync_users(since=options.get('since'), full=options.get('full'),
+                           batch_size=options.get('batch_size'))
+        print "Synced since %s: %d people, %d checked, %d updated, %d missing in %.1f seconds" % (
+            stats['since'] or 'the beginning', stats['people'], stats['checked'],
+            stats['updated'], stats['missing'], stats['seconds'])
@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--semester', action='store_true', dest='semester', default=False,
+            help='Only warm people with a membership in the current semester.'),
+        make_option('--processes', dest='processes', type='int', default=4,
+            help='Number of worker processes.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=200,
+            help='Number of people resolved per batch.'),
+        make_option('--rate', dest='rate', type='float', default=0,
+            help='Maximum number of people sent to the directory per second (0 is no limit).'),
+        make_option('--force', action='store_true', dest='force', default=False,
+            help='Search the directory even for people already cached.'),
+    )
+    help = "Puts the LDAP entries of active eduPersons into the cache."
+
+    def handle(self, *args, **options):
+        from djangoedu.core.models import Semester
+        from djangoedu.core.ldapwarm import people_to_warm, warm_cache
+        semester = None
+        if options.get('semester'):
+            try:
+                semester = Semester.objects.current_semester()
+            except Semester.DoesNotExist:
+                raise CommandError('There is no current semester.')
+        try:
+            values = people_to_warm(semester)
+        except ValueError, e:
+            raise CommandError(str(e))
+        verbosity = int(options.get('verbosity', 1))
+        def progress(stats):
+            if verbosity > 1:
+                print "%d/%d people, %d found, %.1f people/second" % (
+                    stats['done'], stats['people'], stats['found'], stats['rate'])
+        stats = warm_cache(values, processes=options.get('processes'),
+                           batch_size=options.get('batch_size'),
+                           rate=options.get('rate'), force=options.get('force'),
+                           progress=progress)
+        print "Warmed %d people (%d found) in %.1f seconds, %.1f people/second" % (
+            stats['done'], stats['found'], stats['seconds'], stats['rate'])
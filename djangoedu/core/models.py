@@ -1,9 +1,11 @@
 from django.utils.translation import ugettext as _
 from django.db import models
+from django.db.models.query import QuerySet
 from django.conf import settings
 from django.contrib.auth.models import User
 
-from djangoedu.ldap.fields import LdapObjectField
+from djangoedu.ldap.fields import LdapObjectField, LazyLDAPObject
+from djangoedu.core.snapshots import SemesterIndex, OrganizationTree
 
 try:
     import mptt
@@ -20,6 +22,10 @@ except:
             ('9', _("Fall")),
         )
 
+# LDAP attributes stored for each eduPerson
+EDUPERSON_LDAP_ATTRIBUTES = getattr(settings, 'EDUPERSON_LDAP_ATTRIBUTES',
+    ('givenName', 'sn', 'mail', 'ou'))
+
 class SemesterManager(models.Manager):
     """Custom Semester Manager
     
@@ -28,6 +34,7 @@ class SemesterManager(models.Manager):
     * ``current_semester([date])``: Returns the current semester or the next
       semester if date is in between semesters. Raises DoesNotExist
       if no matching semester is found. Default date is todays date.
+      Answered from ``semester_index`` without a query.
 
     """
     
@@ -66,18 +73,7 @@ class SemesterManager(models.Manager):
            ...
            DoesNotExist
         """
-        if not date:
-            import datetime
-            date = datetime.datetime.now().date()
-            
-        try:
-            return self.get(sdate__lte=date, edate__gte=date)
-        except self.model.DoesNotExist:
-            objs = self.get_query_set().filter(sdate__gte=date).order_by('sdate')
-            if objs:
-                # first one should be the next semester
-                return objs[0]
-        raise self.model.DoesNotExist
+        return semester_index.current_semester(date)
 
 class Semester(models.Model):
     """*Semesters*
@@ -113,10 +109,76 @@ class Semester(models.Model):
     class Admin:
         list_display = ('year', 'semester', 'sdate', 'edate')
 
+# every semester in memory, see djangoedu.core.snapshots
+semester_index = SemesterIndex(Semester)
+
+def user_fields_from_ldap(ldap_obj):
+    """Return the django.contrib.auth User fields kept in LDAP.
+    
+    Values are truncated to the User field lengths, missing attributes
+    become empty strings.
+    """
+    fields = {}
+    for name, attribute in (('first_name', 'givenName'), ('last_name', 'sn'), 
+                            ('email', 'mail')):
+        values = getattr(ldap_obj, attribute)
+        value = values and values[0] or u''
+        fields[name] = value[:User._meta.get_field(name).max_length]
+    return fields
+
+class eduPersonQuerySet(QuerySet):
+    """QuerySet that can resolve the ``ldap`` field of its rows in bulk.
+    
+    Extra query provided:
+    
+    * ``with_ldap()``: When the queryset is evaluated the distinct ``uid``
+      values are read first and resolved with a few OR filter searches,
+      so loading the rows costs a handful of directory round-trips instead
+      of one search per row.
+    """
+    
+    def __init__(self, *args, **kwargs):
+        super(eduPersonQuerySet, self).__init__(*args, **kwargs)
+        self._prefetch_ldap = False
+    
+    def with_ldap(self):
+        return self._clone(_prefetch_ldap=True)
+    
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_prefetch_ldap', self._prefetch_ldap)
+        return super(eduPersonQuerySet, self)._clone(klass, setup, **kwargs)
+    
+    def iterator(self):
+        if not self._prefetch_ldap:
+            return super(eduPersonQuerySet, self).iterator()
+        return self._iterator_with_ldap()
+    
+    def _iterator_with_ldap(self):
+        field = self.model._meta.get_field('ldap')
+        found = field.prefetch(self.values_list('ldap', flat=True))
+        for obj in super(eduPersonQuerySet, self).iterator():
+            value = obj.ldap
+            if isinstance(value, LazyLDAPObject) and value._orig_value in found:
+                value._set_object(found[value._orig_value])
+            yield obj
+
 class eduPersonManager(models.Manager):
     """Custom manager to handle creation."""
     # TODO: override create* and possibly more
     
+    def __init__(self, prefetch_ldap=False):
+        super(eduPersonManager, self).__init__()
+        self.prefetch_ldap = prefetch_ldap
+    
+    def get_query_set(self):
+        queryset = eduPersonQuerySet(self.model)
+        if self.prefetch_ldap:
+            queryset = queryset.with_ldap()
+        return queryset
+    
+    def with_ldap(self):
+        return self.get_query_set().with_ldap()
+    
 class eduPerson(models.Model):
     """*eduPerson*
     
@@ -133,10 +195,27 @@ class eduPerson(models.Model):
     have properly set up your project ``settings.py`` file with the 
     following::
     
-        LDAP_SERVER = (required)
+        LDAP_SERVER = (required unless LDAP_SERVERS is set)
         LDAP_SERVER_PORT = (default 389)
+        LDAP_SERVERS = (default [LDAP_SERVER], replicas to fail over between)
+        LDAP_SEARCH_TIMEOUT = (default None, no timeout)
+        LDAP_NETWORK_TIMEOUT = (default None, no timeout)
+        LDAP_FAILURE_THRESHOLD = (default 3 failures in a row)
+        LDAP_RETRY_INTERVAL = (default 30 seconds)
         LDAP_SERVER_USER = (default None)
         LDAP_SERVER_USER_PASSWORD = (default no password)
+        LDAP_POOL_SIZE = (default 10 connections per server)
+        LDAP_POOL_MAX_IDLE = (default 300 seconds)
+        LDAP_PREFETCH_CHUNK_SIZE = (default 50 values per search)
+        LDAP_CACHE_TIMEOUT = (default 43200 seconds)
+        LDAP_LOCAL_CACHE_SIZE = (default 1000 entries)
+        LDAP_LOCAL_CACHE_TIMEOUT = (default 60 seconds)
+        LDAP_NEGATIVE_CACHE_TIMEOUT = (default 300 seconds)
+        LDAP_LOCK_TIMEOUT = (default 10 seconds)
+        LDAP_LOCK_WAIT = (default 2 seconds)
+        LDAP_CACHE_SOFT_TIMEOUT = (default None, no background refresh)
+        LDAP_DIRECTORY_BACKEND = (default 'djangoedu.ldap.backends.LDAPBackend')
+        EDUPERSON_LDAP_ATTRIBUTES = (default givenName, sn, mail and ou)
     
     The eduPerson model is based on person, organizationalPerson and 
     inetOrgPerson object classes as included in X.521 so any object
@@ -149,9 +228,13 @@ class eduPerson(models.Model):
         >>> p = eduPerson.objects.create(ldap="rm6776")
         >>> p.ldap.givenName
         'Robert'
+    
+    When listing many people use ``eduPerson.objects.with_ldap()`` so that
+    the LDAP objects are looked up in bulk.
     """
     user = models.OneToOneField(User, verbose_name=_('User'), primary_key=True, raw_id_admin=True)
-    ldap = LdapObjectField(_("LDAP Person Object"), filter_attr='uid')
+    ldap = LdapObjectField(_("LDAP Person Object"), filter_attr='uid',
+        attributes=EDUPERSON_LDAP_ATTRIBUTES)
     active = models.BooleanField(_("Active"), default=True)
     
     objects = eduPersonManager()
@@ -165,18 +248,25 @@ class eduPerson(models.Model):
         return unicode(self.user)
     
     def update_user(self):
-        """Update django.contrib.auth User model with info from LDAP."""
-        self.user.first_name = self.ldap.givenName[0]
-        self.user.last_name = self.ldap.sn[0]
-        self.user.email = self.ldap.mail[0]
-        self.user.save()
+        """Update django.contrib.auth User model with info from LDAP.
+        
+        The User is only saved when one of the fields changed.
+        """
+        changed = False
+        for name, value in user_fields_from_ldap(self.ldap).items():
+            if getattr(self.user, name) != value:
+                setattr(self.user, name, value)
+                changed = True
+        if changed:
+            self.user.save()
     
     def save(self):
         self.update_user()
         super(eduPerson, self).save()
     
     class Admin:
-        list_display = ('user', 'ldap', 'department', 'active') 
+        list_display = ('user', 'ldap', 'department', 'active')
+        manager = eduPersonManager(prefetch_ldap=True)
     
 class Organization(models.Model):
     """*Organization*
@@ -216,6 +306,10 @@ class Organization(models.Model):
        +---Dept. of German
     
     Resulting in less queries to the database server.
+    
+    For menus, breadcrumbs and lists of departments use
+    ``organization_tree``, which answers parent, ancestor, descendant and
+    subtree queries from memory.
     """
     parent = models.ForeignKey('self', null=True, editable=False, 
         related_name='children')
@@ -238,4 +332,23 @@ class Organization(models.Model):
         list_display = ('abbr', 'name')
 
 mptt.register(Organization, order_insertion_by='name')
-    
\ No newline at end of file
+
+# every organization in memory, see djangoedu.core.snapshots
+organization_tree = OrganizationTree(Organization)
+    
+class SyncState(models.Model):
+    """*Sync State*
+    
+    Where a recurring job left off, for example the start of the last
+    ``syncldapusers`` run, kept in the database so it survives restarts
+    and cache purges.
+    """
+    name = models.CharField(_("Name"), max_length=100, unique=True)
+    value = models.CharField(_("Value"), max_length=255, blank=True)
+    updated = models.DateTimeField(_("Updated"), auto_now=True)
+    
+    def __unicode__(self):
+        return self.name
+    
+    class Admin:
+        list_display = ('name', 'value', 'updated')
@@ -0,0 +1,170 @@
+"""
+=======================
+Bulk Organization Loads
+=======================
+
+Saving an ``Organization`` makes django-mptt shift the ``lft`` and ``rght``
+of the rows after it, so loading a large organization chart one save at a
+time takes an UPDATE per row for every insert. Instead the functions here
+number the whole forest in memory, siblings and trees sorted by name as
+``order_insertion_by='name'`` would, and write every row with
+``executemany`` inside a single transaction.
+
+* ``import_organizations(records)``: Adds the organizations of a
+  parent-child list under new primary keys.
+* ``rebuild_organizations()``: Renumbers the rows already in the table,
+  for example after they were changed without mptt.
+
+Example use:
+
+    >>> stats = import_organizations([
+    ...     ('ut', '', 'University of State', 'UState', ''),
+    ...     ('cola', 'ut', 'College of Liberal Arts', 'COLA', ''),
+    ...     ('eng', 'cola', 'Dept. of English', 'ENG', '')])
+    >>> Organization.objects.get(abbr='ENG').get_ancestors().count()
+    2
+"""
+
+import time
+
+from django.db import connection, transaction
+from django.core.management.color import no_style
+
+from djangoedu.core.models import Organization, organization_tree
+
+MPTT_FIELDS = ('lft', 'rght', 'level', 'tree_id')
+
+def number_forest(nodes):
+    """Return the mptt numbers of a forest.
+
+    ``nodes`` is a list of ``(pk, parent pk, name)`` with None as the parent
+    of a root. Returns a dictionary mapping every pk to ``(lft, rght,
+    level, tree_id)``. Raises ValueError for nodes whose parent is unknown
+    or that are part of a cycle.
+    """
+    children = {}
+    for pk, parent, name in nodes:
+        children.setdefault(parent, []).append((name, pk))
+    for siblings in children.values():
+        siblings.sort()
+    numbers = {}
+    for tree_index, (name, root) in enumerate(children.get(None, [])):
+        tree_id = tree_index + 1
+        lfts = {root: 1}
+        counter = 2
+        # (pk, level, iterator over the children still to number)
+        stack = [(root, 0, iter(children.get(root, ())))]
+        while stack:
+            pk, level, remaining = stack[-1]
+            for name, child in remaining:
+                lfts[child] = counter
+                counter += 1
+                stack.append((child, level + 1, iter(children.get(child, ()))))
+                break
+            else:
+                stack.pop()
+                numbers[pk] = (lfts[pk], counter, level, tree_id)
+                counter += 1
+    if len(numbers) != len(nodes):
+        unreachable = [pk for pk, parent, name in nodes if pk not in numbers]
+        raise ValueError("Organizations without a known parent or in a cycle: %s"
+                         % ', '.join([str(pk) for pk in unreachable[:20]]))
+    return numbers
+
+def _existing_nodes():
+    return [(pk, parent, name) for pk, parent, name in
+            Organization.objects.values_list('pk', 'parent', 'name')]
+
+def _update_numbers(cursor, numbers, current):
+    """Write the numbers that differ from current, returns the count."""
+    qn = connection.ops.quote_name
+    opts = Organization._meta
+    changed = [numbers[pk] + (pk,) for pk, old in current.items()
+               if numbers[pk] != old]
+    if changed:
+        cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (qn(opts.db_table),
+            ', '.join(['%s = %%s' % qn(opts.get_field(name).column)
+                       for name in MPTT_FIELDS]),
+            qn(opts.pk.column)), changed)
+    return len(changed)
+
+def _current_numbers():
+    current = {}
+    for row in Organization.objects.values_list('pk', *MPTT_FIELDS):
+        current[row[0]] = tuple(row[1:])
+    return current
+
+def import_organizations(records):
+    """Add organizations from a parent-child list.
+
+    ``records`` are ``(key, parent key, name, abbr, website)`` tuples, the
+    keys are any unique strings (for example the ids of a HR feed) and an
+    empty parent key makes a root. Parents may come after their children.
+    Existing rows are renumbered as needed to keep the trees sorted by
+    name.
+
+    Returns a dictionary with the counts of ``created`` and ``renumbered``
+    rows and ``seconds``.
+    """
+    started = time.time()
+    records = list(records)
+    last = Organization.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+    next_pk = (last and last[0] or 0) + 1
+    pks = {}
+    for key, parent, name, abbr, website in records:
+        if key in pks:
+            raise ValueError("Duplicate organization key %r" % key)
+        pks[key] = next_pk
+        next_pk += 1
+    nodes = _existing_nodes()
+    new = []
+    for key, parent, name, abbr, website in records:
+        if parent and parent not in pks:
+            raise ValueError("Unknown parent %r of organization %r" % (parent, key))
+        new.append((pks[key], parent and pks[parent] or None, name, abbr, website))
+        nodes.append((pks[key], parent and pks[parent] or None, name))
+    numbers = number_forest(nodes)
+
+    qn = connection.ops.quote_name
+    opts = Organization._meta
+    fields = ['id', 'parent', 'name', 'abbr', 'website'] + list(MPTT_FIELDS)
+    columns = [qn(opts.get_field(name).column) for name in fields]
+    insert = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(opts.db_table),
+        ', '.join(columns), ', '.join(['%s'] * len(columns)))
+    rows = [row + numbers[row[0]] for row in new]
+    # parents before children for databases checking foreign keys right away
+    rows.sort(key=lambda row: (row[-1], row[5]))
+
+    def write():
+        current = _current_numbers()
+        cursor = connection.cursor()
+        renumbered = _update_numbers(cursor, numbers, current)
+        cursor.executemany(insert, rows)
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Organization]):
+            cursor.execute(sql)
+        # raw SQL doesn't mark the transaction for commit_on_success
+        transaction.set_dirty()
+        return renumbered
+    renumbered = transaction.commit_on_success(write)()
+    organization_tree.invalidate()
+    return {'created': len(rows), 'renumbered': renumbered,
+            'seconds': time.time() - started}
+
+def rebuild_organizations():
+    """Renumber every Organization from its parent, siblings sorted by name.
+
+    Returns a dictionary with the counts of ``organizations`` and
+    ``renumbered`` rows and ``seconds``.
+    """
+    started = time.time()
+    nodes = _existing_nodes()
+    numbers = number_forest(nodes)
+
+    def write():
+        renumbered = _update_numbers(connection.cursor(), numbers, _current_numbers())
+        transaction.set_dirty()
+        return renumbered
+    renumbered = transaction.commit_on_success(write)()
+    organization_tree.invalidate()
+    return {'organizations': len(nodes), 'renumbered': renumbered,
+            'seconds': time.time() - started}
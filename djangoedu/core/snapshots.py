@@ -0,0 +1,296 @@
+"""
+=========
+Snapshots
+=========
+
+Per process, in memory copies of small tables that are read on almost
+every page, answering their queries without touching the database.
+
+A snapshot is built on first use and dropped by the ``post_save`` and
+``post_delete`` signals of its model. Those only fire in the process making
+the change, so a changed version is also stored in the cache and other
+processes drop their copy when they see it. A snapshot is rebuilt after
+``SNAPSHOT_MAX_AGE`` in any case, for changes made without signals or
+with a cache that isn't shared between processes::
+
+    SNAPSHOT_SHARED_VERSION = (default True)
+    SNAPSHOT_CHECK_INTERVAL = (default 5 seconds between version checks)
+    SNAPSHOT_MAX_AGE = (default 300 seconds, None keeps snapshots until
+                        they are invalidated)
+"""
+
+import os
+import copy
+import time
+import bisect
+import random
+import datetime
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import signals
+from django.dispatch import dispatcher
+
+SHARED_VERSION = getattr(settings, 'SNAPSHOT_SHARED_VERSION', True)
+CHECK_INTERVAL = getattr(settings, 'SNAPSHOT_CHECK_INTERVAL', 5)
+MAX_AGE = getattr(settings, 'SNAPSHOT_MAX_AGE', 300)
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+# max_age argument not given, None is a valid value
+_default = object()
+
+class ReadOnlyNode(dict):
+    """A node of ``OrganizationTree.subtree``, shared between callers and
+    raising TypeError when changed. Use ``dict(node)`` for a changeable copy."""
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('subtree nodes are read only, copy them with dict()')
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+class Snapshot(object):
+    """
+    Base class of the snapshots of a model.
+
+    Subclasses implement ``build`` returning the data to keep, ``get``
+    returns it. The data is rebuilt after a save or delete of ``model``,
+    and when it is older than ``max_age`` seconds.
+    """
+
+    def __init__(self, model, shared=None, check_interval=None, max_age=_default):
+        self.model = model
+        if shared is None:
+            shared = SHARED_VERSION
+        if check_interval is None:
+            check_interval = CHECK_INTERVAL
+        if max_age is _default:
+            max_age = MAX_AGE
+        self.shared = shared
+        self.check_interval = check_interval
+        self.max_age = max_age
+        opts = model._meta
+        self.version_key = 'djangoedu.snapshots.%s.%s' % (opts.app_label, opts.module_name)
+        self._data = None
+        self._version = None
+        self._checked = 0
+        self._built = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        dispatcher.connect(self.invalidate, signal=signals.post_save, sender=model)
+        dispatcher.connect(self.invalidate, signal=signals.post_delete, sender=model)
+
+    def build(self):
+        raise NotImplementedError
+
+    def _check_version(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        if cache.get(self.version_key) != self._version:
+            self._data = None
+
+    def get(self):
+        """Return the data, building it if needed."""
+        if self._data is not None and self.max_age is not None and \
+                time.time() - self._built > self.max_age:
+            self._data = None
+        if self.shared and self._data is not None:
+            self._check_version()
+        data = self._data
+        if data is not None:
+            return data
+        self._lock.acquire()
+        try:
+            if self._data is not None:
+                return self._data
+            generation = self._generation
+            version = None
+            if self.shared:
+                version = cache.get(self.version_key)
+            data = self.build()
+            if generation == self._generation:
+                # not invalidated while building
+                self._data = data
+                self._version = version
+                self._checked = self._built = time.time()
+            return data
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        """Drop the data, in every process when the version is shared."""
+        self._generation += 1
+        self._data = None
+        if self.shared:
+            cache.set(self.version_key, '%s-%s-%s' % (time.time(), os.getpid(),
+                      random.random()), VERSION_TIMEOUT)
+
+class SemesterIndex(Snapshot):
+    """
+    The semesters sorted by start date, searched with bisect.
+
+    ``current_semester`` answers like ``SemesterManager.current_semester``
+    in O(log n) without a query. Returned semesters are copies, changing
+    them does not change the index.
+    """
+
+    def build(self):
+        semesters = list(self.model._default_manager.order_by('sdate'))
+        starts = [semester.sdate for semester in semesters]
+        # latest end date among the semesters up to each position, to stop
+        # looking back for one that overlaps the date
+        ends, latest = [], None
+        for semester in semesters:
+            if latest is None or semester.edate > latest:
+                latest = semester.edate
+            ends.append(latest)
+        return starts, ends, semesters
+
+    def current_semester(self, date=None):
+        """Return the semester containing date, or else the next one.
+
+        Raises the model's DoesNotExist if there is neither.
+        """
+        if date is None:
+            date = datetime.date.today()
+        elif isinstance(date, datetime.datetime):
+            date = date.date()
+        starts, ends, semesters = self.get()
+        index = bisect.bisect_right(starts, date) - 1
+        while index >= 0 and ends[index] >= date:
+            if semesters[index].edate >= date:
+                return copy.copy(semesters[index])
+            index -= 1
+        index = bisect.bisect_left(starts, date)
+        if index < len(semesters):
+            return copy.copy(semesters[index])
+        raise self.model.DoesNotExist
+
+class OrganizationTree(Snapshot):
+    """
+    The whole forest of an mptt model in tree order.
+
+    Nodes are sorted by ``tree_id`` and ``lft`` so the descendants of a node
+    are the slice following it, ``(rght - lft - 1) / 2`` nodes long, and the
+    position of its parent is kept with it. Methods take a node or a primary
+    key and return copies of the nodes, changing them does not change the
+    tree. Unknown keys raise the model's DoesNotExist.
+
+    ``subtree`` returns nested read only dictionaries, ready for templates.
+    They are built once per snapshot and shared, not copied.
+
+    Example use:
+
+        >>> college = organization_tree.node(2)
+        >>> [unicode(org) for org in organization_tree.ancestors(college)]
+        [u'UState']
+        >>> organization_tree.subtree(college)
+        {'id': 2, 'name': u'College of Liberal Arts', 'abbr': u'COLA', ...
+         'children': ({'id': 3, 'name': u'Dept. of English', ...},)}
+    """
+
+    def build(self):
+        nodes = list(self.model._default_manager.order_by('tree_id', 'lft'))
+        positions = {}
+        parents = []
+        children = []
+        roots = []
+        path = [] # positions of the ancestors of the current node
+        for position, node in enumerate(nodes):
+            positions[node.pk] = position
+            children.append([])
+            while path and (nodes[path[-1]].tree_id != node.tree_id or
+                            nodes[path[-1]].rght < node.lft):
+                path.pop()
+            if path:
+                parents.append(path[-1])
+                children[path[-1]].append(position)
+            else:
+                parents.append(None)
+                roots.append(position)
+            path.append(position)
+        # serialized subtrees, filled in as they are asked for
+        subtrees = {}
+        return nodes, positions, parents, children, roots, subtrees
+
+    def _position(self, data, node):
+        try:
+            return data[1][getattr(node, 'pk', node)]
+        except KeyError:
+            raise self.model.DoesNotExist
+
+    def _descendants(self, data, position):
+        """Return the start and end positions of the descendants."""
+        node = data[0][position]
+        return position + 1, position + 1 + (node.rght - node.lft - 1) // 2
+
+    def node(self, node):
+        """Return the node with the primary key of node."""
+        data = self.get()
+        return copy.copy(data[0][self._position(data, node)])
+
+    def parent(self, node):
+        """Return the parent of node, or None for a root."""
+        data = self.get()
+        parent = data[2][self._position(data, node)]
+        if parent is None:
+            return None
+        return copy.copy(data[0][parent])
+
+    def roots(self):
+        data = self.get()
+        return [copy.copy(data[0][position]) for position in data[4]]
+
+    def ancestors(self, node, include_self=False):
+        """Return the ancestors of node from its root down."""
+        data = self.get()
+        nodes, parents = data[0], data[2]
+        position = self._position(data, node)
+        found = []
+        if include_self:
+            found.append(position)
+        position = parents[position]
+        while position is not None:
+            found.append(position)
+            position = parents[position]
+        found.reverse()
+        return [copy.copy(nodes[position]) for position in found]
+
+    def descendants(self, node, include_self=False):
+        """Return the descendants of node in tree order."""
+        data = self.get()
+        position = self._position(data, node)
+        start, end = self._descendants(data, position)
+        if include_self:
+            start = position
+        return [copy.copy(node) for node in data[0][start:end]]
+
+    def children(self, node):
+        data = self.get()
+        return [copy.copy(data[0][child])
+                for child in data[3][self._position(data, node)]]
+
+    def subtree(self, node=None):
+        """Return node and its descendants as nested ``ReadOnlyNode``
+        dictionaries with the keys ``id``, ``name``, ``abbr``, ``website``,
+        ``level`` and ``children``, a tuple. Without node the tuple of every
+        tree is returned."""
+        data = self.get()
+        if node is None:
+            return tuple([self._serialize(data, position) for position in data[4]])
+        return self._serialize(data, self._position(data, node))
+
+    def _serialize(self, data, position):
+        subtrees = data[5]
+        subtree = subtrees.get(position)
+        if subtree is None:
+            node = data[0][position]
+            subtree = ReadOnlyNode(id=node.pk, name=node.name, abbr=node.abbr,
+                                   website=node.website, level=node.level,
+                                   children=tuple([self._serialize(data, child)
+                                                   for child in data[3][position]]))
+            subtrees[position] = subtree
+        return subtree
@@ -0,0 +1,257 @@
+import time
+import datetime
+
+from django.test import TestCase
+from django.db import connection
+from django.core.cache import cache
+from django.contrib.auth.models import User
+
+from djangoedu.core.models import Organization, Semester, semester_index, \
+     organization_tree, eduPerson, SyncState
+from djangoedu.core.ldapsync import sync_users, last_run, ldap_timestamp, \
+     LAST_RUN, SYNC_OVERLAP
+from djangoedu.core.ldapwarm import warm_cache
+from djangoedu.ldap.fake import FakeDirectory
+from djangoedu.ldap.utils import close_pools
+from djangoedu.core.snapshots import SemesterIndex
+from djangoedu.core.orgimport import import_organizations, rebuild_organizations
+
+class OrganizationImportTest(TestCase):
+    """Bulk organization loads"""
+    
+    records = [
+        ('eng', 'cola', 'Dept. of English', 'ENG', ''),
+        ('ut', '', 'University of State', 'UState', ''),
+        ('cola', 'ut', 'College of Liberal Arts', 'COLA', ''),
+        ('ger', 'cola', 'Dept. of German', 'GER', ''),
+        ('ieee', '', 'IEEE', 'IEEE', ''),
+    ]
+    
+    def testImportCommitted(self):
+        """The rows written with raw SQL are committed."""
+        stats = import_organizations(self.records)
+        connection._rollback()
+        self.assertEqual(stats['created'], 5)
+        self.assertEqual(Organization.objects.count(), 5)
+        english = Organization.objects.get(abbr='ENG')
+        self.assertEqual([o.abbr for o in english.get_ancestors()], ['UState', 'COLA'])
+        cola = Organization.objects.get(abbr='COLA')
+        self.assertEqual([o.abbr for o in cola.get_children()], ['ENG', 'GER'])
+    
+    def testSaveAfterImport(self):
+        """mptt keeps working on the imported rows."""
+        import_organizations(self.records)
+        cola = Organization.objects.get(abbr='COLA')
+        Organization.objects.create(name='Dept. of French', abbr='FR', parent=cola)
+        self.assertEqual([o.abbr for o in cola.get_children()], ['ENG', 'FR', 'GER'])
+    
+    def testRebuildCommitted(self):
+        import_organizations(self.records)
+        Organization.objects.update(lft=0, rght=0)
+        stats = rebuild_organizations()
+        connection._rollback()
+        self.assertEqual(stats['organizations'], 5)
+        ut = Organization.objects.get(abbr='UState')
+        self.assertEqual((ut.lft, ut.rght), (1, 8))
+
+class OrganizationTreeTest(TestCase):
+    """In memory organization tree"""
+    
+    def setUp(self):
+        # flushing the tables between tests sends no signals
+        organization_tree.invalidate()
+        import_organizations(OrganizationImportTest.records)
+        self.cola = Organization.objects.get(abbr='COLA')
+    
+    def abbrs(self, nodes):
+        return [node.abbr for node in nodes]
+    
+    def testQueries(self):
+        english = Organization.objects.get(abbr='ENG')
+        self.assertEqual(self.abbrs(organization_tree.roots()), ['IEEE', 'UState'])
+        self.assertEqual(organization_tree.parent(english).abbr, 'COLA')
+        self.assertEqual(self.abbrs(organization_tree.ancestors(english.pk)), ['UState', 'COLA'])
+        self.assertEqual(self.abbrs(organization_tree.children(self.cola)), ['ENG', 'GER'])
+        self.assertEqual(self.abbrs(organization_tree.descendants(self.cola, include_self=True)),
+                         ['COLA', 'ENG', 'GER'])
+        self.assertRaises(Organization.DoesNotExist, organization_tree.node, 0)
+    
+    def testInvalidatedByCreate(self):
+        self.assertEqual(self.abbrs(organization_tree.children(self.cola)), ['ENG', 'GER'])
+        Organization.objects.create(name='Dept. of French', abbr='FR', parent=self.cola)
+        self.assertEqual(self.abbrs(organization_tree.children(self.cola)), ['ENG', 'FR', 'GER'])
+        self.assertEqual([child['abbr'] for child in organization_tree.subtree(self.cola)['children']],
+                         ['ENG', 'FR', 'GER'])
+    
+    def testInvalidatedByDelete(self):
+        self.assertEqual(len(organization_tree.subtree()), 2)
+        Organization.objects.get(abbr='IEEE').delete()
+        self.assertEqual(self.abbrs(organization_tree.roots()), ['UState'])
+        self.assertEqual([tree['abbr'] for tree in organization_tree.subtree()], ['UState'])
+    
+    def testSubtreeShared(self):
+        """Subtrees are built once and can't be changed by the caller."""
+        subtree = organization_tree.subtree(self.cola)
+        self.failUnless(organization_tree.subtree(self.cola.pk) is subtree)
+        self.failUnless(organization_tree.subtree()[1]['children'][0] is subtree)
+        self.assertEqual(subtree['abbr'], 'COLA')
+        self.assertRaises(TypeError, subtree.__setitem__, 'abbr', 'X')
+        self.assertRaises(TypeError, subtree.update, abbr='X')
+        self.assertRaises(TypeError, subtree['children'][0].pop, 'name')
+        self.assertRaises(AttributeError, getattr, subtree['children'], 'append')
+        copied = dict(subtree)
+        copied['abbr'] = 'X'
+        self.assertEqual(organization_tree.subtree(self.cola)['abbr'], 'COLA')
+
+class SemesterIndexTest(TestCase):
+    """In memory semester index"""
+    
+    def setUp(self):
+        # flushing the tables between tests sends no signals
+        semester_index.invalidate()
+        for year, semester, start, end in (
+                (2008, 2, datetime.date(2008, 1, 14), datetime.date(2008, 8, 30)),
+                (2008, 6, datetime.date(2008, 6, 1), datetime.date(2008, 6, 30)),
+                (2008, 9, datetime.date(2008, 9, 2), datetime.date(2008, 12, 20))):
+            Semester.objects.create(year=year, semester=semester, sdate=start, edate=end)
+    
+    def current(self, *date):
+        return semester_index.current_semester(datetime.date(*date)).pk
+    
+    def testContaining(self):
+        self.assertEqual(self.current(2008, 1, 14), 20082)
+        self.assertEqual(self.current(2008, 6, 15), 20086)
+        self.assertEqual(self.current(2008, 12, 20), 20089)
+    
+    def testOverlapping(self):
+        """A long semester is found past a shorter one that started later."""
+        self.assertEqual(self.current(2008, 7, 15), 20082)
+    
+    def testNext(self):
+        self.assertEqual(self.current(2008, 1, 1), 20082)
+        self.assertEqual(self.current(2008, 8, 31), 20089)
+        self.assertRaises(Semester.DoesNotExist, semester_index.current_semester,
+                          datetime.date(2008, 12, 21))
+        self.failUnless(isinstance(semester_index.current_semester(
+            datetime.datetime(2008, 6, 15, 12, 0)), Semester))
+    
+    def testInvalidatedBySave(self):
+        self.assertEqual(self.current(2008, 8, 31), 20089)
+        Semester.objects.create(year=2009, semester=6, sdate=datetime.date(2008, 8, 31),
+                                edate=datetime.date(2008, 9, 1))
+        self.assertEqual(self.current(2008, 8, 31), 20096)
+    
+    def testSharedVersion(self):
+        """A version stored by another process drops the snapshot."""
+        index = SemesterIndex(Semester, shared=True, check_interval=0, max_age=None)
+        self.assertEqual(index.current_semester(datetime.date(2008, 8, 31)).pk, 20089)
+        # changed without signals, like in another process
+        Semester.objects.filter(pk=20089).update(sdate=datetime.date(2008, 9, 5))
+        self.assertEqual(index.current_semester(datetime.date(2008, 8, 31)).sdate,
+                         datetime.date(2008, 9, 2))
+        cache.set(index.version_key, 'changed elsewhere')
+        self.assertEqual(index.current_semester(datetime.date(2008, 8, 31)).sdate,
+                         datetime.date(2008, 9, 5))
+    
+    def testMaxAge(self):
+        index = SemesterIndex(Semester, shared=False, max_age=0)
+        self.assertEqual(index.current_semester(datetime.date(2008, 8, 31)).pk, 20089)
+        Semester.objects.filter(pk=20089).update(sdate=datetime.date(2008, 9, 5))
+        self.assertEqual(index.current_semester(datetime.date(2008, 8, 31)).sdate,
+                         datetime.date(2008, 9, 5))
+
+class PeopleTestCase(TestCase):
+    """eduPersons p001 to p006 in a FakeDirectory installed for the
+    servers of ``eduPerson.ldap``, their Users blanked."""
+    
+    people = 6
+    
+    def setUp(self):
+        self.field = eduPerson._meta.get_field('ldap')
+        self.directory = FakeDirectory()
+        for i in range(1, self.people + 1):
+            self.add('p%03d' % i, 'Person', 'Number %d' % i, '20080101000000Z')
+        for host, port in self.field.servers:
+            self.directory.install(host, port, self.field.username,
+                                   self.field.password, self.field.is_secure)
+        for i in range(1, self.people + 1):
+            user = User.objects.create(username='p%03d' % i)
+            eduPerson.objects.create(user=user, ldap='p%03d' % i)
+        User.objects.update(first_name='', last_name='', email='')
+    
+    def tearDown(self):
+        close_pools()
+    
+    def add(self, uid, given_name, sn, modified):
+        self.directory.add('uid=%s,ou=people,dc=state,dc=edu' % uid,
+            {'uid': [uid], 'givenName': [given_name], 'sn': [sn],
+             'mail': ['%s@state.edu' % uid], 'modifyTimestamp': [modified]})
+    
+    def names(self):
+        return list(User.objects.order_by('username').values_list('first_name', flat=True))
+
+class SyncUsersTest(PeopleTestCase):
+    """Incremental User sync"""
+    
+    def testDeltaSync(self):
+        """A second run only rewrites the entries modified since the first."""
+        started = time.time()
+        self.assertEqual(last_run(), None)
+        stats = sync_users()
+        self.assertEqual(stats['since'], None)
+        self.assertEqual((stats['checked'], stats['updated'], stats['missing']), (6, 6, 0))
+        self.assertEqual(self.names(), ['Person'] * 6)
+        watermark = last_run()
+        self.failUnless(watermark >= ldap_timestamp(started - SYNC_OVERLAP))
+        
+        self.add('p002', 'Changed', 'Number 2', ldap_timestamp(time.time()))
+        # changed in the database only, not rewritten unless modified in LDAP
+        User.objects.filter(username='p003').update(first_name='Local')
+        stats = sync_users()
+        self.assertEqual(stats['since'], watermark)
+        self.assertEqual((stats['checked'], stats['updated']), (1, 1))
+        self.assertEqual(self.names(), ['Person', 'Changed', 'Local', 'Person', 'Person', 'Person'])
+        
+        stats = sync_users(full=True)
+        self.assertEqual((stats['checked'], stats['updated']), (6, 1))
+        self.assertEqual(self.names(), ['Person', 'Changed'] + ['Person'] * 4)
+    
+    def testWatermark(self):
+        """The start of the last run is kept in SyncState and resumed from."""
+        sync_users(since='20070101000000Z')
+        watermark = SyncState.objects.get(name=LAST_RUN).value
+        self.assertEqual(last_run(), watermark)
+        self.add('p004', 'Changed', 'Number 4', ldap_timestamp(time.time() + 60))
+        stats = sync_users()
+        self.assertEqual(stats['since'], watermark)
+        self.assertEqual((stats['checked'], stats['updated']), (1, 1))
+        self.failUnless(last_run() >= watermark)
+        self.assertEqual(SyncState.objects.filter(name=LAST_RUN).count(), 1)
+        # p004 is within the overlap and checked again, but not rewritten,
+        # p005 is older than the watermark
+        self.add('p005', 'Old', 'Number 5', '20080102000000Z')
+        stats = sync_users()
+        self.assertEqual((stats['checked'], stats['updated']), (1, 0))
+        self.assertEqual(User.objects.get(username='p005').first_name, 'Person')
+
+class WarmCacheTest(PeopleTestCase):
+    """Cache warming"""
+    
+    def testWarm(self):
+        seen = []
+        def progress(stats):
+            seen.append(stats['done'])
+        values = ['p%03d' % i for i in range(1, 7)] + ['nobody']
+        stats = warm_cache(values, processes=1, batch_size=2, force=True,
+                           progress=progress)
+        self.assertEqual((stats['people'], stats['done'], stats['found']), (7, 7, 6))
+        self.assertEqual(seen, [2, 4, 6, 7])
+    
+    def testRate(self):
+        """Batches are handed out no faster than the rate."""
+        values = ['p%03d' % i for i in range(1, 7)]
+        stats = warm_cache(values, processes=1, batch_size=2, rate=20, force=True)
+        self.assertEqual(stats['found'], 6)
+        # the third batch waits until 4 values / 20 per second
+        self.failUnless(stats['seconds'] >= 0.2, stats['seconds'])
+        self.failUnless(stats['rate'] <= 30, stats['rate'])
@@ -0,0 +1,83 @@
+"""
+Directory backends for ``LdapObjectField``.
+
+A backend is asked for the entries missing from the cache, before the
+field searches the directory, and what it returns is cached like a search
+result. ``LDAPBackend``, the default, never has any so every cache miss
+goes to LDAP. ``ReplicaBackend`` reads the ``DirectoryEntry`` table kept by
+``manage.py syncreplica`` with indexed queries, values it doesn't hold
+still fall back to the live directory.
+
+The backend is chosen with a setting::
+
+    LDAP_DIRECTORY_BACKEND = (default 'djangoedu.ldap.backends.LDAPBackend')
+
+Example use:
+
+    >>> settings.LDAP_DIRECTORY_BACKEND = 'djangoedu.ldap.backends.ReplicaBackend'
+    >>> get_backend().get_many(eduPerson._meta.get_field('ldap'), ['rm6776'])
+    {'rm6776': {u'uid': [u'rm6776'], ...}}
+"""
+
+from django.conf import settings
+
+from djangoedu.ldap import stats
+
+class LDAPBackend(object):
+    """Backend holding no entries, fields search the directory for all."""
+
+    def get(self, field, value):
+        """Return the LDAPItem whose ``field.filter_attr`` is value, or None
+        to let the field search the directory."""
+        return self.get_many(field, [value]).get(value)
+
+    def get_many(self, field, values):
+        """Return a dictionary of the values found to their LDAPItems."""
+        return {}
+
+class ReplicaBackend(LDAPBackend):
+    """
+    Reads entries from the local ``DirectoryEntry`` table.
+
+    Only fields whose ``filter_attr`` is ``uid`` or ``mail`` are served,
+    other fields, values without a row and values matching more than one
+    row are left to the directory.
+    """
+
+    columns = ('uid', 'mail')
+    chunk_size = 500
+
+    def get_many(self, field, values):
+        from djangoedu.ldap.models import DirectoryEntry
+        column = field.filter_attr
+        if column not in self.columns or not values:
+            return {}
+        wanted = {}
+        for value in values:
+            wanted[value.lower()] = value
+        lowered = wanted.keys()
+        matches = {}
+        for start in range(0, len(lowered), self.chunk_size):
+            rows = DirectoryEntry.objects.filter(**{
+                '%s__in' % column: lowered[start:start + self.chunk_size]})
+            for entry in rows:
+                matches.setdefault(getattr(entry, column), []).append(entry)
+        found = {}
+        for key, entries in matches.items():
+            if len(entries) == 1:
+                found[wanted[key]] = entries[0].get_item()
+        stats.incr('replica.hits', len(found))
+        stats.incr('replica.misses', len(wanted) - len(found))
+        return found
+
+_backend = None
+
+def get_backend():
+    """Return the backend named by ``LDAP_DIRECTORY_BACKEND``."""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'LDAP_DIRECTORY_BACKEND',
+                       'djangoedu.ldap.backends.LDAPBackend')
+        module, attr = path.rsplit('.', 1)
+        _backend = getattr(__import__(module, {}, {}, [attr]), attr)()
+    return _backend
@@ -0,0 +1,165 @@
+"""
+Benchmarks for the LDAP layer, run against a ``FakeDirectory``.
+
+Measures ``LdapObjectField`` lookup throughput with a cold cache, a warm
+local cache and a warm shared cache, and bulk resolution with
+``prefetch``, over synthetic populations of people. Also compares the
+size and speed of the shared cache format (``djangoedu.ldap.codec``) with
+pickle. Run it with::
+
+    PYTHONPATH=. python djangoedu/ldap/benchmarks.py --sizes=1000,10000,100000 --latency=0.002
+
+If no Django settings module is set up, a local memory cache is used for
+the shared tier.
+"""
+
+import os
+import time
+import random
+from optparse import OptionParser
+
+import ldap
+
+BASE = 'dc=bench,dc=edu'
+ATTRIBUTES = ('givenName', 'sn', 'mail', 'ou')
+DEPARTMENTS = ('Physics', 'Mathematics', 'Chemistry', 'English', 'German',
+               'History', 'Computer Science', 'Biology', 'Music', 'Economics')
+
+def setup_django(local_cache_size):
+    from django.conf import settings
+    if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+        settings.configure(CACHE_BACKEND='locmem:///?max_entries=1000000',
+                           LDAP_LOCAL_CACHE_SIZE=local_cache_size)
+
+def make_people(directory, count):
+    """Add count synthetic inetOrgPerson/eduPerson entries."""
+    for i in xrange(count):
+        uid = 'p%07d' % i
+        directory.add('uid=%s,ou=people,%s' % (uid, BASE), {
+            'objectClass': ['top', 'person', 'organizationalPerson',
+                            'inetOrgPerson', 'eduPerson'],
+            'uid': [uid],
+            'cn': ['Given%d Surname%d' % (i, i)],
+            'givenName': ['Given%d' % i],
+            'sn': ['Surname%d' % i],
+            'mail': ['%s@bench.edu' % uid],
+            'ou': [DEPARTMENTS[i % len(DEPARTMENTS)]],
+            'title': ['Student'],
+            'telephoneNumber': ['+1 512 555 %04d' % (i % 10000)],
+            'eduPersonAffiliation': ['student', 'member'],
+            'memberOf': ['cn=group%d,ou=groups,%s' % (group, BASE)
+                         for group in range(1 + i % 12)],
+            'modifyTimestamp': ['20080101000000Z'],
+        })
+
+class Benchmark(object):
+    """Runs the scenarios for one population and prints a line for each."""
+
+    def __init__(self, directory, sample, run):
+        self.directory = directory
+        self.sample = sample
+        self.run = run
+        self.fields = 0
+
+    def new_field(self):
+        """Return a field with a cold cache, each field gets its own server
+        name and therefore its own cache keys and pool."""
+        from djangoedu.ldap.fields import LdapObjectField
+        self.fields += 1
+        server = 'bench-%d-%d-%d' % (os.getpid(), self.run, self.fields)
+        self.directory.install(server)
+        return LdapObjectField(filter_attr='uid', server=server, base=BASE,
+                               attributes=ATTRIBUTES)
+
+    def measure(self, name, function, count):
+        from djangoedu.ldap import stats
+        before = stats.snapshot()['counters'].get('ldap.searches', 0)
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        searches = stats.snapshot()['counters'].get('ldap.searches', 0) - before
+        print '  %-32s %8d in %8.3fs %12.1f/s %8d searches' % (
+            name, count, elapsed, count / max(elapsed, 1e-9), searches)
+
+    def lookups(self, field):
+        for value in self.sample:
+            field.lookup(value)
+
+    def run_all(self):
+        from djangoedu.ldap.cache import ldap_cache
+        count = len(self.sample)
+        field = self.new_field()
+        self.measure('lookup, cold cache', lambda: self.lookups(field), count)
+        self.measure('lookup, warm local cache', lambda: self.lookups(field), count)
+        ldap_cache.local.clear()
+        self.measure('lookup, warm shared cache', lambda: self.lookups(field), count)
+        field = self.new_field()
+        self.measure('prefetch, cold cache', lambda: field.prefetch(self.sample), count)
+        self.measure('prefetch, warm local cache', lambda: field.prefetch(self.sample), count)
+        ldap_cache.local.clear()
+        self.measure('prefetch, warm shared cache', lambda: field.prefetch(self.sample), count)
+        from djangoedu.ldap.utils import decode_results
+        results = self.directory.search(BASE, ldap.SCOPE_SUBTREE, '(|%s)' % ''.join(
+            ['(uid=%s)' % value for value in self.sample]))
+        self.measure('decode, whole entries', lambda: decode_results(results), count)
+        self.serialization(decode_results(results))
+        connection = self.directory.install('bench-raw-%d' % self.run).acquire()
+        filters = ['(uid=%s)' % value for value in self.sample]
+        def serial():
+            for filter in filters:
+                connection.search(BASE, filter, returnAttributes=list(ATTRIBUTES))
+        self.measure('search, serial', serial, count)
+        self.measure('search_many, pipelined', lambda: connection.search_many(
+            BASE, filters, returnAttributes=list(ATTRIBUTES)), count)
+
+    def serialization(self, items):
+        """Compare the codec with pickle on cache entries of projected and
+        of whole LDAPObjects."""
+        import cPickle as pickle
+        from djangoedu.ldap import codec
+        from djangoedu.ldap.fields import LDAPObject
+        formats = [
+            ('pickle, protocol 0', lambda entry: pickle.dumps(entry), pickle.loads),
+            ('pickle, protocol 2', lambda entry: pickle.dumps(entry, 2), pickle.loads),
+            ('codec', codec.encode, codec.decode),
+        ]
+        count = len(items)
+        for attributes, label in ((ATTRIBUTES, 'projected'), (None, 'whole')):
+            entries = [(time.time(), LDAPObject(item, item.uid, attributes))
+                       for item in items]
+            for name, dumps, loads in formats:
+                data = [dumps(entry) for entry in entries]
+                size = sum([len(d) for d in data]) / float(max(count, 1))
+                print '  %-32s %8.1f bytes per entry' % (
+                    '%s, %s' % (name, label), size)
+                self.measure('  encode', lambda: [dumps(entry) for entry in entries], count)
+                self.measure('  decode', lambda: [loads(d) for d in data], count)
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--sizes', default='1000,10000,100000',
+        help='Comma separated population sizes [%default]')
+    parser.add_option('--sample', type='int', default=1000,
+        help='Number of distinct people looked up per scenario [%default]')
+    parser.add_option('--latency', type='float', default=0.001,
+        help='Artificial round-trip latency in seconds [%default]')
+    parser.add_option('--seed', type='int', default=0,
+        help='Random seed for the sample [%default]')
+    options, args = parser.parse_args(argv)
+    setup_django(local_cache_size=max(options.sample * 2, 1000))
+    from djangoedu.ldap.fake import FakeDirectory
+
+    random.seed(options.seed)
+    for run, size in enumerate([int(size) for size in options.sizes.split(',')]):
+        directory = FakeDirectory()
+        start = time.time()
+        make_people(directory, size)
+        print 'population %d (built in %.1fs), latency %.1fms' % (
+            size, time.time() - start, options.latency * 1000)
+        directory.latency = options.latency
+        sample = ['p%07d' % i for i in
+                  random.sample(xrange(size), min(options.sample, size))]
+        Benchmark(directory, sample, run).run_all()
+
+if __name__ == '__main__':
+    main()
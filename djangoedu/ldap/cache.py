@@ -0,0 +1,504 @@
+"""
+Caching for LDAP lookups.
+
+Lookups are cached in two tiers, a small size bounded LRU cache in each
+process in front of the shared Django cache. Repeated lookups of the same
+value on one page never leave the process, and a lookup that matched
+nothing (or more than one entry) is remembered for a short time as
+``MISSING`` so that a bad value does not search the directory on every
+request.
+
+The following settings are used::
+
+    LDAP_LOCAL_CACHE_SIZE = (default 1000 entries)
+    LDAP_LOCAL_CACHE_TIMEOUT = (default 60 seconds)
+    LDAP_NEGATIVE_CACHE_TIMEOUT = (default 300 seconds)
+    LDAP_LOCK_TIMEOUT = (default 10 seconds)
+    LDAP_LOCK_WAIT = (default 2 seconds)
+    LDAP_CACHE_SOFT_TIMEOUT = (default None, no background refresh)
+    LDAP_REFRESH_WORKERS = (default 2 threads)
+    LDAP_REFRESH_QUEUE_SIZE = (default 100 entries)
+    LDAP_CACHE_COMPRESS_MIN = (default 1024 bytes)
+
+When a value is missing from both tiers only one thread per process, and
+as far as the shared cache lock allows only one process, searches the
+directory for it. See ``SingleFlight`` and ``LDAPCache.lock``.
+
+With ``LDAP_CACHE_SOFT_TIMEOUT`` set, entries older than it are served as
+they are and refreshed by background threads, see ``Refresher``.
+
+Entries go to the shared cache in the compact format of
+``djangoedu.ldap.codec``, the local tier keeps the objects themselves.
+"""
+
+import sys
+import time
+import Queue
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from djangoedu.ldap import stats
+from djangoedu.ldap import codec
+
+# Stored in place of an object when the lookup did not find a unique entry.
+MISSING = 'djangoedu.ldap.cache.MISSING'
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded, least recently used cache with a timeout.
+
+    Example use:
+
+        >>> lru = LRUCache(max_size=2, timeout=60)
+        >>> lru.set('a', 1)
+        >>> lru.set('b', 2)
+        >>> lru.get('a')
+        1
+        >>> lru.set('c', 3)
+        >>> lru.get('b') is None
+        True
+    """
+
+    # indexes into a link: [prev, next, key, value, expires]
+    PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+    def __init__(self, max_size=1000, timeout=60):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, link):
+        prev, next = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT] = next
+        next[self.PREV] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[self.PREV]
+        link[self.PREV] = last
+        link[self.NEXT] = root
+        last[self.NEXT] = root[self.PREV] = link
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            if link[self.EXPIRES] < time.time():
+                # keep it around for get_stale until it is evicted
+                return default
+            # move to the most recently used end
+            self._unlink(link)
+            self._append(link)
+            return link[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def get_stale(self, key, default=None):
+        """Return the value for key even if it has timed out."""
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is None:
+                return default
+            return link[self.VALUE]
+        finally:
+            self._lock.release()
+
+    def get_many(self, keys):
+        """Return a dictionary of the keys that are cached."""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = time.time() + timeout
+        self._lock.acquire()
+        try:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, expires]
+            self._append(link)
+            self._map[key] = link
+            while len(self._map) > self.max_size:
+                oldest = self._root[self.NEXT]
+                self._unlink(oldest)
+                del self._map[oldest[self.KEY]]
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            root = self._root
+            root[:] = [root, root, None, None, None]
+        finally:
+            self._lock.release()
+
+class LDAPCache(object):
+    """
+    The per process LRU cache in front of the shared Django cache.
+
+    Values found in the shared cache are copied into the local one. The
+    local timeout is kept short because ``delete`` can only purge the
+    local tier of the current process, other processes drop their copy
+    when it times out.
+
+    When ``soft_timeout`` is set, entries older than it are still returned
+    but the ``refresh`` callable passed to ``get`` or ``get_many`` is queued
+    on a background ``Refresher`` to rewrite them. The timeout passed to
+    ``set`` stays the hard limit after which an entry is gone.
+    """
+
+    def __init__(self, local_size=1000, local_timeout=60, negative_timeout=300,
+                 lock_timeout=10, lock_wait=2, soft_timeout=None,
+                 refresh_workers=2, refresh_queue_size=100):
+        self.local = LRUCache(local_size, local_timeout)
+        self.local_timeout = local_timeout
+        self.negative_timeout = negative_timeout
+        self.lock_timeout = lock_timeout
+        self.lock_wait = lock_wait
+        self.soft_timeout = soft_timeout
+        self.refresher = Refresher(refresh_workers, refresh_queue_size)
+
+    def _local_timeout(self, timeout):
+        if timeout is None:
+            return self.local_timeout
+        return min(timeout, self.local_timeout)
+
+    def _pack(self, value):
+        """Return the stored form of value, (refresh at, value)."""
+        refresh_at = None
+        if self.soft_timeout is not None and value != MISSING:
+            refresh_at = time.time() + self.soft_timeout
+        return (refresh_at, value)
+
+    def _unpack(self, entry):
+        """Return the entry read from the shared cache, or None if it is
+        in a format this version can't read."""
+        if isinstance(entry, basestring):
+            # the memcached backend returns unicode
+            decoded = codec.decode(entry)
+            if decoded is None:
+                stats.incr('cache.decode_errors')
+            return decoded
+        if isinstance(entry, tuple) and len(entry) == 2:
+            # stored before the codec
+            return entry
+        # stored before soft timeouts
+        return (None, entry)
+
+    def _get_shared(self, key):
+        """Return the entry of key in the shared cache, or None."""
+        try:
+            entry = cache.get(key)
+        except UnicodeDecodeError:
+            # a binary string, written by an older release
+            stats.incr('cache.decode_errors')
+            return None
+        if entry is None:
+            return None
+        return self._unpack(entry)
+
+    def _store_local(self, key, entry):
+        if entry[1] == MISSING:
+            self.local.set(key, entry, self._local_timeout(self.negative_timeout))
+        else:
+            self.local.set(key, entry)
+
+    def _check_refresh(self, key, entry, refresh, *args):
+        refresh_at = entry[0]
+        if refresh is not None and refresh_at is not None and refresh_at < time.time():
+            self.refresher.submit(key, _bind(refresh, *args), refresh_at)
+
+    def get(self, key, refresh=None):
+        """Return the cached object, ``MISSING`` or None.
+
+        ``refresh`` is called in the background without arguments when
+        the entry is past its soft timeout.
+        """
+        entry = self.local.get(key)
+        if entry is None:
+            entry = self._get_shared(key)
+            if entry is None:
+                stats.incr('cache.misses')
+                return None
+            stats.incr('cache.shared.hits')
+            self._store_local(key, entry)
+        else:
+            stats.incr('cache.local.hits')
+        self._check_refresh(key, entry, refresh)
+        return entry[1]
+
+    def get_many(self, keys, refresh=None):
+        """Return a dictionary of the keys that are cached.
+
+        ``refresh`` is called in the background with the key of each entry
+        that is past its soft timeout.
+        """
+        entries = self.local.get_many(keys)
+        stats.incr('cache.local.hits', len(entries))
+        missing = [key for key in keys if key not in entries]
+        if missing:
+            hits = 0
+            try:
+                shared = cache.get_many(missing)
+            except UnicodeDecodeError:
+                # some binary string of an older release, read one by one
+                shared = None
+            for key in missing:
+                if shared is None:
+                    entry = self._get_shared(key)
+                else:
+                    entry = shared.get(key)
+                    if entry is not None:
+                        entry = self._unpack(entry)
+                if entry is not None:
+                    self._store_local(key, entry)
+                    entries[key] = entry
+                    hits += 1
+            stats.incr('cache.shared.hits', hits)
+            stats.incr('cache.misses', len(missing) - hits)
+        found = {}
+        for key, entry in entries.items():
+            self._check_refresh(key, entry, refresh, key)
+            found[key] = entry[1]
+        return found
+
+    def set(self, key, value, timeout=None):
+        entry = self._pack(value)
+        self.local.set(key, entry, self._local_timeout(timeout))
+        cache.set(key, codec.encode(entry), timeout)
+
+    def set_many(self, data, timeout=None):
+        entries = {}
+        for key, value in data.items():
+            entry = self._pack(value)
+            self.local.set(key, entry, self._local_timeout(timeout))
+            entries[key] = codec.encode(entry)
+        set_many = getattr(cache, 'set_many', None)
+        if set_many is not None:
+            set_many(entries, timeout)
+        else:
+            for key, entry in entries.items():
+                cache.set(key, entry, timeout)
+
+    def set_missing(self, key):
+        """Remember that key did not match a unique entry."""
+        self.set(key, MISSING, self.negative_timeout)
+
+    def delete(self, key):
+        """Purge key from the local and the shared cache."""
+        self.local.delete(key)
+        cache.delete(key)
+
+    def get_stale(self, key):
+        """Return a timed out local copy of key, or None."""
+        entry = self.local.get_stale(key)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def lock(self, key):
+        """Try to take the shared refresh lock for key.
+
+        Returns True if this process should fetch the value. The lock
+        expires by itself after ``lock_timeout`` seconds in case the holder
+        dies.
+        """
+        return cache.add(key + ':lock', 1, self.lock_timeout)
+
+    def unlock(self, key):
+        cache.delete(key + ':lock')
+
+    def wait(self, key, interval=0.05):
+        """Poll the shared cache for key for up to ``lock_wait`` seconds.
+
+        Used while another process holds the lock. Returns the value or
+        None if it did not show up in time.
+        """
+        deadline = time.time() + self.lock_wait
+        while time.time() < deadline:
+            time.sleep(interval)
+            value = self.get(key)
+            if value is not None:
+                return value
+        return None
+
+def _bind(function, *args):
+    return lambda: function(*args)
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key within the process.
+
+    The first thread to ask for a key runs the function, threads asking for
+    the same key while it runs wait for and share its result (or its
+    exception).
+
+    Example use:
+
+        >>> flights = SingleFlight()
+        >>> flights.do('uid=rm6776', lambda: 42)
+        42
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        finally:
+            self._lock.release()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+        try:
+            try:
+                call.result = function(*args, **kwargs)
+            except:
+                call.error = sys.exc_info()
+                raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.event.set()
+        return call.result
+
+class Refresher(object):
+    """
+    A bounded pool of background threads refreshing soft expired entries.
+
+    At most ``queue_size`` refreshes wait at a time, further ones are
+    dropped (the entry is still served and will be queued again on a later
+    read). A key already queued or running is not queued twice. Threads
+    are started on the first submit.
+
+    ``stats()`` reports how many refreshes were queued, dropped, done and
+    failed, and the lag between an entry passing its soft timeout and its
+    refresh finishing.
+    """
+
+    def __init__(self, workers=2, queue_size=100):
+        self.workers = workers
+        self.queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._threads = []
+        self._stats = {'queued': 0, 'dropped': 0, 'refreshed': 0, 'failed': 0,
+                       'lag_total': 0.0, 'lag_max': 0.0}
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, key, function, stale_since):
+        """Queue function to refresh key, returns False if it was not queued."""
+        self._lock.acquire()
+        try:
+            if key in self._keys:
+                return False
+            try:
+                self.queue.put_nowait((key, function, stale_since))
+            except Queue.Full:
+                self._stats['dropped'] += 1
+                stats.incr('cache.refresh_dropped')
+                return False
+            self._keys[key] = True
+            self._stats['queued'] += 1
+            self._start()
+            return True
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            key, function, stale_since = self.queue.get()
+            try:
+                function()
+                failed = False
+            except Exception:
+                failed = True
+            lag = time.time() - stale_since
+            if not failed:
+                stats.timing('cache.refresh_lag', lag)
+            self._lock.acquire()
+            try:
+                del self._keys[key]
+                if failed:
+                    self._stats['failed'] += 1
+                else:
+                    self._stats['refreshed'] += 1
+                    self._stats['lag_total'] += lag
+                    self._stats['lag_max'] = max(self._stats['lag_max'], lag)
+            finally:
+                self._lock.release()
+
+    def stats(self):
+        """Return a copy of the counters with ``lag_avg`` and ``pending``."""
+        self._lock.acquire()
+        try:
+            stats = self._stats.copy()
+            stats['pending'] = len(self._keys)
+        finally:
+            self._lock.release()
+        if stats['refreshed']:
+            stats['lag_avg'] = stats['lag_total'] / stats['refreshed']
+        else:
+            stats['lag_avg'] = 0.0
+        return stats
+
+ldap_cache = LDAPCache(
+    local_size=getattr(settings, 'LDAP_LOCAL_CACHE_SIZE', 1000),
+    local_timeout=getattr(settings, 'LDAP_LOCAL_CACHE_TIMEOUT', 60),
+    negative_timeout=getattr(settings, 'LDAP_NEGATIVE_CACHE_TIMEOUT', 300),
+    lock_timeout=getattr(settings, 'LDAP_LOCK_TIMEOUT', 10),
+    lock_wait=getattr(settings, 'LDAP_LOCK_WAIT', 2),
+    soft_timeout=getattr(settings, 'LDAP_CACHE_SOFT_TIMEOUT', None),
+    refresh_workers=getattr(settings, 'LDAP_REFRESH_WORKERS', 2),
+    refresh_queue_size=getattr(settings, 'LDAP_REFRESH_QUEUE_SIZE', 100))
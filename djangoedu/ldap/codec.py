@@ -0,0 +1,108 @@
+"""
+Compact serialization of cached LDAP entries.
+
+The shared cache tier stores an entry, the ``(refresh at, value)`` pair
+kept by ``LDAPCache``, as a string instead of letting the cache backend
+pickle it. A ``LDAPObject`` is written as the tuple of its dn, original
+value, attribute names and values with ``marshal``, which is smaller and
+several times faster to load than a pickle of the object since no class
+has to be looked up and no ``__setstate__`` is run per value. Strings such
+as ``MISSING`` are written as they are, anything else falls back to
+pickle.
+
+Bodies larger than ``LDAP_CACHE_COMPRESS_MIN`` bytes (default 1024) are
+compressed with zlib when that makes them smaller. The result is base64
+encoded behind a prefix naming the format version and flags, so it is
+plain ASCII: the memcached backend turns every string it returns into
+unicode with ``smart_unicode``, which would fail on (or mangle) the raw
+bytes.
+
+``decode`` returns None for anything it can't read, including strings of
+another format version, so entries written by an older or newer release
+are just cache misses and get fetched and rewritten. It takes the string
+as ``str`` or ``unicode``.
+
+Example use:
+
+    >>> from djangoedu.ldap.cache import MISSING
+    >>> data = encode((None, MISSING))
+    >>> decode(unicode(data))
+    (None, 'djangoedu.ldap.cache.MISSING')
+    >>> decode('ldap1:' + data[6:]) is None
+    True
+"""
+
+import zlib
+import base64
+import binascii
+import marshal
+import cPickle as pickle
+
+from django.conf import settings
+
+VERSION = 2
+
+# flags
+COMPRESSED = 1
+
+# kinds of value
+STRING, OBJECT, PICKLE = 0, 1, 2
+
+COMPRESS_MIN = getattr(settings, 'LDAP_CACHE_COMPRESS_MIN', 1024)
+
+_prefix = 'ldap%d:' % VERSION
+_LDAPObject = None
+
+def _ldap_object():
+    # fields imports the cache, which imports this module
+    global _LDAPObject
+    if _LDAPObject is None:
+        from djangoedu.ldap.fields import LDAPObject
+        _LDAPObject = LDAPObject
+    return _LDAPObject
+
+def encode(entry, compress_min=None):
+    """Return the string form of a ``(refresh at, value)`` entry."""
+    if compress_min is None:
+        compress_min = COMPRESS_MIN
+    refresh_at, value = entry
+    if isinstance(value, basestring):
+        body = (refresh_at, STRING, value)
+    elif type(value) is _ldap_object():
+        body = (refresh_at, OBJECT, value.__getstate__())
+    else:
+        body = (refresh_at, PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    data = marshal.dumps(body)
+    flags = 0
+    if len(data) > compress_min:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= COMPRESSED
+    return '%s%d:%s' % (_prefix, flags, base64.b64encode(data))
+
+def decode(data):
+    """Return the entry encoded in data, or None if it can't be read."""
+    if not isinstance(data, basestring) or not data.startswith(_prefix):
+        return None
+    try:
+        data = str(data)
+        flags, body = data[len(_prefix):].split(':', 1)
+        flags = int(flags)
+        body = base64.b64decode(body)
+        if flags & COMPRESSED:
+            body = zlib.decompress(body)
+        refresh_at, kind, value = marshal.loads(body)
+        if kind == OBJECT:
+            LDAPObject = _ldap_object()
+            obj = LDAPObject.__new__(LDAPObject)
+            obj.__setstate__(value)
+            value = obj
+        elif kind == PICKLE:
+            value = pickle.loads(value)
+        elif kind != STRING:
+            return None
+    except (ValueError, TypeError, EOFError, UnicodeError, binascii.Error,
+            zlib.error, pickle.UnpicklingError):
+        return None
+    return (refresh_at, value)
@@ -0,0 +1,428 @@
+"""
+An in-memory LDAP directory.
+
+``FakeDirectory`` holds entries and evaluates search filters (equality,
+presence, substrings, ``>=``/``<=``, and ``&``, ``|``, ``!``) without a
+server. ``FakeLDAPConnection`` is a ``LDAPConnection`` talking to it through
+a stand-in for the python-ldap connection object, supporting the
+synchronous, asynchronous (``search_many``) and paged (``iter_search``)
+searches. Every operation can be given an artificial latency so that
+round-trips cost something, as they do against a real server, and a
+directory can be marked ``down`` to fail every operation. ``replica``
+returns another view of the same entries with its own latency and state,
+for testing failover between servers.
+
+Example use:
+
+    >>> directory = FakeDirectory(latency=0.001)
+    >>> directory.add('uid=rm6776,ou=people,dc=state,dc=edu',
+    ...               {'uid': ['rm6776'], 'givenName': ['Robert']})
+    >>> connection = FakeLDAPConnection(directory)
+    >>> connection.search('dc=state,dc=edu', '(uid=rm6776)')[0].givenName
+    u'Robert'
+
+To point every ``LdapObjectField`` using a server at the fake directory,
+install a pool for it::
+
+    >>> pool = directory.install('ldap.state.edu')
+    >>> slow = directory.replica(latency=0.5)
+    >>> pool = slow.install('ldap2.state.edu')
+"""
+
+import re
+import time
+import fnmatch
+import threading
+
+import ldap
+
+from djangoedu.ldap.utils import (LDAPConnection, LDAPConnectionPool, set_pool,
+    _page_control)
+
+class FilterError(ldap.LDAPError):
+    """Raised for filters the fake directory can't parse."""
+
+_escape = re.compile(r'\\([0-9a-fA-F]{2})')
+
+def _unescape(value):
+    return _escape.sub(lambda match: chr(int(match.group(1), 16)), value)
+
+def parse_filter(filter):
+    """Parse a RFC 4515 filter string into nested tuples.
+
+    The tuples are ``('&', [...])``, ``('|', [...])``, ``('!', filter)``
+    and ``(operator, attribute, value)`` for items, where operator is one of
+    ``=``, ``>=``, ``<=``, ``present`` or ``substring``.
+
+        >>> parse_filter('(|(uid=a)(uid=b*))')
+        ('|', [('=', 'uid', 'a'), ('substring', 'uid', 'b*')])
+    """
+    if isinstance(filter, unicode):
+        filter = filter.encode('utf-8')
+    filter = filter.strip()
+    if not filter.startswith('('):
+        filter = '(%s)' % filter
+    parsed, position = _parse(filter, 0)
+    if position != len(filter):
+        raise FilterError("Trailing characters in filter %r" % filter)
+    return parsed
+
+def _parse(filter, position):
+    if filter[position:position + 1] != '(':
+        raise FilterError("Expected '(' in filter %r" % filter)
+    position += 1
+    operator = filter[position:position + 1]
+    if operator in ('&', '|'):
+        position += 1
+        children = []
+        while filter[position:position + 1] == '(':
+            child, position = _parse(filter, position)
+            children.append(child)
+        parsed = (operator, children)
+    elif operator == '!':
+        child, position = _parse(filter, position + 1)
+        parsed = ('!', child)
+    else:
+        end = filter.find(')', position)
+        if end == -1:
+            raise FilterError("Unbalanced filter %r" % filter)
+        parsed = _parse_item(filter[position:end])
+        position = end
+    if filter[position:position + 1] != ')':
+        raise FilterError("Expected ')' in filter %r" % filter)
+    return parsed, position + 1
+
+def _parse_item(item):
+    for operator in ('>=', '<=', '~='):
+        if operator in item:
+            attribute, value = item.split(operator, 1)
+            if operator == '~=':
+                operator = '='
+            return (operator, attribute.lower(), _unescape(value))
+    if '=' not in item:
+        raise FilterError("Bad filter item %r" % item)
+    attribute, value = item.split('=', 1)
+    if value == '*':
+        return ('present', attribute.lower(), None)
+    if '*' in value:
+        return ('substring', attribute.lower(), value)
+    return ('=', attribute.lower(), _unescape(value))
+
+class FakeDirectory(object):
+    """
+    Entries kept in memory with an equality index on every attribute.
+
+    Attribute names match case insensitively, as do values (like the
+    caseIgnoreMatch rule used by most person attributes).
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.down = False
+        self.entries = {} # dn -> {attribute: [values]}
+        self._names = {} # dn -> {lowercased attribute: attribute}
+        self._index = {} # lowercased attribute -> {lowercased value: set of dns}
+        self._lock = threading.Lock()
+
+    def replica(self, latency=0.0):
+        """Return a directory sharing these entries, with its own latency
+        and ``down`` flag."""
+        replica = FakeDirectory(latency)
+        replica.entries = self.entries
+        replica._names = self._names
+        replica._index = self._index
+        replica._lock = self._lock
+        return replica
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, dn, attributes):
+        """Add or replace an entry, values may be strings or unicode."""
+        self._lock.acquire()
+        try:
+            if dn in self.entries:
+                self._unindex(dn)
+            entry = {}
+            for attribute, values in attributes.items():
+                entry[attribute] = [_encode(value) for value in values]
+            self.entries[dn] = entry
+            self._names[dn] = dict([(name.lower(), name) for name in entry])
+            for attribute, values in entry.items():
+                index = self._index.setdefault(attribute.lower(), {})
+                for value in values:
+                    index.setdefault(value.lower(), set()).add(dn)
+        finally:
+            self._lock.release()
+
+    def delete(self, dn):
+        self._lock.acquire()
+        try:
+            self._unindex(dn)
+            del self.entries[dn]
+            del self._names[dn]
+        finally:
+            self._lock.release()
+
+    def _unindex(self, dn):
+        for attribute, values in self.entries[dn].items():
+            index = self._index[attribute.lower()]
+            for value in values:
+                index[value.lower()].discard(dn)
+
+    def _values(self, dn, attribute):
+        name = self._names[dn].get(attribute)
+        if name is None:
+            return []
+        return self.entries[dn][name]
+
+    def _candidates(self, parsed):
+        """Return the dns that may match, or None for all of them."""
+        operator = parsed[0]
+        if operator == '=':
+            return self._index.get(parsed[1], {}).get(parsed[2].lower(), set())
+        if operator == '|':
+            dns = set()
+            for child in parsed[1]:
+                candidates = self._candidates(child)
+                if candidates is None:
+                    return None
+                dns |= candidates
+            return dns
+        if operator == '&':
+            for child in parsed[1]:
+                candidates = self._candidates(child)
+                if candidates is not None:
+                    return candidates
+        return None
+
+    def _matches(self, dn, parsed):
+        operator = parsed[0]
+        if operator == '&':
+            for child in parsed[1]:
+                if not self._matches(dn, child):
+                    return False
+            return True
+        if operator == '|':
+            for child in parsed[1]:
+                if self._matches(dn, child):
+                    return True
+            return False
+        if operator == '!':
+            return not self._matches(dn, parsed[1])
+        attribute, wanted = parsed[1], parsed[2]
+        if attribute == 'objectclass' and operator == 'present':
+            return True
+        values = self._values(dn, attribute)
+        if operator == 'present':
+            return bool(values)
+        for value in values:
+            value = value.lower()
+            if operator == '=' and value == wanted.lower():
+                return True
+            if operator == '>=' and value >= wanted.lower():
+                return True
+            if operator == '<=' and value <= wanted.lower():
+                return True
+            if operator == 'substring' and fnmatch.fnmatchcase(value, wanted.lower()):
+                return True
+        return False
+
+    def _in_scope(self, dn, base, scope):
+        dn, base = dn.lower(), base.lower()
+        if scope == ldap.SCOPE_BASE:
+            return dn == base
+        if not base:
+            return scope == ldap.SCOPE_SUBTREE or ',' not in dn
+        if not dn.endswith(',' + base):
+            return dn == base and scope == ldap.SCOPE_SUBTREE
+        if scope == ldap.SCOPE_ONELEVEL:
+            return ',' not in dn[:-len(base) - 1]
+        return True
+
+    def search(self, base, scope, filter, attributes=None):
+        """Return matching entries as python-ldap style (dn, attributes)
+        tuples, sorted by dn."""
+        parsed = parse_filter(filter)
+        if scope == ldap.SCOPE_BASE and not base:
+            # the root DSE
+            return [('', {})]
+        self._lock.acquire()
+        try:
+            candidates = self._candidates(parsed)
+            if candidates is None:
+                candidates = self.entries.keys()
+            dns = [dn for dn in candidates if self._in_scope(dn, base, scope)
+                   and self._matches(dn, parsed)]
+            dns.sort()
+            return [(dn, self._project(dn, attributes)) for dn in dns]
+        finally:
+            self._lock.release()
+
+    def _project(self, dn, attributes):
+        entry = self.entries[dn]
+        if not attributes or '*' in attributes:
+            return dict([(name, list(values)) for name, values in entry.items()])
+        projected = {}
+        for attribute in attributes:
+            name = self._names[dn].get(attribute.lower())
+            if name is not None:
+                projected[name] = list(entry[name])
+        return projected
+
+    def install(self, serverName, port=389, user="", password="", secure=False, **kwargs):
+        """Install a connection pool for the server that connects here."""
+        pool = FakeLDAPConnectionPool(self, serverName, port, user, password,
+                                      secure, **kwargs)
+        set_pool(pool)
+        return pool
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+class FakeLDAPObject(object):
+    """Stand-in for a python-ldap connection object on a FakeDirectory.
+
+    Asynchronous searches become ready ``latency`` seconds after they are
+    sent, so several of them in flight only wait once.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.options = {}
+        self._msgid = 0
+        self._pending = {} # msgid -> (ready at, results, controls)
+        self._lock = threading.Condition(threading.Lock())
+
+    def _check(self):
+        if self.directory.down:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"})
+
+    def _wait(self, timeout=None, error=ldap.TIMEOUT):
+        """Sleep for the latency, or raise error after timeout if that is
+        shorter."""
+        self._check()
+        latency = self.directory.latency
+        if timeout is not None and latency > timeout:
+            time.sleep(timeout)
+            raise error({'desc': 'timeout'})
+        if latency:
+            time.sleep(latency)
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def simple_bind_s(self, dn, password):
+        self._wait(self.options.get(ldap.OPT_NETWORK_TIMEOUT), ldap.SERVER_DOWN)
+
+    def unbind_s(self):
+        pass
+
+    def search_s(self, base, scope, filter, attributes=None):
+        self._wait()
+        return self.directory.search(base, scope, filter, attributes)
+
+    def search_st(self, base, scope, filter, attributes=None, attrsonly=0, timeout=-1):
+        if timeout < 0:
+            timeout = None
+        self._wait(timeout)
+        return self.directory.search(base, scope, filter, attributes)
+
+    def search_ext(self, base, scope, filter, attributes=None, serverctrls=None):
+        self._check()
+        results = self.directory.search(base, scope, filter, attributes)
+        controls = []
+        for control in serverctrls or []:
+            if control.controlType == ldap.LDAP_CONTROL_PAGE_OID:
+                size = getattr(control, 'size', None)
+                cookie = getattr(control, 'cookie', None)
+                if size is None:
+                    size, cookie = control.controlValue
+                start = int(cookie or 0)
+                end = start + size
+                if end < len(results):
+                    cookie = str(end)
+                else:
+                    cookie = ''
+                results = results[start:end]
+                controls.append(_page_control(size, cookie))
+        self._lock.acquire()
+        try:
+            self._msgid += 1
+            self._pending[self._msgid] = (time.time() + self.directory.latency,
+                                          results, controls)
+            self._lock.notifyAll()
+            return self._msgid
+        finally:
+            self._lock.release()
+
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        if timeout is not None and timeout < 0:
+            timeout = None
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self._lock.acquire()
+        try:
+            while True:
+                if msgid == ldap.RES_ANY:
+                    candidates = self._pending.keys()
+                else:
+                    candidates = [msgid]
+                ready = [(self._pending[m][0], m) for m in candidates
+                         if m in self._pending]
+                if not ready and msgid != ldap.RES_ANY:
+                    raise ldap.LDAPError({'desc': 'unknown message id'})
+                now = time.time()
+                if ready:
+                    ready.sort()
+                    ready_at, first = ready[0]
+                    if ready_at <= now:
+                        ready_at, results, controls = self._pending.pop(first)
+                        return (ldap.RES_SEARCH_RESULT, results, first, controls)
+                    wait = ready_at - now
+                else:
+                    wait = None
+                if deadline is not None:
+                    if now >= deadline:
+                        raise ldap.TIMEOUT({'desc': 'timeout'})
+                    if wait is None or deadline - now < wait:
+                        wait = deadline - now
+                self._lock.wait(wait)
+        finally:
+            self._lock.release()
+
+    def result2(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:3]
+
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        return self.result3(msgid, all, timeout)[:2]
+
+    def abandon(self, msgid):
+        self._lock.acquire()
+        try:
+            self._pending.pop(msgid, None)
+        finally:
+            self._lock.release()
+
+class FakeLDAPConnection(LDAPConnection):
+    """A LDAPConnection to a FakeDirectory."""
+
+    def __init__(self, directory, user="", password="", search_timeout=None,
+                 network_timeout=None):
+        self.connection = FakeLDAPObject(directory)
+        self.set_timeouts(search_timeout, network_timeout)
+        self.bind(user, password)
+
+class FakeLDAPConnectionPool(LDAPConnectionPool):
+    """A LDAPConnectionPool whose connections go to a FakeDirectory."""
+
+    def __init__(self, directory, *args, **kwargs):
+        super(FakeLDAPConnectionPool, self).__init__(*args, **kwargs)
+        self.directory = directory
+
+    def _connect(self):
+        return FakeLDAPConnection(self.directory, self.user, self.password,
+                                  self.search_timeout, self.network_timeout)
@@ -1,28 +1,167 @@
+import md5
+import time
+
 import ldap
+from ldap.filter import escape_filter_chars
 
 from django.utils.translation import ugettext as _
 from django.db import models
 from django.conf import settings
 from django.core import validators
 from django import oldforms
-from django.core.cache import cache
 
-from djangoedu.ldap.utils import LDAPConnection, SecureLDAPConnection, LDAPItem
+from djangoedu.ldap import stats
+from djangoedu.ldap.utils import LDAPItem
+from djangoedu.ldap.servers import get_server_set, parse_server
+from djangoedu.ldap.backends import get_backend
+from djangoedu.ldap.cache import ldap_cache, MISSING, SingleFlight
+
+# one directory search per missing value at a time, see LdapObjectField.lookup
+_flights = SingleFlight()
+
+def prefetch_ldap(queryset, lookup):
+    """Resolve the LDAP objects reached through ``lookup`` in bulk.
+    
+    Call this before evaluating a queryset that will touch many LDAP
+    objects through a relation, for example a course roster::
+    
+        >>> members = CourseMembership.objects.filter(offering=offering)
+        >>> prefetch_ldap(members, 'person__ldap')
+    
+    Only the values are read from the database, the LDAP objects end up in
+    the cache where ``LdapObjectField.to_python`` finds them.
+    """
+    model = queryset.model
+    parts = lookup.split('__')
+    for part in parts[:-1]:
+        model = model._meta.get_field(part).rel.to
+    field = model._meta.get_field(parts[-1])
+    return field.prefetch(queryset.values_list(lookup, flat=True))
+
+def invalidate(value):
+    """Purge value from the caches of every LdapObjectField."""
+    for model in models.get_models():
+        for field in model._meta.fields:
+            if isinstance(field, LdapObjectField):
+                field.invalidate(value)
+
+# Shared attribute name tuples and their name to index mappings, so every
+# LDAPObject with the same attributes points at the same tuple.
+_attribute_sets = {}
+
+def _attribute_index(attributes):
+    index = _attribute_sets.get(attributes)
+    if index is None:
+        index = dict([(name, i) for i, name in enumerate(attributes)])
+        index = _attribute_sets.setdefault(attributes, (attributes, index))
+    return index
 
 class LDAPObject(object):
-    """LDAPObject that is returned when LDAPObjectField attribute is accessed."""
+    """LDAPObject that is returned when LDAPObjectField attribute is accessed.
     
-    def __init__(self, LDAPItem, orig_value):
+    Only the dn, the original value and the attribute values are stored.
+    When ``attributes`` is given only those attributes are kept, any of them
+    missing from the entry reads as an empty list.
+    """
+    __slots__ = ('dn', '_orig_value', '_attributes', '_values')
+    
+    def __init__(self, LDAPItem, orig_value, attributes=None):
         """Create a LDAPObject with the original value saved."""
-        for attribute, values in LDAPItem.items():
-            setattr(self, attribute, values)
-        setattr(self, 'dn', LDAPItem.dn)
-        setattr(self, '_orig_value', orig_value)
-        #self._orig_value = orig_value
+        if attributes is None:
+            attributes = LDAPItem.keys()
+        self._attributes = _attribute_index(tuple(attributes))[0]
+        # dict.get skips LDAPItem.__getitem__, the item already holds lists
+        get = LDAPItem.get
+        self._values = tuple([get(attribute) or [] for attribute in self._attributes])
+        self.dn = LDAPItem.dn
+        self._orig_value = orig_value
+    
+    def __getattr__(self, attribute):
+        if attribute.startswith('_'):
+            raise AttributeError(attribute)
+        index = _attribute_index(self._attributes)[1]
+        try:
+            return self._values[index[attribute]]
+        except KeyError:
+            raise AttributeError(attribute)
+    
+    def __getstate__(self):
+        return (self.dn, self._orig_value, self._attributes, self._values)
+    
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # pickled before attribute projection, every attribute was
+            # stored in the instance dictionary
+            state = state.copy()
+            dn = state.pop('dn', '')
+            orig_value = state.pop('_orig_value', None)
+            attributes = tuple(state.keys())
+            state = (dn, orig_value, attributes, tuple(state.values()))
+        dn, orig_value, attributes, values = state
+        self.dn = dn
+        self._orig_value = orig_value
+        self._attributes = _attribute_index(attributes)[0]
+        self._values = values
+    
+    def __unicode__(self):
+        return u"%s" % self._orig_value
 
+class LazyLDAPObject(object):
+    """Stand-in for a LDAPObject that is only looked up on first use.
+    
+    The raw field value is kept in ``_orig_value`` so saving or printing a
+    model instance never touches the directory, only reading one of the
+    LDAP attributes does.
+    """
+    
+    def __init__(self, field, orig_value):
+        self.__dict__['_field'] = field
+        self.__dict__['_orig_value'] = orig_value
+        self.__dict__['_obj'] = None
+    
+    def _resolve(self):
+        """Return the LDAPObject, looking it up if needed."""
+        obj = self.__dict__['_obj']
+        if obj is None:
+            obj = self._field.lookup(self._orig_value)
+            self.__dict__['_obj'] = obj
+        return obj
+    
+    def _set_object(self, obj):
+        """Supply an already resolved LDAPObject, used by bulk lookups."""
+        self.__dict__['_obj'] = obj
+    
+    def _is_resolved(self):
+        return self.__dict__['_obj'] is not None
+    
+    def __getattr__(self, attribute):
+        if attribute.startswith('__'):
+            raise AttributeError(attribute)
+        return getattr(self._resolve(), attribute)
+    
+    def __eq__(self, other):
+        return self._orig_value == getattr(other, '_orig_value', other)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash(self._orig_value)
+    
     def __unicode__(self):
         return u"%s" % self._orig_value
     
+    def __reduce__(self):
+        # Pickle the field by reference, the LDAPObject itself is cached
+        # separately.
+        opts = self._field.model._meta
+        return (_unpickle_lazy, (opts.app_label, opts.object_name, 
+            self._field.name, self._orig_value))
+
+def _unpickle_lazy(app_label, model_name, field_name, orig_value):
+    field = models.get_model(app_label, model_name)._meta.get_field(field_name)
+    return LazyLDAPObject(field, orig_value)
+
 class LdapObjectField(models.Field):
     """This is a special field the stores a attribute for a LDAP object.
     
@@ -42,24 +181,67 @@ class LdapObjectField(models.Field):
         >>> person = Person.objects.get(pk=1)
         >>> person.ldap.givenName[0]
         'First_name'
+    
+    Pass ``attributes`` to only request, cache and store the listed LDAP
+    attributes instead of the whole entry::
+    
+           ldap = LdapObjectField(filter_attr='uid', 
+                                  attributes=('givenName', 'sn', 'mail'))
+    
+    The lookup happens the first time an LDAP attribute is read, loading
+    ``Person`` rows only reads the raw value from the database.
+    
+    Pass ``servers`` (or set ``LDAP_SERVERS``) to spread lookups over
+    replicas with failover, see ``djangoedu.ldap.servers``::
+    
+           ldap = LdapObjectField(filter_attr='uid', 
+                                  servers=['ldap1.state.edu', 'ldap2.state.edu'])
+    
+    Entries missing from the cache are asked of the directory backend, see
+    ``djangoedu.ldap.backends``, and only searched for in the directory
+    when it doesn't have them either.
     """
     __metaclass__ = models.SubfieldBase
     
     def __init__(self, verbose_name=None, name=None, filter_attr=None, **kwargs):
         """Setup up ldap object field"""
         # if server/port are null use the defaults from settings.py
-        self.base = kwargs.get('base') or getattr(settings, 'LDAP_BASE', '')
-        self.server = kwargs.get('server') or getattr(settings, 'LDAP_SERVER', None)
-        self.port = kwargs.get('port') or getattr(settings, 'LDAP_SERVER_PORT', 389)
+        self.base = kwargs.pop('base', None) or getattr(settings, 'LDAP_BASE', '')
+        server = kwargs.pop('server', None)
+        self.port = kwargs.pop('port', None) or getattr(settings, 'LDAP_SERVER_PORT', 389)
+        self.servers = kwargs.pop('servers', None)
+        if not self.servers:
+            if server:
+                self.servers = [server]
+            else:
+                self.servers = getattr(settings, 'LDAP_SERVERS', None) or \
+                    [getattr(settings, 'LDAP_SERVER', None)]
+        self.servers = [parse_server(s, self.port) for s in self.servers]
+        # cache keys are shared by the replicas, they use the first name
+        self.server = server or self.servers[0][0]
         self.filter_attr = filter_attr
+        self.attributes = kwargs.pop('attributes', None)
+        if self.attributes is not None:
+            self.attributes = tuple(self.attributes)
         assert(self.filter_attr, "Must provide a filter_attr")
         self.is_secure = getattr(settings, 'LDAP_SECURE_CONNECTION', False)
         self.username = getattr(settings, 'LDAP_SERVER_USER', '')
         self.password = getattr(settings, 'LDAP_SERVER_USER_PASSWORD', '')
         self.cache_timeout = getattr(settings, 'LDAP_CACHE_TIMEOUT', 43200) # 24 hours
+        self.pool_size = getattr(settings, 'LDAP_POOL_SIZE', 10)
+        self.pool_max_idle = getattr(settings, 'LDAP_POOL_MAX_IDLE', 300)
+        self.prefetch_chunk_size = getattr(settings, 'LDAP_PREFETCH_CHUNK_SIZE', 50)
+        self.search_timeout = getattr(settings, 'LDAP_SEARCH_TIMEOUT', None)
+        self.network_timeout = getattr(settings, 'LDAP_NETWORK_TIMEOUT', None)
+        self.failure_threshold = getattr(settings, 'LDAP_FAILURE_THRESHOLD', 3)
+        self.retry_interval = getattr(settings, 'LDAP_RETRY_INTERVAL', 30)
         kwargs['max_length'] = kwargs.get('max_length', 255)
         models.Field.__init__(self, verbose_name, name, **kwargs)
     
+    def contribute_to_class(self, cls, name):
+        super(LdapObjectField, self).contribute_to_class(cls, name)
+        self.model = cls
+    
     def get_manipulator_field_objs(self):
         return [oldforms.TextField]
 
@@ -71,27 +253,200 @@ class LdapObjectField(models.Field):
         defaults.update(kwargs)
         return super(LdapObjectField, self).formfield(**defaults)
     
+    def get_pool(self):
+        """Return the shared ServerSet of this field's servers, it is used
+        like a connection pool."""
+        return get_server_set(self.servers, self.username, self.password,
+                              self.is_secure, max_size=self.pool_size,
+                              max_idle=self.pool_max_idle,
+                              search_timeout=self.search_timeout,
+                              network_timeout=self.network_timeout,
+                              failure_threshold=self.failure_threshold,
+                              retry_interval=self.retry_interval)
+    
+    def get_cache_key(self, value):
+        key = [self.server, self.filter_attr, value]
+        if self.attributes is not None:
+            # fields storing different attributes must not share entries
+            key.append(md5.new(','.join(self.attributes)).hexdigest()[:8])
+        return '_'.join(key)
+    
+    def get_search_attributes(self):
+        """Return the attributes to request, an empty list means all."""
+        if self.attributes is None:
+            return []
+        attributes = list(self.attributes)
+        if self.filter_attr not in attributes:
+            attributes.append(self.filter_attr)
+        return attributes
+    
+    def prefetch(self, values):
+        """Resolve many values at once and store the results in the cache.
+        
+        Values already in the cache are read with a single ``get_many``,
+        those the directory backend has are taken from it and cached, the
+        rest are fetched from the directory with ``fetch``. Returns a dictionary
+        mapping every value that matched a unique LDAP object to that
+        object.
+        """
+        start = time.time()
+        values = [value for value in values if value]
+        found = {}
+        keys = {}
+        for value in values:
+            keys[self.get_cache_key(value)] = value
+        cached = ldap_cache.get_many(keys.keys(),
+            refresh=lambda key: self.refresh(keys[key]))
+        for key, obj in cached.items():
+            if obj != MISSING:
+                found[keys[key]] = obj
+        missing = [value for key, value in keys.items() if key not in cached]
+        if missing:
+            replicated = {}
+            for value, item in get_backend().get_many(self, missing).items():
+                replicated[value] = LDAPObject(item, value, self.attributes)
+            self.cache_objects(replicated.values())
+            found.update(replicated)
+            missing = [value for value in missing if value not in replicated]
+        if missing:
+            found.update(self.fetch(missing))
+        stats.timing('field.prefetch', time.time() - start)
+        stats.incr('field.prefetched', len(dict.fromkeys(values)))
+        return found
+    
+    def fetch(self, values):
+        """Look many values up in the directory, bypassing the cache.
+        
+        Values are searched with OR filters of at most
+        ``LDAP_PREFETCH_CHUNK_SIZE`` values each, all sent at once with
+        ``search_many``. The results are written to the cache and returned
+        as a dictionary mapping every value that matched a unique LDAP
+        object to that object. Values that match nothing, or more than one
+        object, are cached as missing and left for ``lookup`` to report.
+        """
+        values = [value for value in values if value]
+        chunks, filters = [], []
+        for start in range(0, len(values), self.prefetch_chunk_size):
+            chunk = values[start:start + self.prefetch_chunk_size]
+            filter = u'(|%s)' % u''.join([u'(%s=%s)' % (self.filter_attr, 
+                escape_filter_chars(value)) for value in chunk])
+            chunks.append(chunk)
+            filters.append(filter.encode('utf-8'))
+        results = self.get_pool().search_many(self.base, filters,
+            returnAttributes=self.get_search_attributes())
+        fetched = {}
+        for chunk, items in zip(chunks, results):
+            if items is None:
+                # timed out, leave these to lookup
+                continue
+            wanted = dict([(value.lower(), value) for value in chunk])
+            matches = {}
+            for item in items:
+                for attr_value in item[self.filter_attr]:
+                    value = wanted.get(attr_value.lower())
+                    if value is not None:
+                        matches.setdefault(value, []).append(item)
+            for value in chunk:
+                items = matches.get(value, [])
+                if len(items) == 1:
+                    fetched[value] = LDAPObject(items[0], value, self.attributes)
+                else:
+                    ldap_cache.set_missing(self.get_cache_key(value))
+        self.cache_objects(fetched.values())
+        return fetched
+    
+    def cache_objects(self, objects):
+        """Store LDAPObjects built elsewhere, for example by a sync job."""
+        ldap_cache.set_many(dict([(self.get_cache_key(obj._orig_value), obj)
+            for obj in objects]), self.cache_timeout)
+    
     def to_python(self, value):
-        """Lookup ldap object and return it."""
+        """Return a lazy LDAP object for value.
+        
+        The directory is not searched until an attribute is read.
+        """
         if not value:
             return
-        cache_key = '_'.join([self.server, self.filter_attr, value])
-        cached = cache.get(cache_key)
-        if cached:
+        if isinstance(value, (LDAPObject, LazyLDAPObject)):
+            return value
+        return LazyLDAPObject(self, value)
+    
+    def lookup(self, value):
+        """Lookup ldap object and return it.
+        
+        The local and shared caches are asked first, then the directory
+        backend, whose objects are cached too. If neither has the value only
+        one thread of the process searches the directory, the others wait
+        for its result.
+        """
+        start = time.time()
+        cache_key = self.get_cache_key(value)
+        cached = ldap_cache.get(cache_key, refresh=lambda: self.refresh(value))
+        if cached is None:
+            item = get_backend().get(self, value)
+            if item is not None:
+                cached = LDAPObject(item, value, self.attributes)
+                ldap_cache.set(cache_key, cached, self.cache_timeout)
+            else:
+                cached = _flights.do(cache_key, self._fetch_one, value, cache_key)
+        stats.timing('field.lookup', time.time() - start)
+        stats.incr('field.lookups')
+        if cached == MISSING:
+            raise validators.ValidationError, _("This filter must return a unique LDAP Object.")
+        return cached
+    
+    def _fetch_one(self, value, cache_key):
+        """Search the directory for value, returning the object or MISSING.
+        
+        If another process holds the refresh lock for the key its result is
+        awaited for a short while, then a stale local copy is used if there
+        is one, and only then is the directory searched anyway.
+        """
+        cached = ldap_cache.get(cache_key)
+        if cached is not None:
             return cached
-        l = {'port': self.port, 'user': self.username, 'password': self.password}
-        if self.is_secure:
-            connection = SecureLDAPConnection(self.server, **l)
-        else:
-            connection = LDAPConnection(self.server, **l)
-        filter = "%s=%s" % (self.filter_attr, value)
-        ldap_obj = connection.search(self.base, filter)
+        locked = ldap_cache.lock(cache_key)
+        if not locked:
+            cached = ldap_cache.wait(cache_key) or ldap_cache.get_stale(cache_key)
+            if cached is not None:
+                return cached
+        try:
+            return self._search_one(value, cache_key)
+        finally:
+            if locked:
+                ldap_cache.unlock(cache_key)
+    
+    def _search_one(self, value, cache_key):
+        # escaped like fetch does, so both find the same entry for a value
+        filter = u'(%s=%s)' % (self.filter_attr, escape_filter_chars(value))
+        ldap_obj = self.get_pool().search(self.base, filter.encode('utf-8'),
+                                          returnAttributes=self.get_search_attributes())
         if len(ldap_obj) != 1:
-            raise validators.ValidationError, _("This filter must return a unique LDAP Object.")
-        obj = LDAPObject(ldap_obj[0], value)
-        cache.set(cache_key, obj, self.cache_timeout)
+            ldap_cache.set_missing(cache_key)
+            return MISSING
+        obj = LDAPObject(ldap_obj[0], value, self.attributes)
+        ldap_cache.set(cache_key, obj, self.cache_timeout)
         return obj
     
+    def refresh(self, value):
+        """Search the directory for value again and rewrite its cache entry.
+        
+        Called from background threads for entries past
+        ``LDAP_CACHE_SOFT_TIMEOUT``. Does nothing if another process holds
+        the refresh lock for the key.
+        """
+        cache_key = self.get_cache_key(value)
+        if not ldap_cache.lock(cache_key):
+            return
+        try:
+            self._search_one(value, cache_key)
+        finally:
+            ldap_cache.unlock(cache_key)
+    
+    def invalidate(self, value):
+        """Purge value from the local and the shared cache."""
+        ldap_cache.delete(self.get_cache_key(value))
+    
     def get_db_prep_save(self, value):
         # Casts dates into string format for entry into database.
         if value is not None:
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Copy every entry and delete the ones gone from the directory.'),
+        make_option('--since', dest='since', default=None,
+            help='Only copy entries modified after this GeneralizedTime (e.g. 20080901000000Z).'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of entries saved per transaction.'),
+    )
+    help = "Copies changed LDAP person entries into the local directory replica."
+
+    def handle(self, *args, **options):
+        from djangoedu.ldap.replica import sync_replica
+        stats = sync_replica(since=options.get('since'), full=options.get('full'),
+                             batch_size=options.get('batch_size'))
+        print "Synced since %s: %d seen, %d created, %d updated, %d deleted in %.1f seconds" % (
+            stats['since'] or 'the beginning', stats['seen'], stats['created'],
+            stats['updated'], stats['deleted'], stats['seconds'])
@@ -0,0 +1,53 @@
+"""
+Middleware reporting what the LDAP layer cost each request.
+
+Add ``'djangoedu.ldap.middleware.LDAPStatsMiddleware'`` to
+``MIDDLEWARE_CLASSES``. The following settings are used::
+
+    LDAP_STATS_HEADER = (default False, add a X-LDAP-Stats response header;
+                         it shows clients the cost of each request, turn it
+                         on for debugging only)
+    LDAP_STATS_LOG = (default False, log the totals of every request that
+                      used LDAP to the 'djangoedu.ldap' logger)
+"""
+
+import logging
+
+from django.conf import settings
+
+from djangoedu.ldap import stats
+
+logger = logging.getLogger('djangoedu.ldap')
+
+def format_totals(totals):
+    """Return totals as ``name=value`` pairs, times in milliseconds."""
+    parts = []
+    names = totals.keys()
+    names.sort()
+    for name in names:
+        value = totals[name]
+        if name.endswith('.time'):
+            parts.append('%s=%.1fms' % (name, value * 1000))
+        else:
+            parts.append('%s=%d' % (name, value))
+    return '; '.join(parts)
+
+class LDAPStatsMiddleware(object):
+    """Collects the LDAP and LDAP cache totals of each request."""
+
+    def __init__(self):
+        self.header = getattr(settings, 'LDAP_STATS_HEADER', False)
+        self.log = getattr(settings, 'LDAP_STATS_LOG', False)
+
+    def process_request(self, request):
+        stats.start_request()
+
+    def process_response(self, request, response):
+        totals = stats.end_request()
+        if totals:
+            formatted = format_totals(totals)
+            if self.header:
+                response['X-LDAP-Stats'] = formatted
+            if self.log:
+                logger.info('%s %s', request.path, formatted)
+        return response
@@ -0,0 +1,70 @@
+import base64
+
+from django.utils.translation import ugettext as _
+from django.utils import simplejson
+from django.db import models
+
+from djangoedu.ldap.utils import LDAPItem
+
+def _dump_value(value):
+    # binary values (jpegPhoto, userCertificate, ...) stay str when decoded
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeError:
+            return {'base64': base64.b64encode(value)}
+    return value
+
+def _load_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    return value
+
+class DirectoryEntry(models.Model):
+    """*Directory Entry*
+
+    A copy of a person entry in LDAP, read by ``ReplicaBackend`` instead of
+    searching the directory. ``uid`` and ``mail`` are stored lowercased so
+    they can be matched with an index like LDAP matches them, ignoring
+    case. The attributes are kept as JSON in ``data``, values that are not
+    text as ``{"base64": ...}``.
+
+    Add ``djangoedu.ldap`` to ``INSTALLED_APPS`` to create the table and
+    keep it current with ``manage.py syncreplica``.
+    """
+    dn = models.CharField(_("DN"), max_length=255, unique=True)
+    uid = models.CharField(_("UID"), max_length=64, db_index=True)
+    ou = models.CharField(_("Organizational Unit"), max_length=255, db_index=True, blank=True)
+    mail = models.CharField(_("Email"), max_length=255, db_index=True, blank=True)
+    modified = models.CharField(_("Modified"), max_length=32, db_index=True, blank=True,
+                                help_text=_("modifyTimestamp of the entry"))
+    data = models.TextField(_("Attributes"))
+    synced = models.DateTimeField(_("Synced"), auto_now=True)
+
+    def __unicode__(self):
+        return self.dn
+
+    def set_item(self, item):
+        """Copy the dn and attributes of a LDAPItem."""
+        self.dn = item.dn
+        self.uid = item.uid.lower()[:64]
+        self.ou = item.ou[:255]
+        self.mail = item.mail.lower()[:255]
+        self.modified = item.modifyTimestamp[:32]
+        self.data = simplejson.dumps(dict([(name, [_dump_value(value) for value in values])
+            for name, values in item.items()]), sort_keys=True)
+
+    def get_item(self):
+        """Return the entry as a LDAPItem."""
+        attributes = simplejson.loads(self.data)
+        for name, values in attributes.items():
+            attributes[name] = [_load_value(value) for value in values]
+        return LDAPItem.from_decoded(self.dn, attributes)
+
+    class Meta:
+        verbose_name_plural = _("Directory Entries")
+        ordering = ['uid']
+
+    class Admin:
+        list_display = ('uid', 'mail', 'ou', 'modified', 'synced')
+        search_fields = ('uid', 'mail')
@@ -0,0 +1,127 @@
+"""
+=================
+Directory Replica
+=================
+
+Copies person entries from LDAP into the ``DirectoryEntry`` table read by
+``ReplicaBackend``.
+
+A run fetches the entries whose ``modifyTimestamp`` is not older than the
+newest one already copied, with a single paged search, and inserts or
+updates their rows in batches of one transaction each. Only rows that
+actually differ are written. The first run, or a run with ``full=True``,
+copies every entry and also deletes the rows of entries that are gone
+from the directory, which a delta search can't see.
+
+The following settings are used::
+
+    LDAP_REPLICA_FILTER = (default '(uid=*)')
+    LDAP_REPLICA_ATTRIBUTES = (default None, every user attribute)
+
+The servers, base and bind DN are the ones of ``LdapObjectField``.
+"""
+
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from djangoedu.ldap.models import DirectoryEntry
+from djangoedu.ldap.fields import LdapObjectField
+
+REPLICA_FILTER = getattr(settings, 'LDAP_REPLICA_FILTER', '(uid=*)')
+REPLICA_ATTRIBUTES = getattr(settings, 'LDAP_REPLICA_ATTRIBUTES', None)
+
+def replica_attributes():
+    """Return the attributes to request, always including the indexed ones."""
+    if REPLICA_ATTRIBUTES is None:
+        return ['*', 'modifyTimestamp']
+    attributes = list(REPLICA_ATTRIBUTES)
+    for attribute in ('uid', 'mail', 'ou', 'modifyTimestamp'):
+        if attribute not in attributes:
+            attributes.append(attribute)
+    return attributes
+
+def last_modified():
+    """Return the newest modifyTimestamp in the replica, or None."""
+    modified = DirectoryEntry.objects.exclude(modified='').order_by(
+        '-modified').values_list('modified', flat=True)[:1]
+    if modified:
+        return modified[0]
+    return None
+
+def _save_batch(items, stats):
+    existing = {}
+    for entry in DirectoryEntry.objects.filter(dn__in=[item.dn for item in items]):
+        existing[entry.dn] = entry
+    for item in items:
+        entry = existing.get(item.dn)
+        if entry is None:
+            entry = DirectoryEntry()
+            entry.set_item(item)
+            entry.save()
+            stats['created'] += 1
+            continue
+        before = (entry.uid, entry.ou, entry.mail, entry.modified, entry.data)
+        entry.set_item(item)
+        if before != (entry.uid, entry.ou, entry.mail, entry.modified, entry.data):
+            entry.save()
+            stats['updated'] += 1
+_save_batch = transaction.commit_on_success(_save_batch)
+
+def _delete_missing(seen, batch_size):
+    gone = [pk for pk, dn in DirectoryEntry.objects.values_list('pk', 'dn')
+            if dn not in seen]
+    for start in range(0, len(gone), batch_size):
+        DirectoryEntry.objects.filter(pk__in=gone[start:start + batch_size]).delete()
+    return len(gone)
+
+def sync_replica(since=None, full=False, batch_size=500, field=None):
+    """Bring the ``DirectoryEntry`` table up to date with LDAP.
+
+    Options:
+
+    * ``since``: (Optional) GeneralizedTime string, only entries modified
+      after it are copied. Defaults to the newest entry in the replica.
+    * ``full``: Copy every entry and delete rows of removed entries.
+    * ``batch_size``: Number of entries saved per transaction.
+    * ``field``: (Optional) LdapObjectField whose servers and base are
+      searched, by default one configured from the settings.
+
+    Returns a dictionary with the counts of ``seen``, ``created``,
+    ``updated`` and ``deleted`` entries as well as ``since`` and
+    ``seconds``.
+    """
+    started = time.time()
+    if field is None:
+        field = LdapObjectField(filter_attr='uid')
+    if full:
+        since = None
+    elif since is None:
+        since = last_modified()
+    filter = REPLICA_FILTER
+    if not filter.startswith('('):
+        filter = '(%s)' % filter
+    if since is not None:
+        filter = '(&%s(modifyTimestamp>=%s))' % (filter, since)
+    stats = {'seen': 0, 'created': 0, 'updated': 0, 'deleted': 0, 'since': since}
+    seen = {}
+    batch = []
+    for item in field.get_pool().iter_search(field.base, filter,
+            returnAttributes=replica_attributes(), page_size=batch_size):
+        if not item.uid:
+            continue
+        batch.append(item)
+        if since is None:
+            seen[item.dn] = True
+        if len(batch) >= batch_size:
+            _save_batch(batch, stats)
+            stats['seen'] += len(batch)
+            batch = []
+    if batch:
+        _save_batch(batch, stats)
+        stats['seen'] += len(batch)
+    if since is None:
+        stats['deleted'] = _delete_missing(seen, batch_size)
+    stats['seconds'] = time.time() - started
+    return stats
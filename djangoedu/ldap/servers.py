@@ -0,0 +1,263 @@
+"""
+Failover between replicated LDAP servers.
+
+A ``ServerSet`` sends each operation to the healthy server with the lowest
+recent latency and moves on to the next one when a server is down or too
+slow to answer. The connections themselves come from the shared
+``LDAPConnectionPool`` of each server.
+
+The following settings are used by ``LdapObjectField``::
+
+    LDAP_SERVERS = (default [LDAP_SERVER], 'host' or 'host:port' strings or
+                    (host, port) pairs)
+    LDAP_SEARCH_TIMEOUT = (default None, no timeout)
+    LDAP_NETWORK_TIMEOUT = (default None, no timeout)
+    LDAP_FAILURE_THRESHOLD = (default 3 failures in a row)
+    LDAP_RETRY_INTERVAL = (default 30 seconds)
+
+Example use:
+
+    >>> servers = get_server_set(['ldap1.state.edu', 'ldap2.state.edu:3389'],
+    ...                          search_timeout=2, network_timeout=1)
+    >>> items = servers.search("dc=directory,dc=state,dc=edu", "uid=rm6776")
+    >>> [(health.name, health.state) for health in servers.status()]
+    [('ldap1.state.edu:389', 'closed'), ('ldap2.state.edu:3389', 'closed')]
+"""
+
+import os
+import time
+import threading
+
+import ldap
+
+from djangoedu.ldap import stats
+from djangoedu.ldap.utils import LDAPPoolError, get_pool
+
+# errors after which the operation is tried on the next server
+FAILOVER_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE, ldap.BUSY)
+
+def parse_server(server, default_port=389):
+    """Return a (host, port) pair for 'host', 'host:port' or a pair.
+
+        >>> parse_server('ldap.state.edu:3389')
+        ('ldap.state.edu', 3389)
+    """
+    if isinstance(server, (tuple, list)):
+        host, port = server
+        return (host, int(port))
+    if server and ':' in server:
+        host, port = server.rsplit(':', 1)
+        return (host, int(port))
+    return (server, default_port)
+
+class ServerHealth(object):
+    """
+    Recent latency and failures of one server, with a circuit breaker.
+
+    Latency is an exponentially weighted moving average of successful
+    searches. After ``failure_threshold`` failures in a row the breaker
+    opens and the server is skipped for ``retry_interval`` seconds, then a
+    single request is let through to probe it: success closes the breaker,
+    failure keeps it open for another interval.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name, failure_threshold=3, retry_interval=30, weight=0.3):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        self.weight = weight
+        self.latency = None
+        self.failures = 0
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def is_closed(self):
+        return self.state == self.CLOSED
+
+    def start_probe(self, now=None):
+        """Return True and let the caller probe the server if its breaker
+        is open and the retry interval has passed."""
+        if now is None:
+            now = time.time()
+        self._lock.acquire()
+        try:
+            if self.state == self.CLOSED or now - self.opened_at < self.retry_interval:
+                return False
+            # a probe that never reported back is retried after another interval
+            self.state = self.HALF_OPEN
+            self.opened_at = now
+            return True
+        finally:
+            self._lock.release()
+
+    def success(self, seconds=None):
+        self._lock.acquire()
+        try:
+            self.failures = 0
+            self.state = self.CLOSED
+            self.opened_at = None
+            if seconds is not None:
+                if self.latency is None:
+                    self.latency = seconds
+                else:
+                    self.latency += self.weight * (seconds - self.latency)
+        finally:
+            self._lock.release()
+
+    def failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                    self.failures >= self.failure_threshold):
+                if self.state == self.CLOSED:
+                    stats.incr('ldap.breaker_opened')
+                self.state = self.OPEN
+                self.opened_at = time.time()
+        finally:
+            self._lock.release()
+
+class ServerSet(object):
+    """
+    A set of replicated servers used like a single ``LDAPConnectionPool``.
+
+    Operations go to the closed server with the lowest latency, servers
+    that have not answered yet come first so every server gets measured.
+    Servers due for a probe (see ``ServerHealth``) are tried before them,
+    each at most once per retry interval.
+    When a server is down, times out or has no free connection the
+    operation is retried on the next one, and when every server fails the
+    last error is raised. ``LDAPPoolError`` is raised right away if every
+    breaker is open.
+
+    Keyword arguments other than ``failure_threshold`` and
+    ``retry_interval`` are passed to ``get_pool``.
+    """
+
+    def __init__(self, servers, user="", password="", secure=False,
+                 failure_threshold=3, retry_interval=30, **kwargs):
+        self.servers = list(servers)
+        self.user = user
+        self.password = password
+        self.secure = secure
+        self.pool_kwargs = kwargs
+        self.health = {}
+        for host, port in self.servers:
+            self.health[(host, port)] = ServerHealth('%s:%s' % (host, port),
+                failure_threshold, retry_interval)
+
+    def get_pool(self, server):
+        host, port = server
+        return get_pool(host, port, self.user, self.password, self.secure,
+                        **self.pool_kwargs)
+
+    def ordered(self):
+        """Return the servers to try, in order."""
+        now = time.time()
+        closed, probe = [], []
+        for index, server in enumerate(self.servers):
+            health = self.health[server]
+            if health.is_closed():
+                closed.append((health.latency is not None, health.latency, index, server))
+            elif health.start_probe(now):
+                probe.append(server)
+        closed.sort()
+        return probe + [server for known, latency, index, server in closed]
+
+    def _run(self, method, *args):
+        servers = self.ordered()
+        if not servers:
+            stats.incr('ldap.no_server')
+            raise LDAPPoolError("No LDAP server is available.")
+        error = None
+        for server in servers:
+            health = self.health[server]
+            if error is not None:
+                stats.incr('ldap.failovers')
+            start = time.time()
+            try:
+                results = getattr(self.get_pool(server), method)(*args)
+            except FAILOVER_ERRORS, error:
+                health.failure()
+                continue
+            except LDAPPoolError, error:
+                # busy here, not broken
+                continue
+            except ldap.LDAPError:
+                # the server answered, the request was bad
+                health.success()
+                raise
+            if method == 'search':
+                health.success(time.time() - start)
+            else:
+                health.success()
+            return results
+        raise error
+
+    def search(self, searchBaseDN, filter, scope=ldap.SCOPE_SUBTREE, returnAttributes=[]):
+        """Run ``LDAPConnection.search`` on the best server."""
+        return self._run('search', searchBaseDN, filter, scope, returnAttributes)
+
+    def search_many(self, searchBaseDN, filters, scope=ldap.SCOPE_SUBTREE,
+                    returnAttributes=[], timeout=None, max_in_flight=8):
+        """Run ``LDAPConnection.search_many`` on the best server."""
+        return self._run('search_many', searchBaseDN, filters, scope,
+                         returnAttributes, timeout, max_in_flight)
+
+    def iter_search(self, searchBaseDN, filter, scope=ldap.SCOPE_SUBTREE,
+                    returnAttributes=[], page_size=500):
+        """Run ``LDAPConnection.iter_search`` on the best server.
+
+        Fails over only until the first entry has been yielded.
+        """
+        servers = self.ordered()
+        if not servers:
+            stats.incr('ldap.no_server')
+            raise LDAPPoolError("No LDAP server is available.")
+        for position, server in enumerate(servers):
+            health = self.health[server]
+            last = position == len(servers) - 1
+            started = False
+            try:
+                for item in self.get_pool(server).iter_search(searchBaseDN,
+                        filter, scope, returnAttributes, page_size):
+                    started = True
+                    yield item
+            except FAILOVER_ERRORS:
+                health.failure()
+                if started or last:
+                    raise
+                stats.incr('ldap.failovers')
+                continue
+            except LDAPPoolError:
+                if started or last:
+                    raise
+                stats.incr('ldap.failovers')
+                continue
+            health.success()
+            return
+
+    def status(self):
+        """Return the ServerHealth of each server, in configured order."""
+        return [self.health[server] for server in self.servers]
+
+_server_sets = {}
+_server_sets_lock = threading.Lock()
+
+def get_server_set(servers, user="", password="", secure=False, default_port=389,
+                   **kwargs):
+    """Return the shared ServerSet of servers for this process."""
+    servers = tuple([parse_server(server, default_port) for server in servers])
+    key = (os.getpid(), servers, user, secure)
+    _server_sets_lock.acquire()
+    try:
+        server_set = _server_sets.get(key)
+        if server_set is None:
+            server_set = ServerSet(servers, user, password, secure, **kwargs)
+            _server_sets[key] = server_set
+        return server_set
+    finally:
+        _server_sets_lock.release()
@@ -0,0 +1,151 @@
+"""
+Counters and timings for the LDAP layer.
+
+The connection, cache and field code call ``incr`` and ``timing``. Each
+call goes to the stats collector of the process and, between
+``start_request`` and ``end_request`` (see ``LDAPStatsMiddleware``), to the
+totals of the current request.
+
+The collector is chosen with a setting::
+
+    LDAP_STATS_COLLECTOR = (default 'djangoedu.ldap.stats.LocalStatsCollector')
+
+Write a subclass of ``StatsCollector`` to send the numbers elsewhere, or use
+``'djangoedu.ldap.stats.StatsCollector'`` to record nothing.
+
+Example use:
+
+    >>> from djangoedu.ldap import stats
+    >>> stats.snapshot()['counters']['ldap.searches']
+    1234
+"""
+
+import bisect
+import threading
+
+from django.conf import settings
+
+# upper bounds of the timing histogram buckets in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class StatsCollector(object):
+    """Collector that records nothing, the base for other collectors."""
+
+    def incr(self, name, count=1):
+        pass
+
+    def timing(self, name, seconds):
+        pass
+
+    def snapshot(self):
+        return {'counters': {}, 'timings': {}}
+
+class Histogram(object):
+    """Count, total, maximum and bucketed distribution of timings."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds * 1000)] += 1
+
+    def as_dict(self):
+        bounds = list(BUCKETS) + [None]
+        return {'count': self.count, 'total': self.total, 'max': self.max,
+                'buckets': zip(bounds, self.buckets)}
+
+class LocalStatsCollector(StatsCollector):
+    """Keeps cumulative counters and timing histograms for this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self.counters = {}
+            self.timings = {}
+        finally:
+            self._lock.release()
+
+    def incr(self, name, count=1):
+        self._lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def timing(self, name, seconds):
+        self._lock.acquire()
+        try:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.add(seconds)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        """Return a copy of the counters and of each timing histogram.
+
+        Histogram buckets are ``(upper bound in ms, count)`` pairs, the last
+        bound is None.
+        """
+        self._lock.acquire()
+        try:
+            return {'counters': self.counters.copy(),
+                    'timings': dict([(name, histogram.as_dict())
+                                     for name, histogram in self.timings.items()])}
+        finally:
+            self._lock.release()
+
+_collector = None
+_request = threading.local()
+
+def get_collector():
+    """Return the collector named by ``LDAP_STATS_COLLECTOR``."""
+    global _collector
+    if _collector is None:
+        path = getattr(settings, 'LDAP_STATS_COLLECTOR',
+                       'djangoedu.ldap.stats.LocalStatsCollector')
+        module, attr = path.rsplit('.', 1)
+        _collector = getattr(__import__(module, {}, {}, [attr]), attr)()
+    return _collector
+
+def incr(name, count=1):
+    get_collector().incr(name, count)
+    totals = getattr(_request, 'totals', None)
+    if totals is not None:
+        totals[name] = totals.get(name, 0) + count
+
+def timing(name, seconds):
+    get_collector().timing(name, seconds)
+    totals = getattr(_request, 'totals', None)
+    if totals is not None:
+        totals[name + '.time'] = totals.get(name + '.time', 0.0) + seconds
+
+def start_request():
+    """Start collecting totals for the current thread."""
+    _request.totals = {}
+
+def end_request():
+    """Stop collecting and return the totals of the current thread.
+
+    Counters are keyed by name and timings by name plus ``.time``, in
+    seconds. Returns None if ``start_request`` was not called.
+    """
+    totals = getattr(_request, 'totals', None)
+    _request.totals = None
+    return totals
+
+def snapshot():
+    """Return the cumulative stats of the collector."""
+    return get_collector().snapshot()
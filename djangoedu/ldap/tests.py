@@ -0,0 +1,413 @@
+import time
+import unittest
+import threading
+
+from django.core import validators
+from django.utils.encoding import smart_unicode
+
+from djangoedu.ldap import cache as ldap_cache_module
+from djangoedu.ldap import codec
+from djangoedu.ldap.cache import LDAPCache, MISSING, ldap_cache
+from djangoedu.ldap.fake import FakeDirectory, FakeLDAPConnection
+from djangoedu.ldap.fields import LDAPObject, LazyLDAPObject, LdapObjectField
+from djangoedu.ldap.models import DirectoryEntry
+from djangoedu.ldap.servers import ServerSet, ServerHealth
+from djangoedu.ldap.utils import LDAPItem, LDAPConnectionPool
+
+def make_object(uid='rm6776', attributes=None):
+    item = LDAPItem(('uid=%s,ou=people,dc=state,dc=edu' % uid,
+        {'uid': [uid], 'givenName': ['Robert'], 'sn': ['M\xc3\xbcller'],
+         'mail': ['%s@state.edu' % uid], 'ou': ['Physics']}))
+    return LDAPObject(item, uid, attributes)
+
+class MemcachedLikeCache(object):
+    """Returns strings the way the memcached backend does, through
+    ``smart_unicode``."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        value = self.data.get(key)
+        if value is None:
+            return default
+        if isinstance(value, basestring):
+            return smart_unicode(value)
+        return value
+
+    def get_many(self, keys):
+        return dict([(key, self.data[key]) for key in keys if key in self.data])
+
+    def set(self, key, value, timeout=None):
+        self.data[key] = value
+
+    def add(self, key, value, timeout=None):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+class CodecTest(unittest.TestCase):
+    """Cache entries in the codec format"""
+
+    def setUp(self):
+        self.old_cache = ldap_cache_module.cache
+        self.shared = ldap_cache_module.cache = MemcachedLikeCache()
+        self.cache = LDAPCache()
+
+    def tearDown(self):
+        ldap_cache_module.cache = self.old_cache
+
+    def testRoundTrip(self):
+        """Objects, MISSING and compressed entries come back unchanged."""
+        obj = make_object(attributes=('givenName', 'sn', 'mail', 'ou'))
+        for entry in ((None, obj), (time.time(), MISSING)):
+            decoded = codec.decode(unicode(codec.encode(entry, compress_min=10)))
+            self.assertEqual(decoded[0], entry[0])
+            if entry[1] == MISSING:
+                self.assertEqual(decoded[1], MISSING)
+            else:
+                self.assertEqual(decoded[1].dn, obj.dn)
+                self.assertEqual(decoded[1].sn, obj.sn)
+
+    def testThroughSmartUnicode(self):
+        """Entries survive a backend returning unicode."""
+        self.cache.set('person', make_object())
+        self.cache.set_missing('nobody')
+        self.cache.local.clear()
+        self.assertEqual(self.cache.get('person').sn, [u'M\xfcller'])
+        self.assertEqual(self.cache.get('nobody'), MISSING)
+        self.cache.local.clear()
+        found = self.cache.get_many(['person', 'nobody', 'other'])
+        self.assertEqual(found['person'].uid, [u'rm6776'])
+        self.assertEqual(found['nobody'], MISSING)
+        self.failIf('other' in found)
+
+    def testUnreadableIsMiss(self):
+        """Binary entries of older releases and garbage are misses."""
+        self.shared.data['binary'] = '\x01\x00x\x9c\xff\xfe'
+        self.shared.data['garbage'] = u'ldap2:0:not base64!'
+        self.assertEqual(self.cache.get('binary'), None)
+        self.assertEqual(self.cache.get('garbage'), None)
+        self.assertEqual(self.cache.get_many(['binary', 'garbage']), {})
+
+    def testUnreadableInBatch(self):
+        """A backend failing a whole get_many on one binary entry doesn't
+        make the readable entries misses."""
+        self.cache.set('person', make_object())
+        self.cache.local.clear()
+        self.shared.data['binary'] = '\x01\x00x\x9c\xff\xfe'
+        def get_many(keys):
+            return dict([(key, self.shared.get(key)) for key in keys
+                         if key in self.shared.data])
+        self.shared.get_many = get_many
+        found = self.cache.get_many(['person', 'binary', 'other'])
+        self.assertEqual(found.keys(), ['person'])
+        self.assertEqual(found['person'].sn, [u'M\xfcller'])
+
+class IterSearchTest(unittest.TestCase):
+    """Paged searches"""
+
+    def setUp(self):
+        self.directory = FakeDirectory()
+        for i in range(250):
+            self.directory.add('uid=p%03d,dc=state,dc=edu' % i, {'uid': ['p%03d' % i]})
+        self.connection = FakeLDAPConnection(self.directory)
+        self.page_sizes = []
+        search_ext = self.connection.connection.search_ext
+        def record(*args, **kwargs):
+            control = kwargs['serverctrls'][0]
+            size = getattr(control, 'size', None)
+            if size is None:
+                size = control.controlValue[0]
+            self.page_sizes.append(size)
+            return search_ext(*args, **kwargs)
+        self.connection.connection.search_ext = record
+
+    def testReadsEveryPage(self):
+        items = list(self.connection.iter_search('dc=state,dc=edu', '(uid=*)', page_size=100))
+        self.assertEqual(len(items), 250)
+        self.assertEqual(self.page_sizes, [100, 100, 100])
+
+    def testCancelledWhenClosedEarly(self):
+        """Closing the generator asks for a page of size 0."""
+        search = self.connection.iter_search('dc=state,dc=edu', '(uid=*)', page_size=100)
+        for i in range(150):
+            search.next()
+        search.close()
+        self.assertEqual(self.page_sizes, [100, 100, 0])
+
+    def testNothingToCancelAfterLastPage(self):
+        search = self.connection.iter_search('dc=state,dc=edu', '(uid=*)', page_size=100)
+        for i in range(220):
+            search.next()
+        search.close()
+        self.assertEqual(self.page_sizes, [100, 100, 100])
+
+class SlowConnection(object):
+    """A connection whose liveness check and unbind take a while."""
+
+    def __init__(self, alive=True):
+        self.alive = alive
+
+    def is_alive(self):
+        time.sleep(0.3)
+        return self.alive
+
+    def close(self):
+        time.sleep(0.3)
+
+class PoolTest(unittest.TestCase):
+    """Connection pool"""
+
+    def testChecksOutsideLock(self):
+        """Slow liveness checks of two connections overlap."""
+        pool = LDAPConnectionPool('ldap.state.edu', max_size=2, check_interval=0)
+        pool._connect = SlowConnection
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        start = time.time()
+        threads = [threading.Thread(target=lambda: pool.release(pool.acquire()))
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.failUnless(time.time() - start < 0.55)
+        self.assertEqual(pool._size, 2)
+
+    def testDeadConnectionReplaced(self):
+        pool = LDAPConnectionPool('ldap.state.edu', max_size=1, check_interval=0)
+        pool._connect = SlowConnection
+        pool.release(SlowConnection(alive=False))
+        pool._size = 1
+        connection = pool.acquire()
+        self.failUnless(connection.alive)
+        self.assertEqual(pool._size, 1)
+
+    def testPruneClosesOutsideLock(self):
+        """Other threads get connections while stale ones are unbound."""
+        pool = LDAPConnectionPool('ldap.state.edu', max_size=2, max_idle=60)
+        pool._connect = SlowConnection
+        stale, fresh = pool.acquire(), pool.acquire()
+        pool.release(stale)
+        pool.release(fresh)
+        pool._idle[0] = (stale, time.time() - 120)
+        pruning = threading.Thread(target=pool.prune)
+        pruning.start()
+        time.sleep(0.1)
+        start = time.time()
+        self.failUnless(pool.acquire() is fresh)
+        self.failUnless(time.time() - start < 0.1)
+        pruning.join()
+        self.assertEqual(pool._size, 1)
+
+class DirectoryEntryTest(unittest.TestCase):
+    """Replica rows"""
+
+    def testBinaryAttributes(self):
+        """Values that are not text are kept as base64."""
+        item = LDAPItem(('uid=rm6776,dc=state,dc=edu', {'uid': ['rm6776'],
+            'cn': ['J\xc3\xb6rg'], 'jpegPhoto': ['\xff\xd8\xff\xe0\x00']}))
+        entry = DirectoryEntry()
+        entry.set_item(item)
+        copy = entry.get_item()
+        self.assertEqual(copy['jpegPhoto'], ['\xff\xd8\xff\xe0\x00'])
+        self.assertEqual(copy.cn, u'J\xf6rg')
+        self.assertEqual(copy.uid, u'rm6776')
+
+class DirectoryTestCase(unittest.TestCase):
+    """A field on a FakeDirectory of p001 to p003, with empty caches."""
+
+    def setUp(self):
+        self.old_cache = ldap_cache_module.cache
+        self.shared = ldap_cache_module.cache = MemcachedLikeCache()
+        ldap_cache.local.clear()
+        self.directory = FakeDirectory()
+        for i in range(1, 4):
+            self.directory.add('uid=p%03d,ou=people,dc=state,dc=edu' % i,
+                {'uid': ['p%03d' % i], 'givenName': ['Person'], 'sn': ['Number %d' % i]})
+        self.field = LdapObjectField(filter_attr='uid', server='ldap.test.state.edu',
+            base='dc=state,dc=edu', attributes=('givenName', 'sn'))
+        host, port = self.field.servers[0]
+        self.pool = self.directory.install(host, port, self.field.username,
+                                           self.field.password, self.field.is_secure)
+        # filters of the searches below the base, liveness checks left out
+        self.searches = []
+        search = self.directory.search
+        def counted(base, scope, filter, attributes=None):
+            if base:
+                self.searches.append(filter)
+            return search(base, scope, filter, attributes)
+        self.directory.search = counted
+
+    def tearDown(self):
+        ldap_cache_module.cache = self.old_cache
+        ldap_cache.local.clear()
+
+class LookupTest(DirectoryTestCase):
+    """Single value lookups"""
+
+    def testFound(self):
+        self.assertEqual(self.field.lookup('p002').sn, [u'Number 2'])
+
+    def testFilterCharactersEscaped(self):
+        """Values are matched literally, as prefetch matches them."""
+        for value in ('p001*', 'p00*', 'p001)(uid=p002'):
+            self.assertRaises(validators.ValidationError, self.field.lookup, value)
+            self.assertEqual(self.field.fetch([value]), {})
+
+class LazyTest(DirectoryTestCase):
+    """Values resolved on first use"""
+
+    def testResolvedOnFirstRead(self):
+        lazy = self.field.to_python('p001')
+        self.failUnless(isinstance(lazy, LazyLDAPObject))
+        self.assertEqual(unicode(lazy), u'p001')
+        self.assertEqual(self.field.get_db_prep_save(lazy), 'p001')
+        self.assertEqual(lazy, 'p001')
+        self.assertEqual(self.searches, [])
+        self.assertEqual(lazy.sn, [u'Number 1'])
+        self.assertEqual(lazy.givenName, [u'Person'])
+        self.assertEqual(len(self.searches), 1)
+
+    def testValidationErrorDeferred(self):
+        """A value matching nothing fails when read, not when loaded."""
+        lazy = self.field.to_python('nobody')
+        self.assertEqual(unicode(lazy), u'nobody')
+        self.assertRaises(validators.ValidationError, getattr, lazy, 'sn')
+
+class NegativeCacheTest(DirectoryTestCase):
+    """Lookups that matched nothing"""
+
+    def testMissingCached(self):
+        """A value matching nothing is searched once, in either tier."""
+        self.assertRaises(validators.ValidationError, self.field.lookup, 'p004')
+        self.assertRaises(validators.ValidationError, self.field.lookup, 'p004')
+        ldap_cache.local.clear()
+        self.assertRaises(validators.ValidationError, self.field.lookup, 'p004')
+        self.assertEqual(len(self.searches), 1)
+
+    def testInvalidate(self):
+        """invalidate purges both tiers, the next lookup searches again."""
+        self.assertRaises(validators.ValidationError, self.field.lookup, 'p004')
+        self.directory.add('uid=p004,ou=people,dc=state,dc=edu',
+            {'uid': ['p004'], 'givenName': ['Person'], 'sn': ['Number 4']})
+        self.assertRaises(validators.ValidationError, self.field.lookup, 'p004')
+        self.field.invalidate('p004')
+        self.assertEqual(self.field.lookup('p004').sn, [u'Number 4'])
+        self.assertEqual(len(self.searches), 2)
+
+class SingleFlightTest(DirectoryTestCase):
+    """Concurrent misses"""
+
+    def testOneSearch(self):
+        """Threads missing the same value at once share one search."""
+        self.directory.latency = 0.2
+        found = []
+        def lookup():
+            found.append(self.field.lookup('p003').sn)
+        threads = [threading.Thread(target=lookup) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(found, [[u'Number 3']] * 5)
+        self.assertEqual(len(self.searches), 1)
+
+class SoftTimeoutTest(DirectoryTestCase):
+    """Background refresh of soft expired entries"""
+
+    def testStaleServedWhileRefreshing(self):
+        cache = LDAPCache(soft_timeout=0.1)
+        cache.set('key', 'old')
+        time.sleep(0.15)
+        refreshed = threading.Event()
+        def refresh():
+            cache.set('key', 'new')
+            refreshed.set()
+        self.assertEqual(cache.get('key', refresh=refresh), 'old')
+        refreshed.wait(2)
+        self.assertEqual(cache.get('key'), 'new')
+
+    def testFieldRefresh(self):
+        """refresh rewrites the entry from the directory."""
+        self.field.lookup('p001')
+        self.directory.delete('uid=p001,ou=people,dc=state,dc=edu')
+        self.directory.add('uid=p001,ou=people,dc=state,dc=edu',
+            {'uid': ['p001'], 'givenName': ['Person'], 'sn': ['Renamed']})
+        self.assertEqual(self.field.lookup('p001').sn, [u'Number 1'])
+        self.field.refresh('p001')
+        self.assertEqual(self.field.lookup('p001').sn, [u'Renamed'])
+        self.assertEqual(len(self.searches), 2)
+
+class FailoverTest(unittest.TestCase):
+    """Failover between replicas"""
+
+    def setUp(self):
+        self.primary = FakeDirectory()
+        self.primary.add('uid=p001,dc=state,dc=edu', {'uid': ['p001']})
+        self.secondary = self.primary.replica()
+        self.searches = {}
+        for name, directory in (('ldap1', self.primary), ('ldap2', self.secondary)):
+            directory.install('%s.test.state.edu' % name)
+            self.count(name, directory)
+        self.servers = ServerSet([('ldap1.test.state.edu', 389),
+                                  ('ldap2.test.state.edu', 389)],
+                                 failure_threshold=3, retry_interval=0.3)
+        self.first, self.second = self.servers.status()
+
+    def count(self, name, directory):
+        self.searches[name] = 0
+        search = directory.search
+        def counted(base, scope, filter, attributes=None):
+            if base:
+                self.searches[name] += 1
+            return search(base, scope, filter, attributes)
+        directory.search = counted
+
+    def search(self):
+        return self.servers.search('dc=state,dc=edu', '(uid=p001)')
+
+    def testFailover(self):
+        """A server that is down is skipped for the next one."""
+        self.primary.down = True
+        self.assertEqual(len(self.search()), 1)
+        self.assertEqual(self.searches, {'ldap1': 0, 'ldap2': 1})
+        self.assertEqual(self.first.failures, 1)
+        self.failUnless(self.first.is_closed())
+
+    def testBreaker(self):
+        """The breaker opens after 3 failures and a probe closes it."""
+        self.primary.down = True
+        for i in range(3):
+            self.search()
+        self.assertEqual(self.first.state, ServerHealth.OPEN)
+        self.assertEqual(self.servers.ordered(), [('ldap2.test.state.edu', 389)])
+        self.primary.down = False
+        self.search()
+        self.assertEqual(self.searches['ldap1'], 0)
+        time.sleep(0.35)
+        self.search()
+        self.assertEqual(self.searches['ldap1'], 1)
+        self.assertEqual(self.first.state, ServerHealth.CLOSED)
+
+    def testFailedProbe(self):
+        self.primary.down = True
+        for i in range(3):
+            self.search()
+        time.sleep(0.35)
+        self.assertEqual(len(self.search()), 1)
+        self.assertEqual(self.first.state, ServerHealth.OPEN)
+        self.assertEqual(self.servers.ordered(), [('ldap2.test.state.edu', 389)])
+
+    def testLowestLatency(self):
+        """Once both servers answered the faster one is preferred."""
+        self.primary.latency = 0.1
+        for i in range(4):
+            self.search()
+        self.assertEqual(self.searches, {'ldap1': 1, 'ldap2': 3})
@@ -3,10 +3,17 @@ Utilities for accessing LDAP databases.
 """
 
 import ldap
+from ldap.controls import SimplePagedResultsControl
+import os
 import os.path
+import time
+import atexit
+import threading
 
 from django.utils.encoding import force_unicode
 
+from djangoedu.ldap import stats
+
 DEBUG = False
 if DEBUG:
     # Set debugging level
@@ -24,19 +31,55 @@ if os.path.exists('/etc/gentoo-release'):
     ldap.set_option(ldap.OPT_X_TLS_KEYFILE, '/etc/openldap/ssl/ldap.pem')
     ldap.set_option(ldap.OPT_X_TLS_CACERTDIR, '/usr/share/ca-certificates')
 
+def _page_control(size, cookie=''):
+    """Return a Simple Paged Results request control."""
+    try:
+        # python-ldap 2.4 and later
+        return SimplePagedResultsControl(True, size=size, cookie=cookie)
+    except TypeError:
+        return SimplePagedResultsControl(ldap.LDAP_CONTROL_PAGE_OID, True, (size, cookie))
+
+def _page_cookie(controls):
+    """Return the cookie of the paged results response control, or ''."""
+    for control in controls:
+        if control.controlType == ldap.LDAP_CONTROL_PAGE_OID:
+            cookie = getattr(control, 'cookie', None)
+            if cookie is None:
+                cookie = control.controlValue[1]
+            return cookie
+    return ''
+
 class LDAPConnection(object):
     
-    def __init__(self, serverName, port=389, user="", password=""):
+    search_timeout = None
+    
+    def __init__(self, serverName, port=389, user="", password="",
+                 search_timeout=None, network_timeout=None):
         """Set up the connection.
         
         user should be a DN.
         If no user and password is given, try to connect anonymously with a blank user DN and password.
+        ``network_timeout`` limits connecting to the server and
+        ``search_timeout`` every search, both in seconds.
         """
         
         url = 'ldap://%s:%s' % (serverName, str(port))
         self.connection = ldap.initialize(url)
+        self.set_timeouts(search_timeout, network_timeout)
         self.bind(user, password)
     
+    def set_timeouts(self, search_timeout=None, network_timeout=None):
+        """Set the search and connect timeouts in seconds, None waits forever.
+        
+        A search that runs out of time raises ``ldap.TIMEOUT``, a server
+        that can't be reached in time raises ``ldap.SERVER_DOWN``.
+        """
+        self.search_timeout = search_timeout
+        if network_timeout is not None:
+            self.connection.set_option(ldap.OPT_NETWORK_TIMEOUT, network_timeout)
+        if search_timeout is not None:
+            self.connection.set_option(ldap.OPT_TIMEOUT, search_timeout)
+    
     def bind(self, dn, password):
         """Bind using the passed DN and password."""
         # It seems that python-ldap chokes when passed unicode objects with
@@ -44,19 +87,158 @@ class LDAPConnection(object):
         # it to utf-8.
         if isinstance(password, unicode):
             password = password.encode('utf-8')
-        self.connection.simple_bind_s(dn, password)        
+        start = time.time()
+        self.connection.simple_bind_s(dn, password)
+        stats.timing('ldap.bind', time.time() - start)
+        stats.incr('ldap.binds')
     
     def close(self):
         self.connection.unbind_s()
     
+    def is_alive(self):
+        """Return True if the server still answers on this connection.
+        
+        Reads the root DSE asking for no attributes, which is about the
+        cheapest request a server will answer.
+        """
+        try:
+            self.connection.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['1.1'])
+        except ldap.LDAPError:
+            return False
+        return True
+    
     def search(self, searchBaseDN, filter, scope=ldap.SCOPE_SUBTREE, returnAttributes=[]):
-        results = self.connection.search_s(searchBaseDN, scope, filter, returnAttributes)
+        start = time.time()
+        if self.search_timeout is None:
+            results = self.connection.search_s(searchBaseDN, scope, filter, returnAttributes)
+        else:
+            results = self.connection.search_st(searchBaseDN, scope, filter,
+                returnAttributes, 0, self.search_timeout)
+        stats.timing('ldap.search', time.time() - start)
+        stats.incr('ldap.searches')
+        stats.incr('ldap.results', len(results))
         return self.toItems(results)
     
+    def iter_search(self, searchBaseDN, filter, scope=ldap.SCOPE_SUBTREE,
+                    returnAttributes=[], page_size=500):
+        """Search with the Simple Paged Results control and yield LDAPItems.
+        
+        Only one page of ``page_size`` entries is held at a time, so scans
+        over the whole directory run in constant memory and are not cut
+        short by the server's size limit. When the generator is closed
+        early, or an error stops it, the search is cancelled on the server.
+        
+        Example use:
+        
+            >>> ldapc = LDAPConnection("ldap.state.edu")
+            >>> for item in ldapc.iter_search("dc=state,dc=edu", "ou=Physics"):
+            ...     print item.uid
+        """
+        cookie = ''
+        msgid = None
+        finished = False
+        try:
+            while True:
+                msgid = self.connection.search_ext(searchBaseDN, scope, filter,
+                    returnAttributes, serverctrls=[_page_control(page_size, cookie)])
+                start = time.time()
+                rtype, rdata, rmsgid, controls = self.connection.result3(msgid, 1,
+                    self.search_timeout or -1)
+                msgid = None
+                stats.timing('ldap.search_page', time.time() - start)
+                stats.incr('ldap.search_pages')
+                stats.incr('ldap.results', len(rdata))
+                cookie = _page_cookie(controls)
+                for result in rdata:
+                    if result[0] is not None:
+                        yield LDAPItem(result)
+                if not cookie:
+                    finished = True
+                    break
+        finally:
+            if not finished:
+                self._cancel_paged_search(searchBaseDN, scope, filter, msgid, cookie)
+    
+    def _cancel_paged_search(self, searchBaseDN, scope, filter, msgid, cookie):
+        """Abandon a page still being sent, or ask for a page of size 0
+        with the last cookie, which ends a paged search on the server."""
+        try:
+            if msgid is not None:
+                self.connection.abandon(msgid)
+            elif cookie:
+                msgid = self.connection.search_ext(searchBaseDN, scope, filter,
+                    ['1.1'], serverctrls=[_page_control(0, cookie)])
+                self.connection.result3(msgid, 1, self.search_timeout or -1)
+        except ldap.LDAPError:
+            pass
+    
+    def search_many(self, searchBaseDN, filters, scope=ldap.SCOPE_SUBTREE,
+                    returnAttributes=[], timeout=None, max_in_flight=8):
+        """Run several searches at once on this connection.
+        
+        Up to ``max_in_flight`` searches are sent before waiting for an
+        answer, and results are collected in whatever order the server
+        sends them. Returns a list holding the LDAPItems of each filter in
+        the order of ``filters``. A search that does not complete within
+        ``timeout`` seconds of being sent, by default the search timeout of
+        the connection, is abandoned and its slot is None.
+        
+        Example use:
+        
+            >>> ldapc = LDAPConnection("ldap.state.edu")
+            >>> physics, math = ldapc.search_many("dc=state,dc=edu", ["ou=Physics", "ou=Math"])
+        """
+        if timeout is None:
+            timeout = self.search_timeout
+        results = [None] * len(filters)
+        pending = {} # msgid -> (index, deadline)
+        next_index = 0
+        start = time.time()
+        try:
+            while next_index < len(filters) or pending:
+                while next_index < len(filters) and len(pending) < max_in_flight:
+                    msgid = self.connection.search_ext(searchBaseDN, scope,
+                        filters[next_index], returnAttributes)
+                    deadline = None
+                    if timeout is not None:
+                        deadline = time.time() + timeout
+                    pending[msgid] = (next_index, deadline)
+                    next_index += 1
+                deadlines = [deadline for index, deadline in pending.values()
+                             if deadline is not None]
+                wait = None
+                if deadlines:
+                    wait = max(min(deadlines) - time.time(), 0)
+                try:
+                    rtype, rdata, msgid = self.connection.result2(ldap.RES_ANY, 1, wait)
+                except ldap.TIMEOUT:
+                    msgid = None
+                if msgid in pending:
+                    index, deadline = pending.pop(msgid)
+                    results[index] = self.toItems(rdata)
+                    stats.incr('ldap.results', len(rdata))
+                now = time.time()
+                for msgid, (index, deadline) in pending.items():
+                    if deadline is not None and deadline <= now:
+                        del pending[msgid]
+                        self.connection.abandon(msgid)
+                        stats.incr('ldap.search_timeouts')
+        except:
+            # don't leave answers to a failed batch queued on the connection
+            for msgid in pending.keys():
+                try:
+                    self.connection.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+            raise
+        stats.timing('ldap.search_many', time.time() - start)
+        stats.incr('ldap.searches', len(filters))
+        return results
+    
     def toItems(self, results):
         """Return the LDAPResults as LDAPItems which is a dict storage container."""
         
-        return [LDAPItem(item) for item in results]
+        return decode_results(results)
 
 class SecureLDAPConnection(LDAPConnection):
     """
@@ -69,7 +251,8 @@ class SecureLDAPConnection(LDAPConnection):
         >>> ldaps.close()
     """
     
-    def __init__(self, serverName, port=636, user="", password=""):
+    def __init__(self, serverName, port=636, user="", password="",
+                 search_timeout=None, network_timeout=None):
         """
         Set up the connection.
         
@@ -80,6 +263,7 @@ class SecureLDAPConnection(LDAPConnection):
         
         url = 'ldaps://%s:%s' % (serverName, str(port))
         self.connection = ldap.initialize(url)
+        self.set_timeouts(search_timeout, network_timeout)
         self.bind(user, password)
 
 def lazy_unicode(s):
@@ -89,30 +273,63 @@ def lazy_unicode(s):
     except:
         return s
 
+# decoded attribute names, shared by every entry
+_names = {}
+
+def decode_name(name):
+    """Return the unicode attribute name, the same object for every entry."""
+    try:
+        return _names[name]
+    except KeyError:
+        return _names.setdefault(name, lazy_unicode(name))
+
+def decode_values(values):
+    """Return a list of unicode values, falling back to ``lazy_unicode``
+    value by value when one is not utf-8."""
+    try:
+        return [value.decode('utf-8') for value in values]
+    except (UnicodeError, AttributeError):
+        return [lazy_unicode(value) for value in values]
+
+def decode_results(results):
+    """Return a list of LDAPItems for python-ldap search results.
+    
+    Search continuation references are skipped.
+    """
+    return [LDAPItem(result) for result in results if result[0] is not None]
+
 class LDAPItem(dict):
     """
     Provides a storage container for LDAP objects, or anything with a DN and attributes.
     
     This is helpful for turning query results into a useful object.
+    
+    ``item[attr]`` is the list of values of an attribute and ``item.attr``
+    its first value, missing attributes give ``[]`` and ``''``.
     """
     
     def __init__(self, LDAPResult):
-        """"""
-        
+        """Decode the names and values of a (dn, attributes) result."""
         self.dn, self.attributes = LDAPResult
-        for attribute, values in self.attributes.items():
-            # force unicode attributes and values fail silently
-            attr = lazy_unicode(attribute)
-            value = [lazy_unicode(s) for s in values]
-            # Make first value of each LDAP attribute accessible
-            # through instance attribute of same name
-            setattr(self, attr, value[0])
-            # Make the entire list of values for each LDAP attribute 
-            # accessible through a dictionary mapping
-            self[attr] = value
+        # force unicode attributes and values fail silently
+        dict.__init__(self, [(decode_name(attribute), decode_values(values))
+                             for attribute, values in self.attributes.iteritems()])
+    
+    def from_decoded(cls, dn, attributes):
+        """Return a LDAPItem for attributes that are already unicode."""
+        item = dict.__new__(cls)
+        dict.__init__(item, attributes)
+        item.dn = dn
+        item.attributes = attributes
+        return item
+    from_decoded = classmethod(from_decoded)
     
     def __getattr__(self, attribute):
-        # Return an empty string if the attribute doesn't exist
+        # Return the first value, or an empty string if the attribute
+        # doesn't exist
+        values = self.get(attribute)
+        if values:
+            return values[0]
         return self.__dict__.get(attribute, '')
 
     def __getitem__(self, attribute):
@@ -137,4 +354,273 @@ class LDAPItem(dict):
         return False
     
     def __unicode__(self):
-        return unicode(self.dn)
\ No newline at end of file
+        return unicode(self.dn)
+
+class LDAPPoolError(ldap.LDAPError):
+    """Raised when no pooled connection becomes available in time."""
+
+class LDAPConnectionPool(object):
+    """
+    A thread safe pool of bound LDAP connections to a single server.
+    
+    Connections are created on demand up to ``max_size``. Idle connections
+    older than ``max_idle`` seconds are closed instead of being reused, and
+    connections that have been idle for more than ``check_interval`` seconds
+    are checked with ``is_alive`` before they are handed out.
+    ``search_timeout`` and ``network_timeout`` are passed on to the
+    connections, ``timeout`` is how long ``acquire`` waits for one.
+    
+    Example use:
+    
+        >>> pool = LDAPConnectionPool("ldap.state.edu", user="super", password="secret")
+        >>> items = pool.search("dc=directory,dc=state,dc=edu", "uid=rm6776")
+        >>> pool.close()
+    """
+    
+    def __init__(self, serverName, port=389, user="", password="", secure=False,
+                 max_size=10, max_idle=300, check_interval=30, timeout=10,
+                 search_timeout=None, network_timeout=None):
+        self.serverName = serverName
+        self.port = port
+        self.user = user
+        self.password = password
+        self.secure = secure
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.search_timeout = search_timeout
+        self.network_timeout = network_timeout
+        self._idle = [] # list of (connection, last used) pairs
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition(threading.Lock())
+    
+    def _connect(self):
+        if self.secure:
+            klass = SecureLDAPConnection
+        else:
+            klass = LDAPConnection
+        return klass(self.serverName, port=self.port, user=self.user,
+                     password=self.password, search_timeout=self.search_timeout,
+                     network_timeout=self.network_timeout)
+    
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except ldap.LDAPError:
+            pass
+    
+    def acquire(self):
+        """Return a bound connection, creating one if the pool is not full.
+        
+        Blocks for at most ``timeout`` seconds waiting for a connection to
+        be released, then raises LDAPPoolError.
+        """
+        deadline = time.time() + self.timeout
+        while True:
+            connection, idle = self._take(deadline)
+            if connection is None:
+                break
+            # the network round trips happen outside of the lock, so a slow
+            # or dead server doesn't hold up the other threads
+            if idle <= self.max_idle and (idle <= self.check_interval or
+                                          connection.is_alive()):
+                return connection
+            self._drop()
+            self._discard(connection)
+        try:
+            return self._connect()
+        except:
+            self._drop()
+            raise
+    
+    def _take(self, deadline):
+        """Pop an idle connection and how long it has been idle, or reserve
+        a slot for a new one and return (None, None)."""
+        self._lock.acquire()
+        try:
+            while True:
+                if self._closed:
+                    raise LDAPPoolError("Connection pool has been closed.")
+                now = time.time()
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    return connection, now - last_used
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None, None
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise LDAPPoolError("Timed out waiting for a LDAP connection.")
+                self._lock.wait(remaining)
+        finally:
+            self._lock.release()
+    
+    def _drop(self):
+        """Give up the slot of a connection that is not coming back."""
+        self._lock.acquire()
+        try:
+            self._size -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+    
+    def release(self, connection, broken=False):
+        """Give a connection back to the pool.
+        
+        Pass ``broken=True`` when the connection failed so that it is closed
+        instead of reused.
+        """
+        self._lock.acquire()
+        try:
+            discard = broken or self._closed
+            if discard:
+                self._size -= 1
+            else:
+                self._idle.append((connection, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+        if discard:
+            self._discard(connection)
+    
+    def _run(self, method, *args, **kwargs):
+        """Call a LDAPConnection method on a pooled connection.
+        
+        If the server went away the call is retried once on a fresh
+        connection.
+        """
+        for attempt in (1, 2):
+            connection = self.acquire()
+            try:
+                results = getattr(connection, method)(*args, **kwargs)
+            except ldap.SERVER_DOWN:
+                self.release(connection, broken=True)
+                if attempt == 2:
+                    raise
+                continue
+            except:
+                self.release(connection, broken=True)
+                raise
+            self.release(connection)
+            return results
+    
+    def search(self, searchBaseDN, filter, scope=ldap.SCOPE_SUBTREE, returnAttributes=[]):
+        """Run ``LDAPConnection.search`` on a pooled connection."""
+        return self._run('search', searchBaseDN, filter, scope, returnAttributes)
+    
+    def search_many(self, searchBaseDN, filters, scope=ldap.SCOPE_SUBTREE,
+                    returnAttributes=[], timeout=None, max_in_flight=8):
+        """Run ``LDAPConnection.search_many`` on a pooled connection."""
+        return self._run('search_many', searchBaseDN, filters, scope, 
+                         returnAttributes, timeout, max_in_flight)
+    
+    def iter_search(self, searchBaseDN, filter, scope=ldap.SCOPE_SUBTREE,
+                    returnAttributes=[], page_size=500):
+        """Run ``LDAPConnection.iter_search`` on a pooled connection.
+        
+        The connection is held until the generator is exhausted or closed.
+        """
+        connection = self.acquire()
+        broken = True
+        try:
+            for item in connection.iter_search(searchBaseDN, filter, scope,
+                                               returnAttributes, page_size):
+                yield item
+            broken = False
+        except GeneratorExit:
+            # closed early, iter_search cancelled the search on the server
+            broken = False
+            raise
+        finally:
+            self.release(connection, broken)
+    
+    def prune(self):
+        """Close connections that have been idle longer than ``max_idle``."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            keep, stale = [], []
+            for connection, last_used in self._idle:
+                if now - last_used > self.max_idle:
+                    stale.append(connection)
+                else:
+                    keep.append((connection, last_used))
+            self._idle = keep
+            self._size -= len(stale)
+            if stale:
+                self._lock.notifyAll()
+        finally:
+            self._lock.release()
+        # unbinding is a network round trip, done outside of the lock
+        for connection in stale:
+            self._discard(connection)
+    
+    def close(self):
+        """Close every idle connection and refuse new acquires.
+        
+        Connections that are checked out are closed when they are released.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            idle = self._idle
+            self._size -= len(idle)
+            self._idle = []
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+        for connection, last_used in idle:
+            self._discard(connection)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(serverName, port=389, user="", password="", secure=False, **kwargs):
+    """Return the shared pool for server, port, bind DN and secure flag.
+    
+    Pools are per process, a forked child never reuses the sockets of its
+    parent.
+    """
+    key = (os.getpid(), serverName, port, user, secure)
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = LDAPConnectionPool(serverName, port, user, password, secure, **kwargs)
+            _pools[key] = pool
+        return pool
+    finally:
+        _pools_lock.release()
+
+def set_pool(pool):
+    """Make pool the shared pool for its server, port, bind DN and secure
+    flag, for example to point fields at a fake directory."""
+    key = (os.getpid(), pool.serverName, pool.port, pool.user, pool.secure)
+    _pools_lock.acquire()
+    try:
+        old = _pools.get(key)
+        _pools[key] = pool
+    finally:
+        _pools_lock.release()
+    if old is not None and old is not pool:
+        old.close()
+
+def close_pools():
+    """Close and forget every pool of this process.
+    
+    Pools inherited from a parent process are forgotten without unbinding,
+    their sockets still belong to the parent.
+    """
+    pid = os.getpid()
+    _pools_lock.acquire()
+    try:
+        pools = [pool for key, pool in _pools.items() if key[0] == pid]
+        _pools.clear()
+    finally:
+        _pools_lock.release()
+    for pool in pools:
+        pool.close()
+
+atexit.register(close_pools)